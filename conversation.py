@@ -0,0 +1,143 @@
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+# Цепочка ответов на стороне OpenAI (previous_response_id); 0 — всегда слать историю самим
+CONVERSATION_CHAINING = os.getenv("CONVERSATION_CHAINING", "1") == "1"
+# Сколько последних реплик держим для запасного варианта и их бюджет в токенах
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "8"))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "1500"))
+# Через сколько секунд тишины диалог забывается; лимиты на число диалогов и память под текст
+CONVERSATION_IDLE = float(os.getenv("CONVERSATION_IDLE", "1800"))
+CONVERSATION_MAX_USERS = int(os.getenv("CONVERSATION_MAX_USERS", "50000"))
+CONVERSATION_BUDGET_BYTES = int(os.getenv("CONVERSATION_BUDGET_BYTES", str(32 * 1024 * 1024)))
+
+
+def estimate_tokens(text: str) -> int:
+    # грубо: для русского текста ~3 символа на токен
+    return len(text) // 3 + 1
+
+
+class _Conversation:
+    """Диалог одного пользователя: id последнего ответа и короткий хвост реплик."""
+
+    __slots__ = ("response_id", "turns", "tokens", "size", "touched")
+
+    def __init__(self, now: float):
+        self.response_id: Optional[str] = None
+        # (role, text, tokens); старые реплики вытесняются при переполнении
+        self.turns: deque[tuple[str, str, int]] = deque()
+        self.tokens = 0
+        self.size = 0
+        self.touched = now
+
+
+class ConversationStore:
+    """
+    Память ассистента в процессе. Пока цепочка на стороне OpenAI жива,
+    следующий вопрос уходит только с previous_response_id, без истории.
+    Кольцевой буфер последних реплик (в пределах бюджета токенов) нужен,
+    когда цепочки нет: первый ход пришёл из кэша/общего запроса, ответ
+    на стороне OpenAI истёк или цепочка выключена.
+    """
+
+    def __init__(self, max_turns: int, token_budget: int, idle: float, max_users: int, budget_bytes: int):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.idle = idle
+        self.max_users = max_users
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+        self.chained = 0
+        self.replayed = 0
+        self.chain_lost = 0
+        self._items: "OrderedDict[int, _Conversation]" = OrderedDict()
+
+    def _drop(self, tg_id: int) -> None:
+        conv = self._items.pop(tg_id, None)
+        if conv is not None:
+            self.total_bytes -= conv.size
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._items:
+            tg_id, conv = next(iter(self._items.items()))
+            if (now - conv.touched < self.idle and len(self._items) <= self.max_users
+                    and self.total_bytes <= self.budget_bytes):
+                break
+            self._drop(tg_id)
+
+    def _get(self, tg_id: int) -> Optional[_Conversation]:
+        conv = self._items.get(tg_id)
+        if conv is not None and time.monotonic() - conv.touched >= self.idle:
+            self._drop(tg_id)
+            return None
+        return conv
+
+    def active(self, tg_id: Optional[int]) -> bool:
+        return tg_id is not None and self._get(tg_id) is not None
+
+    def context(self, tg_id: int) -> tuple[Optional[str], list[dict]]:
+        """(previous_response_id, прошлые реплики для input) — нужно что-то одно."""
+        conv = self._get(tg_id)
+        if conv is None:
+            return None, []
+        if CONVERSATION_CHAINING and conv.response_id:
+            self.chained += 1
+            return conv.response_id, []
+        self.replayed += 1
+        return None, [{"role": role, "content": text} for role, text, _ in conv.turns]
+
+    def forget_chain(self, tg_id: int) -> None:
+        """Ответ по previous_response_id недоступен — дальше шлём историю."""
+        conv = self._items.get(tg_id)
+        if conv is not None:
+            conv.response_id = None
+            self.chain_lost += 1
+
+    def _append(self, conv: _Conversation, role: str, text: str) -> None:
+        # реплика длиннее всего бюджета не должна вытеснить сама себя — обрезаем её
+        if estimate_tokens(text) > self.token_budget:
+            text = text[:max(self.token_budget - 1, 0) * 3]
+        tokens = estimate_tokens(text)
+        conv.turns.append((role, text, tokens))
+        conv.tokens += tokens
+        conv.size += len(text)
+        self.total_bytes += len(text)
+        # новейшую реплику не трогаем
+        while len(conv.turns) > 1 and (len(conv.turns) > self.max_turns or conv.tokens > self.token_budget):
+            _, old, old_tokens = conv.turns.popleft()
+            conv.tokens -= old_tokens
+            conv.size -= len(old)
+            self.total_bytes -= len(old)
+
+    def record(self, tg_id: int, question: str, answer: str, response_id: Optional[str] = None) -> None:
+        now = time.monotonic()
+        conv = self._get(tg_id)
+        if conv is None:
+            conv = self._items[tg_id] = _Conversation(now)
+        conv.touched = now
+        conv.response_id = response_id
+        self._append(conv, "user", question)
+        self._append(conv, "assistant", answer)
+        self._items.move_to_end(tg_id)
+        self._evict()
+
+    def reset(self, tg_id: int) -> None:
+        self._drop(tg_id)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._items),
+            "bytes": self.total_bytes,
+            "chained": self.chained,
+            "replayed": self.replayed,
+            "chain_lost": self.chain_lost,
+        }
+
+
+conversations = ConversationStore(
+    CONVERSATION_MAX_TURNS, CONVERSATION_TOKEN_BUDGET, CONVERSATION_IDLE,
+    CONVERSATION_MAX_USERS, CONVERSATION_BUDGET_BYTES,
+)
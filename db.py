@@ -1,13 +1,22 @@
 # db.py
+import asyncio
+import contextvars
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 
 from sqlalchemy import (
-    Integer, String, BigInteger, DateTime, ForeignKey, func, select, Boolean
+    Integer, String, BigInteger, DateTime, ForeignKey, func, select, update, or_, Boolean,
+    Index, Text, inspect, text, event, UniqueConstraint, LargeBinary,
 )
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column, relationship
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from metrics import observe_sql
 
 # ---------- Константы/настройки ----------
 DB_URL = os.getenv("DB_URL", "sqlite+aiosqlite:///bot.db")
@@ -24,8 +33,80 @@ MONTH_PRICE_RUB = int(os.getenv("SUB_PRICE_RUB", "100"))
 # Бонус за приглашённого оплатившего реферала (в рублях)
 REFERRAL_BONUS_RUB = int(os.getenv("REFERRAL_BONUS_RUB", "50"))
 
+# Кэш снимков доступа: размер (кол-во пользователей) и время жизни записи в секундах
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE", "10000"))
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL", "30"))
+
+# Групповая запись в журнал операций: окно сбора пачки (сек) и её максимальный размер
+LEDGER_BATCH_WINDOW = float(os.getenv("LEDGER_BATCH_WINDOW", "0.005"))
+LEDGER_BATCH_MAX = int(os.getenv("LEDGER_BATCH_MAX", "100"))
+
+# ---------- Профиль БД ----------
+# sqlite (aiosqlite, по умолчанию) или postgres (asyncpg, DB_URL=postgresql+asyncpg://...)
+DB_PROFILE = os.getenv("DB_PROFILE", "postgres" if DB_URL.startswith("postgresql") else "sqlite")
+
+# Пул соединений (для sqlite много соединений не нужно: писатель всё равно один,
+# но запас на всплески чтения оставляем)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10" if DB_PROFILE == "postgres" else "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20" if DB_PROFILE == "postgres" else "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# PostgreSQL: соединения старше часа пересоздаём (обрывы через pgbouncer/балансировщик)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+
+# PRAGMA для SQLite: WAL, NORMAL (в WAL безопасно), ожидание блокировки, mmap и кэш страниц
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # отрицательное значение — размер в КиБ
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),
+    "temp_store": "MEMORY",
+}
+
+
+def _engine_options() -> dict:
+    if DB_PROFILE == "postgres":
+        return dict(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=True,
+            pool_recycle=DB_POOL_RECYCLE,
+            connect_args={
+                "command_timeout": 30,
+                "server_settings": {"application_name": "hangman-bot", "jit": "off"},
+            },
+        )
+    if ":memory:" in DB_URL:
+        return {}
+    return dict(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+
 # ---------- SQLAlchemy ----------
-engine = create_async_engine(DB_URL, echo=False, future=True)
+engine = create_async_engine(DB_URL, echo=False, future=True, **_engine_options())
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL: читатели не блокируются писателями (важно для FSM и нескольких процессов)
+    if engine.dialect.name == "sqlite":
+        cur = dbapi_conn.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cur.execute(f"PRAGMA {name}={value}")
+        cur.close()
+
+
+# Метрики SQL: число и время запросов (по типу и на апдейт)
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info["sql_started"] = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    observe_sql(statement, time.perf_counter() - conn.info.pop("sql_started", time.perf_counter()))
+
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 Base = declarative_base()
 
@@ -42,6 +123,9 @@ class User(Base):
     # реферальные поля
     inviter_tg: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
     first_payment_bonus_given: Mapped[bool] = mapped_column(Boolean, default=False)
+    # денормализованная дата окончания подписки (max(Subscription.end_at)),
+    # обновляется в activate_subscription в той же транзакции
+    subscription_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
@@ -58,16 +142,369 @@ class Subscription(Base):
 
     user: Mapped[User] = relationship(back_populates="subscriptions")
 
+    __table_args__ = (
+        Index("ix_subscriptions_user_id_end_at", "user_id", "end_at"),
+    )
+
+
+class Transaction(Base):
+    """Журнал операций по балансу: пополнения, дневные списания, реферальные бонусы."""
+    __tablename__ = "transactions"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_tg: Mapped[int] = mapped_column(BigInteger, index=True)
+    # topup | daily | referral | opening (перенос баланса, бывшего до журнала)
+    kind: Mapped[str] = mapped_column(String(16))
+    # сумма в рублях: + начисление, - списание
+    amount_rub: Mapped[int] = mapped_column(Integer)
+    # уникальный id операции (telegram_payment_charge_id, daily:<tg>:<дата>, ...)
+    charge_id: Mapped[Optional[str]] = mapped_column(String(255), unique=True, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class VisionCacheEntry(Base):
+    """Кэш ответов GPT_vision по перцептивному хэшу фото (см. visioncache.py)."""
+    __tablename__ = "vision_cache"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # 64-битный dHash, хранится со знаком (BigInteger)
+    dhash: Mapped[int] = mapped_column(BigInteger, index=True)
+    # нормализованный текст уточнений пользователя ("" — без уточнений)
+    extra_key: Mapped[str] = mapped_column(Text, default="")
+    result: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class TextCacheEntry(Base):
+    """Кэш ответов GPT_text по нормализованному вопросу (см. textcache.py)."""
+    __tablename__ = "text_cache"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # sha256 нормализованного текста вопроса
+    key: Mapped[str] = mapped_column(String(64), unique=True, index=True)
+    norm_text: Mapped[str] = mapped_column(Text)
+    result: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
+
+
+class FSMRecord(Base):
+    """Состояние FSM и данные пользователя (см. storage.py)."""
+    __tablename__ = "fsm_states"
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    # JSON со словарём данных FSM
+    data: Mapped[str] = mapped_column(Text, default="{}")
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+class UsageRecord(Base):
+    """Один вызов OpenAI: токены и задержка (только добавление, см. usage.py)."""
+    __tablename__ = "usage_log"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # 0 — вызов без пользователя (прогрев и т.п.)
+    tg_id: Mapped[int] = mapped_column(BigInteger, default=0)
+    lane: Mapped[str] = mapped_column(String(16))
+    model: Mapped[str] = mapped_column(String(64))
+    input_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    cached_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    output_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    latency_ms: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+class UsageDaily(Base):
+    """Сводка токенов за день по пользователю и полосе."""
+    __tablename__ = "usage_daily"
+    __table_args__ = (UniqueConstraint("day", "tg_id", "lane", name="uq_usage_daily"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    day: Mapped[str] = mapped_column(String(10), index=True)  # YYYY-MM-DD (UTC)
+    tg_id: Mapped[int] = mapped_column(BigInteger, default=0)
+    lane: Mapped[str] = mapped_column(String(16))
+    calls: Mapped[int] = mapped_column(Integer, default=0)
+    input_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    cached_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    output_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    latency_ms: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class Job(Base):
+    """Фоновая генерация ответа (см. jobqueue.py): переживает рестарт бота."""
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_status_lease", "status", "lease_until"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(16))  # text | vision
+    # enqueued → leased → done | failed
+    status: Mapped[str] = mapped_column(String(16), default="enqueued")
+    tg_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    # сообщение-статус, которое правим результатом
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    message_id: Mapped[int] = mapped_column(BigInteger)
+    # вопрос ассистенту или уточнения к фото; само фото — в image до завершения
+    text: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    image: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    # до этого момента задача невидима для других воркеров (аренда или пауза перед повтором)
+    lease_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    owner: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+class PendingPhoto(Base):
+    """Фото, ждущее уточнений пользователя (см. photos.py, при FSM_STORAGE=sql)."""
+    __tablename__ = "pending_photos"
+
+    # ключ из FSM (photo_key)
+    key: Mapped[str] = mapped_column(String(32), primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
+
+class Migration(Base):
+    """Выполненные разовые миграции данных (чтобы не повторять их на каждом старте)."""
+    __tablename__ = "migrations"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
 # ---------- Инициализация ----------
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_migrate_subscription_until)
+        await conn.run_sync(_migrate_ledger_opening)
+
+
+def _migrate_subscription_until(conn) -> None:
+    """Разовая миграция старых bot.db: колонка users.subscription_until + индекс подписок."""
+    columns = {c["name"] for c in inspect(conn).get_columns("users")}
+    if "subscription_until" not in columns:
+        conn.execute(text("ALTER TABLE users ADD COLUMN subscription_until TIMESTAMP"))
+        conn.execute(text(
+            "UPDATE users SET subscription_until = "
+            "(SELECT max(end_at) FROM subscriptions WHERE subscriptions.user_id = users.id)"
+        ))
+    for index in Subscription.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+# общий для SQLite и PostgreSQL: || приводит tg_id к тексту в обеих БД
+_LEDGER_OPENING_SQL = text(
+    "INSERT INTO transactions (user_tg, kind, amount_rub, charge_id, created_at) "
+    "SELECT tg_id, 'opening', balance_rub, 'opening:' || tg_id, CURRENT_TIMESTAMP FROM users "
+    "WHERE balance_rub <> 0 AND NOT EXISTS "
+    "(SELECT 1 FROM transactions t WHERE t.user_tg = users.tg_id)"
+)
+
+
+def _migrate_ledger_opening(conn) -> None:
+    """Балансы, накопленные до появления журнала, переносим в него записями opening."""
+    if conn.execute(text("SELECT 1 FROM migrations WHERE name = 'ledger_opening'")).first():
+        return
+    conn.execute(_LEDGER_OPENING_SQL)
+    # в той же транзакции, что и перенос (init_db — engine.begin)
+    conn.execute(text("INSERT INTO migrations (name, applied_at) VALUES ('ledger_opening', CURRENT_TIMESTAMP)"))
 
 
 # ---------- Вспомогательные ----------
 def _today_str() -> str:
     return datetime.utcnow().strftime("%Y-%m-%d")
 
+
+def daily_price_rub() -> int:
+    # стоимость дня в рублях, округление вверх из копеек
+    return (DAILY_PRICE_KOP + 99) // 100
+
+
+# ---------- Кэш снимков доступа (LRU + TTL) ----------
+_access_cache: "OrderedDict[int, tuple[float, dict]]" = OrderedDict()
+# растёт при каждом сбросе: снимок, прочитанный до сброса, в кэш уже не кладём
+_access_epoch = 0
+
+
+def _cache_get(tg_id: int) -> Optional[dict]:
+    item = _access_cache.get(tg_id)
+    if item is None:
+        return None
+    expires_at, snap = item
+    if expires_at < time.monotonic():
+        _access_cache.pop(tg_id, None)
+        return None
+    _access_cache.move_to_end(tg_id)
+    return snap
+
+
+def _cache_put(tg_id: int, snap: dict) -> None:
+    _access_cache[tg_id] = (time.monotonic() + ACCESS_CACHE_TTL, snap)
+    _access_cache.move_to_end(tg_id)
+    while len(_access_cache) > ACCESS_CACHE_SIZE:
+        _access_cache.popitem(last=False)
+
+
+def invalidate_access(tg_id: Optional[int]) -> None:
+    """Сбрасываем снимок доступа пользователя после изменения баланса/подписки."""
+    global _access_epoch
+    if tg_id is not None:
+        _access_epoch += 1
+        _access_cache.pop(tg_id, None)
+
+# ---------- Журнал операций (ledger) с групповой фиксацией ----------
+def dialect_insert(model):
+    """INSERT с поддержкой ON CONFLICT для текущей БД (SQLite или PostgreSQL)."""
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    return insert(model)
+
+
+def _credit_insert(op: dict):
+    # запись в журнал идемпотентна по charge_id: повтор не начисляет второй раз
+    return (
+        dialect_insert(Transaction)
+        .values(user_tg=op["tg_id"], kind=op["kind"], amount_rub=op["amount"], charge_id=op["charge_id"])
+        .on_conflict_do_nothing(index_elements=[Transaction.charge_id])
+        .returning(Transaction.id)
+    )
+
+
+async def _apply_credit(session: AsyncSession, op: dict) -> Optional[int]:
+    res = await session.execute(_credit_insert(op))
+    if res.first() is None:
+        return None
+    res = await session.execute(
+        update(User)
+        .where(User.tg_id == op["tg_id"])
+        .values(balance_rub=User.balance_rub + op["amount"])
+        .returning(User.balance_rub)
+    )
+    return res.scalar_one()
+
+
+async def _apply_daily(session: AsyncSession, op: dict) -> bool:
+    # условие по балансу, дате и подписке проверяется в самом UPDATE,
+    # поэтому параллельные нажатия не спишут дважды
+    today = op["today"]
+    day_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    res = await session.execute(
+        update(User)
+        .where(
+            User.tg_id == op["tg_id"],
+            User.balance_rub >= op["amount"],
+            or_(User.last_charge_date.is_(None), User.last_charge_date != today),
+            or_(User.subscription_until.is_(None), User.subscription_until < day_start),
+        )
+        .values(
+            balance_rub=User.balance_rub - op["amount"],
+            last_charge_date=today,
+        )
+        .returning(User.balance_rub)
+    )
+    if res.first() is None:
+        return False
+    session.add(Transaction(
+        user_tg=op["tg_id"], kind="daily", amount_rub=-op["amount"],
+        charge_id=f"daily:{op['tg_id']}:{today}",
+    ))
+    return True
+
+
+async def _apply_referral(session: AsyncSession, op: dict) -> Optional[int]:
+    # отметка о бонусе и само начисление — в одной транзакции пачки
+    res = await session.execute(
+        update(User)
+        .where(
+            User.tg_id == op["invitee_tg"],
+            User.inviter_tg == op["tg_id"],
+            User.first_payment_bonus_given.is_not(True),
+        )
+        .values(first_payment_bonus_given=True)
+        .execution_options(synchronize_session=False)
+    )
+    if res.rowcount != 1:
+        return None
+    return await _apply_credit(session, {**op, "kind": "referral", "charge_id": f"referral:{op['invitee_tg']}"})
+
+
+_LEDGER_OPS = {"credit": _apply_credit, "daily": _apply_daily, "referral": _apply_referral}
+
+
+class LedgerWriter:
+    """
+    Групповая фиксация: операции, пришедшие в течение LEDGER_BATCH_WINDOW,
+    пишутся одной транзакцией (один fsync вместо десятка). Если пачка упала,
+    операции повторяются по одной, чтобы ошибка одной не задела остальные.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.ops = 0
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, op: dict):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((op, fut))
+        if self._task is None or self._task.done():
+            # пустой контекст: запросы пачки не засчитываются апдейту, который её открыл
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+        return await asyncio.shield(fut)
+
+    async def _run(self) -> None:
+        while self._pending:
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.window)
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                results = await self._apply(batch)
+            except Exception:
+                for item in batch:
+                    try:
+                        results = await self._apply([item])
+                        item[1].set_result(results[0])
+                    except Exception as e:
+                        item[1].set_exception(e)
+                continue
+            for (_, fut), result in zip(batch, results):
+                fut.set_result(result)
+
+    async def _apply(self, batch: list[tuple[dict, asyncio.Future]]) -> list:
+        async with AsyncSessionLocal() as session:
+            results = [await _LEDGER_OPS[op["op"]](session, op) for op, _ in batch]
+            await session.commit()
+        self.batches += 1
+        self.ops += len(batch)
+        for op, _ in batch:
+            invalidate_access(op["tg_id"])
+        return results
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "ops": self.ops, "pending": len(self._pending)}
+
+
+ledger = LedgerWriter(LEDGER_BATCH_WINDOW, LEDGER_BATCH_MAX)
+
+
+async def rebuild_balances() -> None:
+    """Пересчитываем users.balance_rub из журнала операций (баланс — проекция журнала)."""
+    global _access_epoch
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(User).values(
+                balance_rub=select(func.coalesce(func.sum(Transaction.amount_rub), 0))
+                .where(Transaction.user_tg == User.tg_id)
+                .scalar_subquery()
+            )
+        )
+        await session.commit()
+    _access_epoch += 1
+    _access_cache.clear()
+
+
 # ---------- Публичные функции, которые дергает handlers.py ----------
 async def get_or_create_user(session: AsyncSession, tg_id: int) -> User:
     res = await session.execute(select(User).where(User.tg_id == tg_id))
@@ -85,28 +522,36 @@ async def get_balance(session: AsyncSession, tg_id: int) -> int:
     return user.balance_rub or 0
 
 
-async def credit_balance(session: AsyncSession, tg_id: int, amount_rub: int) -> int:
+async def credit_balance(
+    session: AsyncSession, tg_id: int, amount_rub: int,
+    charge_id: Optional[str] = None, kind: str = "topup",
+) -> int:
+    """
+    Начисление через журнал операций. Повтор с тем же charge_id (повторно
+    доставленный апдейт об оплате) ничего не начисляет и возвращает текущий баланс.
+    """
     user = await get_or_create_user(session, tg_id)
-    user.balance_rub = (user.balance_rub or 0) + int(amount_rub)
+    # отпускаем соединение сессии: пока ждём пакет, оно нужно писателю журнала
     await session.commit()
-    return user.balance_rub
-
-
-async def _active_subscription_until(session: AsyncSession, user_id: int) -> Optional[datetime]:
-    res = await session.execute(
-        select(func.max(Subscription.end_at)).where(Subscription.user_id == user_id)
-    )
-    return res.scalar_one_or_none()
+    balance = await ledger.submit({
+        "op": "credit", "tg_id": tg_id, "amount": int(amount_rub),
+        "kind": kind, "charge_id": charge_id,
+    })
+    if balance is None:
+        await session.refresh(user)
+        return user.balance_rub or 0
+    return balance
 
 
 async def is_subscription_active(session: AsyncSession, tg_id: int) -> bool:
     user = await get_or_create_user(session, tg_id)
-    end = await _active_subscription_until(session, user.id)
+    end = user.subscription_until
     return bool(end and end.date() >= datetime.utcnow().date())
 
 
 async def activate_subscription(session: AsyncSession, user_id: int, days: int = 30) -> Subscription:
-    current_end = await _active_subscription_until(session, user_id)
+    user = await session.get(User, user_id)
+    current_end = user.subscription_until
     start_from = max(datetime.utcnow(), current_end) if current_end else datetime.utcnow()
     sub = Subscription(
         user_id=user_id,
@@ -114,11 +559,57 @@ async def activate_subscription(session: AsyncSession, user_id: int, days: int =
         end_at=start_from + timedelta(days=days),
     )
     session.add(sub)
+    user.subscription_until = sub.end_at
     await session.commit()
     await session.refresh(sub)
+    invalidate_access(user.tg_id)
     return sub
 
 
+async def _load_access_snapshot(tg_id: int) -> dict:
+    # один запрос по одной строке users, подписка уже денормализована
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            select(
+                User.balance_rub,
+                User.last_charge_date,
+                User.inviter_tg,
+                User.subscription_until,
+            ).where(User.tg_id == tg_id)
+        )
+        row = res.first()
+        if row is None:
+            user = await get_or_create_user(session, tg_id)
+            row = (user.balance_rub, user.last_charge_date, user.inviter_tg, user.subscription_until)
+    balance, last_charge_date, inviter_tg, sub_until = row
+    return {
+        "balance_rub": balance or 0,
+        "last_charge_date": last_charge_date,
+        "subscription_until": sub_until,
+        "inviter_tg": inviter_tg,
+    }
+
+
+async def get_access_snapshot(tg_id: int) -> dict:
+    """
+    Снимок данных доступа пользователя: баланс, дата последнего списания,
+    окончание подписки и пригласивший. Читается одним запросом и кэшируется.
+    """
+    snap = _cache_get(tg_id)
+    if snap is None:
+        epoch = _access_epoch
+        snap = await _load_access_snapshot(tg_id)
+        # пока читали, могло пройти списание — такой снимок устарел, не кэшируем
+        if epoch == _access_epoch:
+            _cache_put(tg_id, snap)
+    return snap
+
+
+def snapshot_sub_active(snap: dict) -> bool:
+    end = snap["subscription_until"]
+    return bool(end and end.date() >= datetime.utcnow().date())
+
+
 async def ensure_access_with_wallet_daily(tg_id: int) -> dict:
     """
     Правило доступа (без пробных попыток):
@@ -127,28 +618,29 @@ async def ensure_access_with_wallet_daily(tg_id: int) -> dict:
     3) Иначе пытаемся списать стоимость дня (округление вверх). Если хватило — доступ есть.
     4) Иначе — доступа нет.
     """
-    async with AsyncSessionLocal() as session:
-        user = await get_or_create_user(session, tg_id)
-
-        # 1) активная подписка?
-        if await is_subscription_active(session, tg_id):
-            return {"allowed": True, "reason": "sub_active"}
-
-        # 2) уже списывали сегодня?
-        today = _today_str()
-        if user.last_charge_date == today:
-            return {"allowed": True, "reason": "already_charged"}
-
-        # 3) пробуем списать дневную стоимость (3 ₽ при DAILY_PRICE_KOP=300)
-        rub_to_charge = (DAILY_PRICE_KOP + 99) // 100
-        if (user.balance_rub or 0) >= rub_to_charge:
-            user.balance_rub -= rub_to_charge
-            user.last_charge_date = today
-            await session.commit()
-            return {"allowed": True, "reason": "charged"}
-
-        # 4) денег нет — доступ закрыт
-        return {"allowed": False, "reason": "no_balance"}
+    # 1-2) проверки по кэшированному снимку, без похода в БД
+    snap = await get_access_snapshot(tg_id)
+    if snapshot_sub_active(snap):
+        return {"allowed": True, "reason": "sub_active"}
+
+    today = _today_str()
+    if snap["last_charge_date"] == today:
+        return {"allowed": True, "reason": "already_charged"}
+
+    # 3) атомарное списание одним условным UPDATE + запись в журнал (см. _apply_daily)
+    charged = await ledger.submit({"op": "daily", "tg_id": tg_id, "amount": daily_price_rub(), "today": today})
+    if charged:
+        return {"allowed": True, "reason": "charged"}
+
+    # списания не было — выясняем причину по свежему снимку
+    snap = await get_access_snapshot(tg_id)
+    if snapshot_sub_active(snap):
+        return {"allowed": True, "reason": "sub_active"}
+    if snap["last_charge_date"] == today:
+        return {"allowed": True, "reason": "already_charged"}
+
+    # 4) денег нет — доступ закрыт
+    return {"allowed": False, "reason": "no_balance"}
 
 async def set_inviter_if_first(session: AsyncSession, invitee_tg: int, inviter_tg: int) -> bool:
     """Сохраняем пригласившего один раз, игнорируем самоприглашение."""
@@ -158,6 +650,7 @@ async def set_inviter_if_first(session: AsyncSession, invitee_tg: int, inviter_t
     if user.inviter_tg is None:
         user.inviter_tg = inviter_tg
         await session.commit()
+        invalidate_access(invitee_tg)
         return True
     return False
 
@@ -166,7 +659,13 @@ async def reward_referrer_on_first_paid(session: AsyncSession, invitee_tg: int)
     """Начисляем бонус пригласившему один раз при первой оплате приглашённого."""
     user = await get_or_create_user(session, invitee_tg)
     if user.inviter_tg and not user.first_payment_bonus_given:
-        inviter = await get_or_create_user(session, user.inviter_tg)
-        inviter.balance_rub = (inviter.balance_rub or 0) + REFERRAL_BONUS_RUB
-        user.first_payment_bonus_given = True
+        await get_or_create_user(session, user.inviter_tg)
+        # отпускаем соединение сессии, как в credit_balance
         await session.commit()
+        # флаг у приглашённого и начисление пригласившему пишутся одной транзакцией;
+        # charge_id по приглашённому: бонус за него не начислится дважды
+        await ledger.submit({
+            "op": "referral", "tg_id": user.inviter_tg, "invitee_tg": invitee_tg,
+            "amount": REFERRAL_BONUS_RUB,
+        })
+        invalidate_access(invitee_tg)
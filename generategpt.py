@@ -1,23 +1,171 @@
-from openai import AsyncOpenAI, DefaultHttpxClient
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError, APIStatusError, InternalServerError, RateLimitError,
+)
 import httpx
+import asyncio
 import base64
-import aiofiles
+import contextlib
+import hashlib
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
 
 import os
+from typing import AsyncIterator, Awaitable, Callable
 from dotenv import load_dotenv
 
+from imageprep import image_dhash
+from metrics import observe_openai, observe_tokens
+from visioncache import vision_cache, normalize_extra
+from textcache import text_cache, normalize_question
+from conversation import conversations
+from usage import usage_recorder
+from topicfilter import topic_filter
+
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 PROXY = os.getenv("HTTP_PROXY")
 API_KEY = os.getenv("GPT_TOKEN")
 
-http_client = httpx.AsyncClient(proxy=PROXY) if PROXY else httpx.AsyncClient()
+# ---------- HTTP-клиент OpenAI ----------
+# Пул соединений: максимум соединений, сколько держать живыми и сколько секунд
+GPT_POOL_MAX = int(os.getenv("GPT_POOL_MAX", "20"))
+GPT_POOL_KEEPALIVE = int(os.getenv("GPT_POOL_KEEPALIVE", "10"))
+GPT_POOL_KEEPALIVE_EXPIRY = float(os.getenv("GPT_POOL_KEEPALIVE_EXPIRY", "60"))
+# HTTP/2 (нужен пакет h2) и прогрев соединения на старте
+GPT_HTTP2 = os.getenv("GPT_HTTP2", "1") == "1"
+GPT_WARMUP = os.getenv("GPT_WARMUP", "1") == "1"
 
-client = AsyncOpenAI(
-    api_key=API_KEY,
-    http_client=http_client,
-)
+
+class _PoolStats:
+    __slots__ = ("requests", "in_flight", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class _MeteredTransport(httpx.AsyncBaseTransport):
+    """
+    Транспорт-обёртка для статистики пула: сколько запросов в работе и
+    сколько запрос ждал соединения (до первого trace-события httpcore
+    после выдачи соединения из пула).
+    """
+
+    def __init__(self, inner: httpx.AsyncHTTPTransport, stats: _PoolStats):
+        self.inner = inner
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.monotonic()
+        acquired = False
+        parent_trace = request.extensions.get("trace")
+
+        async def trace(event_name: str, info: dict):
+            nonlocal acquired
+            if not acquired and (
+                event_name.startswith("connection.connect_tcp")
+                or event_name.endswith("send_request_headers.started")
+            ):
+                acquired = True
+                waited = time.monotonic() - started
+                self.stats.wait_total += waited
+                self.stats.wait_max = max(self.stats.wait_max, waited)
+            if parent_trace is not None:
+                await parent_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        self.stats.requests += 1
+        self.stats.in_flight += 1
+        try:
+            return await self.inner.handle_async_request(request)
+        finally:
+            self.stats.in_flight -= 1
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+
+pool_stats = _PoolStats()
+http_client: httpx.AsyncClient | None = None
+client: AsyncOpenAI | None = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _build_client() -> AsyncOpenAI:
+    global http_client, client
+    transport = httpx.AsyncHTTPTransport(
+        http2=GPT_HTTP2 and _http2_available(),
+        proxy=PROXY,
+        limits=httpx.Limits(
+            max_connections=GPT_POOL_MAX,
+            max_keepalive_connections=GPT_POOL_KEEPALIVE,
+            keepalive_expiry=GPT_POOL_KEEPALIVE_EXPIRY,
+        ),
+    )
+    http_client = httpx.AsyncClient(transport=_MeteredTransport(transport, pool_stats))
+    client = AsyncOpenAI(
+        api_key=API_KEY,
+        http_client=http_client,
+        # повторы делаем сами (см. _create), чтобы учитывать дедлайн и предохранитель
+        max_retries=0,
+    )
+    return client
+
+
+def _client() -> AsyncOpenAI:
+    return client if client is not None else _build_client()
+
+
+async def init_gpt_client() -> None:
+    """Создаём клиент на старте бота и заранее открываем TLS-соединение."""
+    _build_client()
+    if GPT_WARMUP:
+        try:
+            await client.models.list()
+        except Exception:
+            logger.warning("Прогрев соединения с OpenAI не удался", exc_info=True)
+
+
+def pool_stats_snapshot() -> dict:
+    connections = idle = None
+    try:
+        # внутренности httpcore: приватный API, поэтому без гарантий
+        pool = http_client._transport.inner._pool
+        connections = len(pool.connections)
+        idle = sum(1 for conn in pool.connections if conn.is_idle())
+    except Exception:
+        pass
+    return {
+        "requests": pool_stats.requests,
+        "in_flight": pool_stats.in_flight,
+        "connections": connections,
+        "idle_connections": idle,
+        "avg_wait_ms": pool_stats.wait_total * 1000 / pool_stats.requests if pool_stats.requests else 0.0,
+        "max_wait_ms": pool_stats.wait_max * 1000,
+    }
+
+# Отказ на вопрос не по теме: его пишет модель по INSTRUCTIONS, а локальный фильтр отдаёт сразу
+OFF_TOPIC_TEXT = """Я отвечаю только на вопросы про тренировки, питание и здоровый образ жизни. Например:
+– Как составить план тренировок для набора мышц?
+– Какие продукты богаты белком?
+– Как правильно распределить приёмы пищи в течение дня?"""
 
 INSTRUCTIONS = '''
 Ты — виртуальный фитнес-ассистент. Твоя задача — помогать пользователю с вопросами про:
@@ -38,10 +186,7 @@ INSTRUCTIONS = '''
 
 Если вопрос не по теме — не отвечай напрямую, а вежливо напиши:
 
-«Я отвечаю только на вопросы про тренировки, питание и здоровый образ жизни. Например:
-– Как составить план тренировок для набора мышц?
-– Какие продукты богаты белком?
-– Как правильно распределить приёмы пищи в течение дня?»
+«''' + OFF_TOPIC_TEXT + '''»
 
 Отвечай простым языком, добавляй эмодзи для дружелюбности (по желанию).
 
@@ -50,40 +195,7 @@ INSTRUCTIONS = '''
 Если запрос слишком общий («Составь мне диету»), уточни у пользователя детали: цель (похудение, набор массы, поддержание формы), ограничения, предпочтения.
 '''
 
-async def GPT_text(user_text: str) -> str:
-    try:
-        resp = await client.responses.create(
-            model="gpt-5-nano",
-            reasoning={"effort": "low"},
-            instructions=INSTRUCTIONS,
-            input=user_text,
-        )
-        return (resp.output_text or "").strip()
-    except Exception as e:
-        # Тут можно логировать e, но пользователю отдать мягкую ошибку
-        return "Упс, не получилось сгенерировать ответ. Попробуйте ещё раз."
-
-async def close_gpt_client():
-    await http_client.aclose()
-
-async def GPT_vision(image_path: str, extra_text: str | None = None) -> str:
-    try:
-        async with aiofiles.open(image_path, "rb") as f:
-            raw = await f.read()
-        base64_image = base64.b64encode(raw).decode("utf-8")
-
-        user_hint = "Расчитай по инструкции"
-        if extra_text:
-            user_hint = (
-                "Расчитай по инструкции. "
-                "Если указаны состав/ингредиенты и граммовка, СЧИТАЙ ИХ ПРИОРИТЕТНЫМИ (важнее визуальной оценки). "
-                f"Доп. данные от пользователя:\n{extra_text.strip()}"
-            )
-
-        response = await client.responses.create(
-            model="gpt-5-nano",
-            reasoning={"effort": "low"},
-            instructions='''
+VISION_INSTRUCTIONS = '''
             Ты — эксперт по питанию. Я пришлю фотографию еды, на ней может быть одно или несколько блюд.
 Твоя задача — дать оценку для каждого блюда отдельно, если блюд несколько, а если на фото только одна тарелка 
 с одним основным блюдом (даже если в нём есть гарнир и салат), то оценивай всё это как одно блюдо.
@@ -111,17 +223,761 @@ async def GPT_vision(image_path: str, extra_text: str | None = None) -> str:
 Углеводы (г): XXX 
 
 Всегда указывай все 6 строк для каждого блюда, даже если данные приблизительные.
-        ''',
-            input=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": user_hint},
-                        {"type": "input_image", "image_url": f"data:image/jpeg;base64,{base64_image}"},
-                    ],
-                }
-            ],
-        )
-        return (response.output_text or "").strip()
+        '''
+
+TEXT_ERROR = "Упс, не получилось сгенерировать ответ. Попробуйте ещё раз."
+
+
+# ---------- Планировщик запросов к OpenAI ----------
+# Одновременных запросов к OpenAI и максимальная глубина очереди
+GPT_MAX_CONCURRENT = int(os.getenv("GPT_MAX_CONCURRENT", "8"))
+GPT_MAX_QUEUE = int(os.getenv("GPT_MAX_QUEUE", "200"))
+# Веса полос: сколько запросов полосы обслуживаем за один круг
+LANE_WEIGHTS = {
+    "text": int(os.getenv("GPT_TEXT_WEIGHT", "2")),
+    "vision": int(os.getenv("GPT_VISION_WEIGHT", "1")),
+}
+
+BUSY_TEXT = "Сейчас очень много запросов, попробуйте через минуту 🙏"
+
+
+class SchedulerBusy(Exception):
+    """Очередь к OpenAI переполнена — запрос не принят."""
+
+
+class _Ticket:
+    __slots__ = ("lane", "tg_id", "tag", "future", "cancelled")
+
+    def __init__(self, lane: str, tg_id: int | None, tag: tuple[float, int], future: asyncio.Future):
+        self.lane = lane
+        self.tg_id = tg_id
+        self.tag = tag
+        self.future = future
+        self.cancelled = False
+
+    def __lt__(self, other: "_Ticket") -> bool:
+        return self.tag < other.tag
+
+
+class GPTScheduler:
+    """
+    Ограничивает число одновременных запросов к OpenAI.
+
+    Ожидающие запросы лежат в полосах (text/vision), полосы обслуживаются
+    взвешенным round robin. Внутри полосы — взвешенная справедливая очередь
+    по tg_id: у каждого пользователя своё «виртуальное время», поэтому
+    много запросов от одного человека не отодвигают остальных.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, lane_weights: dict[str, int]):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.lane_weights = lane_weights
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._heaps: dict[str, list[_Ticket]] = {lane: [] for lane in lane_weights}
+        self._vtime: dict[str, float] = {lane: 0.0 for lane in lane_weights}
+        self._user_finish: dict[tuple[str, int | None], float] = {}
+        self._credits = dict(lane_weights)
+        self._seq = itertools.count()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane: str, tg_id: int | None = None):
+        await self._acquire(lane, tg_id)
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._dispatch()
+
+    async def _acquire(self, lane: str, tg_id: int | None) -> None:
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            return
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerBusy()
+
+        key = (lane, tg_id)
+        finish = max(self._vtime[lane], self._user_finish.get(key, 0.0)) + 1.0
+        self._user_finish[key] = finish
+        ticket = _Ticket(lane, tg_id, (finish, next(self._seq)), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heaps[lane], ticket)
+        self.queued += 1
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # слот уже выдали, но ждущий ушёл — возвращаем слот
+                self.active -= 1
+                self._dispatch()
+            else:
+                ticket.cancelled = True
+                self.queued -= 1
+                self._forget_finish(ticket)
+            raise
+
+    def _forget_finish(self, ticket: _Ticket) -> None:
+        # отменённая заявка не должна ни сдвигать очередь пользователя, ни копиться в словаре
+        key = (ticket.lane, ticket.tg_id)
+        if self._user_finish.get(key) != ticket.tag[0]:
+            return
+        rest = [t.tag[0] for t in self._heaps[ticket.lane] if t.tg_id == ticket.tg_id and not t.cancelled]
+        if rest:
+            self._user_finish[key] = max(rest)
+        else:
+            del self._user_finish[key]
+
+    def _next_lane(self) -> str | None:
+        pending = [lane for lane, heap in self._heaps.items() if heap]
+        if not pending:
+            return None
+        if not any(self._credits[lane] > 0 for lane in pending):
+            self._credits = dict(self.lane_weights)
+        for lane in pending:
+            if self._credits[lane] > 0:
+                self._credits[lane] -= 1
+                return lane
+        return pending[0]
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrent:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            ticket = heapq.heappop(self._heaps[lane])
+            if ticket.cancelled:
+                continue
+            self.queued -= 1
+            self._vtime[lane] = ticket.tag[0]
+            key = (lane, ticket.tg_id)
+            if self._user_finish.get(key) == ticket.tag[0]:
+                del self._user_finish[key]
+            self.active += 1
+            ticket.future.set_result(None)
+
+    def queue_position(self, tg_id: int) -> int | None:
+        """Место пользователя в очереди (1 — следующий), None — не ждёт."""
+        best = None
+        for heap in self._heaps.values():
+            for ticket in heap:
+                if ticket.tg_id != tg_id or ticket.cancelled:
+                    continue
+                ahead = sum(1 for other in heap if not other.cancelled and other.tag < ticket.tag)
+                if best is None or ahead < best:
+                    best = ahead
+        return None if best is None else best + 1
+
+    def stats(self) -> dict:
+        return {"active": self.active, "queued": self.queued, "rejected": self.rejected}
+
+    async def drain(self, lane: str, tg_id: int | None, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        Читаем поток OpenAI в слоте отдельной задачей, наружу отдаём последний
+        накопленный текст: слот освобождается, как только поток прочитан, а не
+        когда Telegram примет все правки.
+        """
+        latest = ""
+        changed = asyncio.Event()
+
+        async def pump() -> None:
+            nonlocal latest
+            async with self.slot(lane, tg_id), contextlib.aclosing(chunks):
+                async for latest in chunks:
+                    changed.set()
+
+        task = asyncio.ensure_future(pump())
+        try:
+            while True:
+                waiter = asyncio.ensure_future(changed.wait())
+                await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if changed.is_set():
+                    changed.clear()
+                    yield latest
+                elif task.done():
+                    task.result()
+                    return
+        finally:
+            task.cancel()
+
+
+scheduler = GPTScheduler(GPT_MAX_CONCURRENT, GPT_MAX_QUEUE, LANE_WEIGHTS)
+
+
+# ---------- Склейка одинаковых запросов (single-flight) ----------
+class _LeaderGone(Exception):
+    """Потоковый запрос-лидер прервался, не дойдя до конца."""
+
+
+class SingleFlight:
+    """
+    Одновременные одинаковые запросы ждут один общий результат.
+    Сам запрос идёт отдельной задачей, а ждущие смотрят на неё через shield,
+    поэтому отмена у одного пользователя не отменяет ответ остальным.
+    """
+
+    def __init__(self):
+        self._calls: dict[tuple, asyncio.Future] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def _forget(self, key: tuple, fut: asyncio.Future) -> None:
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+
+    async def do(self, key: tuple, factory: Callable[[], Awaitable[str]]) -> str:
+        fut = self._calls.get(key)
+        if fut is None:
+            self.leaders += 1
+            fut = asyncio.ensure_future(factory())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+        return await asyncio.shield(fut)
+
+    async def stream(self, key: tuple, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        # ведомые получают только итоговый текст; если лидер оборвался — идут сами
+        fut = self._calls.get(key)
+        if fut is not None:
+            try:
+                self.shared += 1
+                yield await asyncio.shield(fut)
+                return
+            except _LeaderGone:
+                pass
+        self.leaders += 1
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._calls[key] = fut
+        text, completed = "", False
+        try:
+            async for text in factory():
+                yield text
+            completed = True
+        finally:
+            self._forget(key, fut)
+            if completed:
+                fut.set_result(text)
+            else:
+                fut.set_exception(_LeaderGone())
+
+    def stats(self) -> dict:
+        return {"leaders": self.leaders, "shared": self.shared, "in_flight": len(self._calls)}
+
+
+flights = SingleFlight()
+
+
+# ---------- Устойчивость: дедлайны, повторы, хеджирование, предохранитель ----------
+# Дедлайн одного вызова OpenAI, сек
+GPT_TIMEOUTS = {
+    "text": float(os.getenv("GPT_TEXT_TIMEOUT", "60")),
+    "vision": float(os.getenv("GPT_VISION_TIMEOUT", "90")),
+}
+# Повторы на 429/5xx/сетевых ошибках: кол-во и экспоненциальная пауза с джиттером
+GPT_MAX_RETRIES = int(os.getenv("GPT_MAX_RETRIES", "2"))
+GPT_BACKOFF_BASE = float(os.getenv("GPT_BACKOFF_BASE", "0.5"))
+GPT_BACKOFF_MAX = float(os.getenv("GPT_BACKOFF_MAX", "8"))
+# Хеджирование: второй запрос, если первый дольше p95 (1 — включено)
+GPT_HEDGE = os.getenv("GPT_HEDGE", "0") == "1"
+GPT_HEDGE_MIN_SAMPLES = int(os.getenv("GPT_HEDGE_MIN_SAMPLES", "20"))
+# Предохранитель: сколько ошибок подряд размыкают цепь и на сколько секунд
+GPT_BREAKER_THRESHOLD = int(os.getenv("GPT_BREAKER_THRESHOLD", "5"))
+GPT_BREAKER_COOLDOWN = float(os.getenv("GPT_BREAKER_COOLDOWN", "30"))
+
+DEGRADED_TEXT = "Ассистент временно недоступен, попробуйте через пару минут 🙏"
+
+_RETRYABLE_STATUS = {408, 409, 429}
+
+
+class CircuitOpen(Exception):
+    """OpenAI сейчас считается недоступным — отвечаем сразу, без запроса."""
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trips = 0
+        self._probe = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def check(self) -> bool:
+        """Пропускаем запрос или бросаем CircuitOpen; True — этот запрос пробный."""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probe):
+            raise CircuitOpen()
+        if state == "half_open":
+            # пропускаем один пробный запрос
+            self._probe = True
+            return True
+        return False
+
+    def release_probe(self) -> None:
+        # пробный запрос отменили, не дождавшись исхода: следующий сможет попробовать снова
+        self._probe = False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._probe = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probe = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+
+class LatencyWindow:
+    def __init__(self, size: int = 200):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def p95(self) -> float | None:
+        if len(self._samples) < GPT_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+breaker = CircuitBreaker(GPT_BREAKER_THRESHOLD, GPT_BREAKER_COOLDOWN)
+latencies = {lane: LatencyWindow() for lane in GPT_TIMEOUTS}
+resilience_counters = {"retries": 0, "timeouts": 0, "hedges": 0, "hedge_wins": 0, "breaker_rejects": 0}
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, (TimeoutError, APIConnectionError, RateLimitError, InternalServerError)):
+        return True
+    return isinstance(e, APIStatusError) and (e.status_code in _RETRYABLE_STATUS or e.status_code >= 500)
+
+
+def _backoff(attempt: int) -> float:
+    # «full jitter»: случайная пауза от 0 до base * 2^attempt
+    return random.uniform(0, min(GPT_BACKOFF_MAX, GPT_BACKOFF_BASE * 2 ** attempt))
+
+
+_closing: set[asyncio.Task] = set()
+
+
+def _close_loser(task: asyncio.Future) -> None:
+    # проигравший запрос всё же получил ответ: поток (stream=True) держит HTTP-соединение — закрываем
+    if task.cancelled() or task.exception() is not None:
+        return
+    close = getattr(task.result(), "close", None)
+    if close is None:
+        return
+    closing = asyncio.ensure_future(close())
+    _closing.add(closing)
+    closing.add_done_callback(lambda t: (_closing.discard(t), t.cancelled() or t.exception()))
+
+
+async def _hedged_create(lane: str, request: dict):
+    p95 = latencies[lane].p95() if GPT_HEDGE else None
+    if p95 is None:
+        return await _client().responses.create(**request)
+    # хедж идёт в том же слоте планировщика: это редкий лишний запрос на хвосте
+    first = asyncio.ensure_future(_client().responses.create(**request))
+    done, _ = await asyncio.wait({first}, timeout=p95)
+    if done:
+        return first.result()
+    resilience_counters["hedges"] += 1
+    hedge = asyncio.ensure_future(_client().responses.create(**request))
+    pending = {first, hedge}
+    winner = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        resilience_counters["hedge_wins"] += 1
+                    winner = task
+                    return task.result()
+        # оба запроса упали — отдаём ошибку первого
+        return first.result()
+    finally:
+        for task in (first, hedge):
+            if task is not winner:
+                task.cancel()
+                task.add_done_callback(_close_loser)
+
+
+async def _create(lane: str, request: dict, tg_id: int | None = None):
+    """Вызов OpenAI с дедлайном, повторами, хеджированием и предохранителем."""
+    try:
+        probe = breaker.check()
+    except CircuitOpen:
+        resilience_counters["breaker_rejects"] += 1
+        raise
+    try:
+        return await _attempts(lane, request, tg_id)
+    finally:
+        # успех и ошибка уже сняли пробу; здесь — отмена (дедлайн ответа, остановка)
+        if probe:
+            breaker.release_probe()
+
+
+async def _attempts(lane: str, request: dict, tg_id: int | None):
+    for attempt in range(GPT_MAX_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            async with asyncio.timeout(GPT_TIMEOUTS[lane]):
+                response = await _hedged_create(lane, request)
+        except Exception as e:
+            observe_openai(lane, time.monotonic() - started, "timeout" if isinstance(e, TimeoutError) else "error")
+            if isinstance(e, TimeoutError):
+                resilience_counters["timeouts"] += 1
+            if not _retryable(e):
+                # upstream ответил (например, 400) — это не повод размыкать цепь
+                breaker.success()
+                raise
+            if attempt == GPT_MAX_RETRIES:
+                breaker.failure()
+                raise
+            resilience_counters["retries"] += 1
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        # для потока это время до ответа сервера, токены считаются в _stream_output
+        observe_openai(lane, time.monotonic() - started, "ok")
+        if not request.get("stream"):
+            _record_usage(lane, request, response, time.monotonic() - started, tg_id)
+        latencies[lane].add(time.monotonic() - started)
+        breaker.success()
+        return response
+
+
+def _record_usage(lane: str, request: dict, response, seconds: float, tg_id: int | None) -> None:
+    usage = getattr(response, "usage", None)
+    observe_tokens(lane, usage)
+    usage_recorder.record(tg_id, lane, getattr(response, "model", None) or request["model"], usage, seconds)
+
+
+def resilience_stats() -> dict:
+    return {**resilience_counters, "breaker_state": breaker.state, "breaker_trips": breaker.trips}
+
+
+# Кэш префикса у OpenAI: запросы начинаются с одинаковых байтов (инструкции, затем
+# неизменная часть подсказки), а всё, что меняется от вызова к вызову, идёт в конце.
+# prompt_cache_key направляет запросы одной полосы на одни и те же серверы кэша.
+PROMPT_CACHE_KEYS = {"text": "fitbot-text-v1", "vision": "fitbot-vision-v1"}
+VISION_HINT = "Расчитай по инструкции"
+VISION_EXTRA_HINT = (
+    "Если указаны состав/ингредиенты и граммовка, СЧИТАЙ ИХ ПРИОРИТЕТНЫМИ (важнее визуальной оценки). "
+    "Доп. данные от пользователя:\n"
+)
+
+
+def _text_request(user_text: str, previous_response_id: str | None = None, history: list[dict] | None = None) -> dict:
+    request = dict(
+        model="gpt-5-nano",
+        reasoning={"effort": "low"},
+        instructions=INSTRUCTIONS,
+        prompt_cache_key=PROMPT_CACHE_KEYS["text"],
+        input=[*history, {"role": "user", "content": user_text}] if history else user_text,
+    )
+    if previous_response_id:
+        # история лежит на стороне OpenAI, заново её не отправляем
+        request["previous_response_id"] = previous_response_id
+    return request
+
+
+def _vision_request(image: bytes | memoryview, extra_text: str | None) -> dict:
+    base64_image = base64.b64encode(image).decode("ascii")
+
+    content = [
+        {"type": "input_text", "text": VISION_HINT},
+        {"type": "input_image", "image_url": f"data:image/jpeg;base64,{base64_image}"},
+    ]
+    if extra_text:
+        # уточнения пользователя — после фото, чтобы не ломать общий префикс
+        content.append({"type": "input_text", "text": VISION_EXTRA_HINT + extra_text.strip()})
+
+    return dict(
+        model="gpt-5-nano",
+        reasoning={"effort": "low"},
+        instructions=VISION_INSTRUCTIONS,
+        prompt_cache_key=PROMPT_CACHE_KEYS["vision"],
+        input=[{"role": "user", "content": content}],
+    )
+
+
+async def _stream_output(
+    lane: str, request: dict, meta: dict | None = None, tg_id: int | None = None
+) -> AsyncIterator[str]:
+    # отдаём накопленный текст по мере прихода дельт из Responses streaming API;
+    # повторы возможны только до первого события, дальше — общий дедлайн;
+    # в meta кладём id ответа (нужен для previous_response_id)
+    started = time.monotonic()
+    deadline = started + GPT_TIMEOUTS[lane]
+    stream = await _create(lane, {**request, "stream": True}, tg_id)
+    events = stream.__aiter__()
+    text = ""
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            event = await asyncio.wait_for(events.__anext__(), timeout=max(remaining, 0))
+        except StopAsyncIteration:
+            return
+        except TimeoutError:
+            resilience_counters["timeouts"] += 1
+            raise
+        if event.type == "response.output_text.delta":
+            text += event.delta
+            yield text
+        elif event.type == "response.completed":
+            _record_usage(lane, request, event.response, time.monotonic() - started, tg_id)
+            if meta is not None:
+                meta["response_id"] = event.response.id
+
+
+async def GPT_text(user_text: str, tg_id: int | None = None) -> str:
+    # продолжение диалога зависит от контекста пользователя — мимо кэша и общих запросов
+    if conversations.active(tg_id):
+        return await _generate_text(user_text, tg_id, dialog=True)
+    # явно не по теме — отказ без запроса в модель (в диалоге не проверяем: уточнения вроде
+    # «а сколько раз?» без контекста фильтру не понять)
+    if topic_filter.is_off_topic(user_text):
+        return OFF_TOPIC_TEXT
+    # частые вопросы отдаём из кэша, личные (с цифрами, «мне», «мой»…) — всегда в модель
+    result = await text_cache.get(user_text)
+    if result:
+        _remember_turn(tg_id, user_text, result)
+        return result
+    led = False
+
+    def lead():
+        # свой запрос сам запомнит реплику вместе с id ответа — цепочка начнётся со второго вопроса
+        nonlocal led
+        led = True
+        return _generate_text(user_text, tg_id)
+
+    # одинаковые вопросы, пришедшие одновременно, ждут один общий запрос
+    result = await flights.do(_text_key(user_text), lead)
+    if not led:
+        # чужой ответ: на него нельзя сослаться через previous_response_id
+        _remember_turn(tg_id, user_text, result)
+    return result
+
+
+def _chain_lost(e: Exception, previous_response_id: str | None) -> bool:
+    # ответ, на который ссылаемся, истёк или удалён на стороне OpenAI
+    return previous_response_id is not None and isinstance(e, APIStatusError) and e.status_code in (400, 404)
+
+
+def _remember_turn(tg_id: int | None, question: str, answer: str, response_id: str | None = None) -> None:
+    if tg_id is None or not answer or answer in (BUSY_TEXT, DEGRADED_TEXT, TEXT_ERROR):
+        return
+    conversations.record(tg_id, question, answer, response_id)
+
+
+async def _generate_text(user_text: str, tg_id: int | None, dialog: bool = False) -> str:
+    previous_id, history = conversations.context(tg_id) if dialog else (None, None)
+    try:
+        async with scheduler.slot("text", tg_id):
+            try:
+                resp = await _create("text", _text_request(user_text, previous_id, history), tg_id)
+            except APIStatusError as e:
+                if not _chain_lost(e, previous_id):
+                    raise
+                conversations.forget_chain(tg_id)
+                _, history = conversations.context(tg_id)
+                resp = await _create("text", _text_request(user_text, None, history), tg_id)
+        result = (resp.output_text or "").strip()
+    except SchedulerBusy:
+        return BUSY_TEXT
+    except CircuitOpen:
+        return DEGRADED_TEXT
     except Exception as e:
-        return f"Ошибка обработки изображения: {e}"
\ No newline at end of file
+        # Тут можно логировать e, но пользователю отдать мягкую ошибку
+        return TEXT_ERROR
+    _remember_turn(tg_id, user_text, result, resp.id)
+    if not dialog:
+        await _cache_text(user_text, result)
+    return result
+
+
+async def GPT_text_stream(user_text: str, tg_id: int | None = None) -> AsyncIterator[str]:
+    """Как GPT_text, но отдаёт ответ частями (каждый раз — весь текст на данный момент)."""
+    if conversations.active(tg_id):
+        async for text in _stream_text(user_text, tg_id, dialog=True):
+            yield text
+        return
+    if topic_filter.is_off_topic(user_text):
+        yield OFF_TOPIC_TEXT
+        return
+    cached = await text_cache.get(user_text)
+    if cached:
+        _remember_turn(tg_id, user_text, cached)
+        yield cached
+        return
+    led = False
+
+    def lead():
+        nonlocal led
+        led = True
+        return _stream_text(user_text, tg_id)
+
+    text = ""
+    async for text in flights.stream(_text_key(user_text), lead):
+        yield text
+    if not led:
+        _remember_turn(tg_id, user_text, text)
+
+
+async def _stream_text(user_text: str, tg_id: int | None, dialog: bool = False) -> AsyncIterator[str]:
+    previous_id, history = conversations.context(tg_id) if dialog else (None, None)
+    meta: dict = {}
+
+    async def chunks() -> AsyncIterator[str]:
+        text = ""
+        try:
+            async for text in _stream_output("text", _text_request(user_text, previous_id, history), meta, tg_id):
+                yield text
+        except APIStatusError as e:
+            # повторяем с историей, только если пользователь ещё ничего не увидел
+            if text or not _chain_lost(e, previous_id):
+                raise
+            conversations.forget_chain(tg_id)
+            _, fresh = conversations.context(tg_id)
+            async for text in _stream_output("text", _text_request(user_text, None, fresh), meta, tg_id):
+                yield text
+
+    text = ""
+    try:
+        async for text in scheduler.drain("text", tg_id, chunks()):
+            yield text
+    except SchedulerBusy:
+        yield BUSY_TEXT
+        return
+    except CircuitOpen:
+        yield DEGRADED_TEXT
+        return
+    except Exception:
+        logger.exception("Ошибка потоковой генерации ответа")
+        yield TEXT_ERROR
+        return
+    result = text.strip()
+    _remember_turn(tg_id, user_text, result, meta.get("response_id"))
+    if not dialog:
+        await _cache_text(user_text, result)
+    yield result
+
+
+def _text_key(user_text: str) -> tuple:
+    return ("text", normalize_question(user_text))
+
+
+async def _cache_text(user_text: str, result: str) -> None:
+    if not result:
+        return
+    try:
+        await text_cache.put(user_text, result)
+    except Exception:
+        logger.exception("Не удалось сохранить ответ в кэш вопросов")
+
+
+async def close_gpt_client():
+    global http_client, client
+    if http_client is not None:
+        await http_client.aclose()
+    http_client = client = None
+
+
+async def GPT_vision(image: bytes | memoryview, extra_text: str | None = None, tg_id: int | None = None) -> str:
+    # повторные/почти одинаковые фото отдаём из кэша по перцептивному хэшу
+    digest = await image_dhash(image)
+    if digest is not None:
+        cached = await vision_cache.get(digest, extra_text)
+        if cached:
+            return cached
+    return await flights.do(
+        _vision_key(image, digest, extra_text),
+        lambda: _generate_vision(image, digest, extra_text, tg_id),
+    )
+
+
+async def _generate_vision(
+    image: bytes | memoryview, digest: int | None, extra_text: str | None, tg_id: int | None
+) -> str:
+    try:
+        async with scheduler.slot("vision", tg_id):
+            response = await _create("vision", _vision_request(image, extra_text), tg_id)
+        result = (response.output_text or "").strip()
+    except SchedulerBusy:
+        return BUSY_TEXT
+    except CircuitOpen:
+        return DEGRADED_TEXT
+    except Exception as e:
+        return f"Ошибка обработки изображения: {e}"
+    await _cache_vision(digest, extra_text, result)
+    return result
+
+
+async def GPT_vision_stream(
+    image: bytes | memoryview, extra_text: str | None = None, tg_id: int | None = None
+) -> AsyncIterator[str]:
+    """Как GPT_vision, но отдаёт ответ частями."""
+    digest = await image_dhash(image)
+    if digest is not None:
+        cached = await vision_cache.get(digest, extra_text)
+        if cached:
+            yield cached
+            return
+    key = _vision_key(image, digest, extra_text)
+    async for text in flights.stream(key, lambda: _stream_vision(image, digest, extra_text, tg_id)):
+        yield text
+
+
+async def _stream_vision(
+    image: bytes | memoryview, digest: int | None, extra_text: str | None, tg_id: int | None
+) -> AsyncIterator[str]:
+    text = ""
+    try:
+        chunks = _stream_output("vision", _vision_request(image, extra_text), tg_id=tg_id)
+        async for text in scheduler.drain("vision", tg_id, chunks):
+            yield text
+    except SchedulerBusy:
+        yield BUSY_TEXT
+        return
+    except CircuitOpen:
+        yield DEGRADED_TEXT
+        return
+    except Exception as e:
+        yield f"Ошибка обработки изображения: {e}"
+        return
+    result = text.strip()
+    await _cache_vision(digest, extra_text, result)
+    yield result
+
+
+def _vision_key(image: bytes | memoryview, digest: int | None, extra_text: str | None) -> tuple:
+    # точный ключ: dHash (или хэш байтов, если dHash недоступен) + уточнения
+    image_key = digest if digest is not None else hashlib.blake2b(image, digest_size=16).hexdigest()
+    return ("vision", image_key, normalize_extra(extra_text))
+
+
+async def _cache_vision(digest: int | None, extra_text: str | None, result: str) -> None:
+    # ошибки в кэш не кладём
+    if digest is None or not result:
+        return
+    try:
+        await vision_cache.put(digest, extra_text, result)
+    except Exception:
+        logger.exception("Не удалось сохранить ответ в кэш фото")
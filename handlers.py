@@ -5,24 +5,27 @@ from aiogram.filters import CommandStart, Command
 from aiogram.enums import ChatAction
 import os
 from aiogram.fsm.context import FSMContext
-import uuid
-import contextlib
 from aiogram.types import LabeledPrice, PreCheckoutQuery
 from aiogram.enums import ContentType
 from states import Chat, Images
 import keyboards as kb
-from generategpt import GPT_text, GPT_vision
+from generategpt import scheduler
+from jobqueue import job_queue
+from photos import photo_store, download_photo
+from conversation import conversations
+from imageprep import pick_photo_size, prepare_image
 from datetime import datetime
 from db import (
     AsyncSessionLocal, get_or_create_user,
     ensure_access_with_wallet_daily, get_balance, credit_balance,
-    is_subscription_active,
     reward_referrer_on_first_paid,
-    ensure_access_with_wallet_daily,
+    get_access_snapshot, snapshot_sub_active, daily_price_rub,
     DAILY_PRICE_KOP, MONTH_PRICE_RUB, set_inviter_if_first)
 
 router = Router()
 
+PHOTO_EXPIRED = "Фото устарело, отправь его ещё раз."
+
 async def push_state(state: FSMContext, new_state):
     # Сохраняем текущий state в стек, затем переключаемся в новый
     cur = await state.get_state()
@@ -47,27 +50,39 @@ async def pop_state(state: FSMContext):
 
 @router.message(Images.photo, F.photo)
 async def photo_received(message: Message, state: FSMContext):
-    # сохраняем фото во временный файл и кладём путь в FSM
-    file_name = f"{uuid.uuid4()}.jpg"
-    await message.bot.download(message.photo[-1], destination=file_name)
-    await state.update_data(photo_path=file_name)
+    # скачиваем фото в память и кладём ключ в FSM (без временных файлов)
+    raw = await download_photo(message.bot, pick_photo_size(message.photo))
+    if raw is None:
+        await message.answer("Фото слишком большое, отправь другое.", reply_markup=kb.back_main)
+        return
+    raw = await prepare_image(raw)
+    data = await state.get_data()
+    await photo_store.discard(data.get("photo_key"))
+    await state.update_data(photo_key=await photo_store.put(raw))
 
     # спрашиваем про доп.данные
     await state.set_state(Images.meta)
     await message.answer(
         "Можешь уточнить состав и граммовку или нажми «Пропустить».", reply_markup=kb.photo_extra)
 
+def _queue_note(tg_id: int) -> str:
+    pos = scheduler.queue_position(tg_id)
+    return f"\nВы №{pos} в очереди." if pos else ""
+
 @router.message(Images.wait)
 async def wait_wait(message: Message):
-    await message.answer('Ваше изображение обрабатывается, подождите...')
+    await message.answer('Ваше изображение обрабатывается, подождите...' + _queue_note(message.from_user.id))
 
 @router.message(Chat.wait)
 async def wait_wait(message: Message):
-    await message.answer('Ваше сообщение генерируется, подождите...')
+    await message.answer('Ваше сообщение генерируется, подождите...' + _queue_note(message.from_user.id))
 
 @router.callback_query(F.data == 'back')
 async def back(callback: CallbackQuery, state: FSMContext):
-    # чистим состояния, чтобы не застрять
+    # освобождаем фото, если пользователь бросил сценарий, чистим состояния и диалог с ассистентом
+    data = await state.get_data()
+    await photo_store.discard(data.get("photo_key"))
+    conversations.reset(callback.from_user.id)
     await state.clear()
     # возвращаем пользователя в экран "Пользоваться ботом"
     await callback.message.edit_text(
@@ -115,53 +130,62 @@ async def support(cb: CallbackQuery):
 async def chat_response(message: Message, state: FSMContext):
     await message.bot.send_chat_action(chat_id=message.from_user.id, action=ChatAction.TYPING)
     await state.set_state(Chat.wait)
-    resp = await GPT_text(message.text)
-    await message.answer(resp, reply_markup=kb.inline_main)
-    await state.clear()
+    # ответ генерирует очередь задач: правит заглушку и снимает Chat.wait (см. jobqueue.py)
+    placeholder = await message.answer("✍️ Печатаю ответ…")
+    try:
+        await job_queue.enqueue_text(message.from_user.id, placeholder, message.text)
+    except Exception:
+        # задача не встала — не оставляем пользователя в ожидании
+        await state.clear()
+        raise
 
 
 @router.callback_query(F.data == 'skip_photo_meta')
 async def skip_photo_meta(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    file_name = data.get("photo_path")
+    image = await photo_store.pop(data.get("photo_key"))
+    if image is None:
+        await state.set_state(Images.photo)
+        await cb.message.edit_text(PHOTO_EXPIRED, reply_markup=kb.back_main)
+        return
     await cb.message.bot.send_chat_action(chat_id=cb.from_user.id, action=ChatAction.TYPING)
     await cb.message.edit_text("Обрабатываю фото… ⏳")
+    await state.set_state(Images.wait)
     try:
-        await state.set_state(Images.wait)
-        resp = await GPT_vision(file_name, extra_text=None)
-        await cb.message.edit_text(resp, reply_markup=kb.inline_main)
-    finally:
-        with contextlib.suppress(Exception):
-            os.remove(file_name)
+        await job_queue.enqueue_vision(cb.from_user.id, cb.message, image, extra_text=None)
+    except Exception:
+        # задача не встала — не оставляем пользователя в ожидании
         await state.clear()
+        raise
 
 @router.message(Images.meta, F.text)
 async def photo_with_meta(message: Message, state: FSMContext):
     data = await state.get_data()
-    file_name = data.get("photo_path")
+    image = await photo_store.pop(data.get("photo_key"))
+    if image is None:
+        await state.set_state(Images.photo)
+        await message.answer(PHOTO_EXPIRED, reply_markup=kb.back_main)
+        return
     user_extra = message.text.strip()
     await message.bot.send_chat_action(chat_id=message.from_user.id, action=ChatAction.TYPING)
 
     status_msg = await message.answer("Обрабатываю фото с учётом твоих данных… ⏳")
+    await state.set_state(Images.wait)
     try:
-        await state.set_state(Images.wait)
-        resp = await GPT_vision(file_name, extra_text=user_extra)
-        await status_msg.edit_text(resp, reply_markup=kb.inline_main)
-    finally:
-        with contextlib.suppress(Exception):
-            os.remove(file_name)
+        await job_queue.enqueue_vision(message.from_user.id, status_msg, image, extra_text=user_extra)
+    except Exception:
+        # задача не встала — не оставляем пользователя в ожидании
         await state.clear()
+        raise
 
 
 async def _status_line(tg_id: int) -> str:
     today = datetime.utcnow().strftime("%Y-%m-%d")
-    async with AsyncSessionLocal() as session:
-        user = await get_or_create_user(session, tg_id)
-        paid_today = (user.last_charge_date == today)
-        sub_active = await is_subscription_active(session, tg_id)
-        bal = await get_balance(session, tg_id)
-    need_rub = (DAILY_PRICE_KOP + 99) // 100  # 3 ₽ при DAILY_PRICE_KOP=300
-    allowed = sub_active or paid_today or (bal >= need_rub)
+    snap = await get_access_snapshot(tg_id)
+    paid_today = (snap["last_charge_date"] == today)
+    sub_active = snapshot_sub_active(snap)
+    need_rub = daily_price_rub()  # 3 ₽ при DAILY_PRICE_KOP=300
+    allowed = sub_active or paid_today or (snap["balance_rub"] >= need_rub)
     return "🟢 Доступ: оплачен" if allowed else "🔴 Доступ не оплачен"
 
 @router.callback_query(F.data == 'menu')
@@ -229,7 +253,9 @@ async def successful_payment_handler(message: Message):
     if payload.startswith("topup_"):
         async with AsyncSessionLocal() as session:
             # зачисляем пользователю
-            new_balance = await credit_balance(session, tg_id, total_rub)
+            new_balance = await credit_balance(
+                session, tg_id, total_rub, charge_id=sp.telegram_payment_charge_id
+            )
             # раздаём реферал-бонус пригласившему (однократно — логика внутри)
             await reward_referrer_on_first_paid(session, invitee_tg=tg_id)
 
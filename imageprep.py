@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Optional
+
+from aiogram.types import PhotoSize
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен — отправляем фото как есть
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Минимальная меньшая сторона фото, которой хватает для оценки КБЖУ
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "512"))
+
+# Пережатие: длинная сторона и качество JPEG (0 — не пережимать)
+PHOTO_TARGET_EDGE = int(os.getenv("PHOTO_TARGET_EDGE", "1024"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "80"))
+
+# Кол-во процессов для пережатия
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+prep_counters = {"images": 0, "errors": 0, "kept_original": 0, "bytes_in": 0, "bytes_out": 0,
+                 "seconds_total": 0.0, "seconds_max": 0.0}
+
+
+def pick_photo_size(sizes: list[PhotoSize]) -> PhotoSize:
+    """Самый маленький PhotoSize, у которого меньшая сторона не ниже PHOTO_MIN_SIDE."""
+    for size in sorted(sizes, key=lambda s: s.width * s.height):
+        if min(size.width, size.height) >= PHOTO_MIN_SIDE:
+            return size
+    return sizes[-1]
+
+
+def _resize_jpeg(data: bytes, target_edge: int, quality: int) -> bytes:
+    # выполняется в отдельном процессе, поэтому только модульная функция
+    with Image.open(BytesIO(data)) as img:
+        img = img.convert("RGB")
+        img.thumbnail((target_edge, target_edge), Image.LANCZOS)
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+def _dhash(data: bytes) -> int:
+    # 64-битный difference hash: сравниваем соседние пиксели уменьшенного ч/б кадра 9x8
+    with Image.open(BytesIO(data)) as img:
+        img.draft("L", (64, 64))
+        pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, как и у воркеров: fork многопоточного процесса с event loop небезопасен
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def prepare_image(data: bytes) -> bytes:
+    """Уменьшаем и пережимаем фото перед отправкой в модель, не блокируя event loop."""
+    if Image is None or PHOTO_TARGET_EDGE <= 0:
+        return data
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(
+            _get_pool(), _resize_jpeg, data, PHOTO_TARGET_EDGE, PHOTO_JPEG_QUALITY
+        )
+    except Exception:
+        logger.exception("Не удалось пережать фото, отправляем оригинал")
+        prep_counters["errors"] += 1
+        return data
+    if len(result) >= len(data):
+        result = data
+        prep_counters["kept_original"] += 1
+    elapsed = time.perf_counter() - started
+    prep_counters["images"] += 1
+    prep_counters["bytes_in"] += len(data)
+    prep_counters["bytes_out"] += len(result)
+    prep_counters["seconds_total"] += elapsed
+    prep_counters["seconds_max"] = max(prep_counters["seconds_max"], elapsed)
+    logger.info(
+        "prepare_image: %d -> %d байт (сэкономлено %d), %.1f мс",
+        len(data), len(result), len(data) - len(result), elapsed * 1000,
+    )
+    return result
+
+
+def image_prep_stats() -> dict:
+    images = prep_counters["images"]
+    return {
+        "images": images,
+        "errors": prep_counters["errors"],
+        "kept_original": prep_counters["kept_original"],
+        "bytes_in": prep_counters["bytes_in"],
+        "bytes_out": prep_counters["bytes_out"],
+        "bytes_saved": prep_counters["bytes_in"] - prep_counters["bytes_out"],
+        "avg_ms": prep_counters["seconds_total"] * 1000 / images if images else 0.0,
+        "max_ms": prep_counters["seconds_max"] * 1000,
+    }
+
+
+async def image_dhash(data: bytes) -> Optional[int]:
+    """Перцептивный хэш фото (dHash). None — если Pillow нет или фото не читается."""
+    if Image is None:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_pool(), _dhash, bytes(data))
+    except Exception:
+        logger.exception("Не удалось посчитать хэш фото")
+        return None
+
+
+def shutdown_image_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,361 @@
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.types import Chat as TgChat, Message
+from sqlalchemy import and_, delete, func, or_, select, update
+
+import keyboards as kb
+from db import AsyncSessionLocal, Job
+from generategpt import GPT_text, GPT_text_stream, GPT_vision, GPT_vision_stream
+from states import Chat, Images
+from streaming import STREAM_REPLIES, stream_to_message
+
+logger = logging.getLogger(__name__)
+
+# Сколько задач генерации процесс выполняет одновременно (OpenAI дополнительно
+# ограничивает планировщик generategpt — воркеров должно быть не меньше GPT_MAX_CONCURRENT)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "32"))
+# Аренда задачи, сек: продлевается, пока воркер жив; истекла — задачу берёт другой
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+# Попыток на задачу, пауза перед повтором и как часто смотреть в таблицу без сигнала
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+# Сколько дней хранить завершённые задачи
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "3"))
+
+ENQUEUED, LEASED, DONE, FAILED = "enqueued", "leased", "done", "failed"
+
+JOB_FAILED_TEXT = "Не получилось обработать запрос, попробуйте ещё раз."
+
+# состояния ожидания, которые снимаем после доставки результата
+_WAIT_STATES = {Chat.wait.state, Images.wait.state}
+
+
+class JobQueue:
+    """
+    Очередь генерации в таблице jobs (та же БД, что и у db.py). Хендлер
+    отправляет сообщение-статус и ставит задачу; воркеры арендуют задачи
+    (lease_until — тайм-аут видимости), генерируют ответ, правят им статус
+    и снимают с пользователя состояние ожидания.
+
+    Задача, брошенная на полпути (деплой, падение), возвращается в очередь:
+    при остановке аренды отпускаются сразу, после падения — на старте
+    (свой шард) или по истечении аренды. Доставка «хотя бы раз»: повтор
+    после падения заново правит то же сообщение.
+    """
+
+    def __init__(self, workers: int, lease: float, max_attempts: int):
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # (индекс, всего) в режиме --workers: процесс берёт только задачи своих пользователей
+        self.shard: Optional[tuple[int, int]] = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.enqueued = 0
+        self.started = 0
+        self.done = 0
+        self.failed = 0
+        self.retried = 0
+        self.recovered = 0
+        self.lost = 0
+        self.busy = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._bot: Optional[Bot] = None
+        self._storage: Optional[BaseStorage] = None
+        self._tasks: list[asyncio.Task] = []
+        self._claim_lock = asyncio.Lock()
+        # по разрешению на каждую поставленную задачу: будит одного воркера, а не всех
+        self._signal = asyncio.Semaphore(0)
+        self._polled_empty = 0.0
+
+    # ---------- постановка ----------
+    async def enqueue_text(self, tg_id: int, status: Message, question: str) -> int:
+        return await self._enqueue("text", tg_id, status, question, None)
+
+    async def enqueue_vision(self, tg_id: int, status: Message, image: bytes, extra_text: Optional[str]) -> int:
+        return await self._enqueue("vision", tg_id, status, extra_text, bytes(image))
+
+    async def _enqueue(self, kind: str, tg_id: int, status: Message, text: Optional[str],
+                       image: Optional[bytes]) -> int:
+        job = Job(kind=kind, status=ENQUEUED, tg_id=tg_id, chat_id=status.chat.id,
+                  message_id=status.message_id, text=text, image=image)
+        async with AsyncSessionLocal() as session:
+            session.add(job)
+            await session.commit()
+        self.enqueued += 1
+        self._signal.release()
+        return job.id
+
+    # ---------- аренда ----------
+    def _visible(self, now: datetime):
+        cond = and_(
+            Job.status.in_((ENQUEUED, LEASED)),
+            or_(Job.lease_until.is_(None), Job.lease_until <= now),
+        )
+        if self.shard is not None:
+            index, total = self.shard
+            cond = and_(cond, Job.tg_id % total == index)
+        return cond
+
+    async def _claim(self) -> Optional[Job]:
+        # внутри процесса берём по очереди, между процессами — сравнение с обменом по статусу
+        async with self._claim_lock, AsyncSessionLocal() as session:
+            now = datetime.utcnow()
+            job = (await session.execute(
+                select(Job).where(self._visible(now)).order_by(Job.id).limit(1)
+            )).scalar_one_or_none()
+            if job is None:
+                return None
+            res = await session.execute(
+                update(Job).where(Job.id == job.id, self._visible(now)).values(
+                    status=LEASED, owner=self.owner, attempts=Job.attempts + 1,
+                    lease_until=now + timedelta(seconds=self.lease), updated_at=now,
+                ).execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            if res.rowcount != 1:
+                return None
+        job.attempts += 1
+        waited = (now - job.created_at).total_seconds()
+        if job.attempts == 1:
+            self.started += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return job
+
+    async def _renew(self, job_id: int) -> None:
+        """Продлеваем аренду, пока задача выполняется; возврат — аренда потеряна."""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            now = datetime.utcnow()
+            try:
+                async with AsyncSessionLocal() as session:
+                    res = await session.execute(
+                        update(Job).where(Job.id == job_id, Job.owner == self.owner, Job.status == LEASED)
+                        .values(lease_until=now + timedelta(seconds=self.lease), updated_at=now)
+                    )
+                    await session.commit()
+            except Exception:
+                # сбой БД — попробуем на следующем шаге, запаса аренды хватает на два промаха
+                logger.exception("Задача %d: не удалось продлить аренду", job_id)
+                continue
+            if res.rowcount != 1:
+                logger.warning("Аренда задачи %d потеряна", job_id)
+                return
+
+    async def _finish(self, job: Job, status: str, error: Optional[str] = None, retry_in: float = 0) -> None:
+        now = datetime.utcnow()
+        values = dict(status=status, error=error, updated_at=now, owner=None,
+                      lease_until=now + timedelta(seconds=retry_in) if retry_in else None)
+        if status in (DONE, FAILED):
+            values["image"] = None  # фото больше не нужно
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(Job).where(Job.id == job.id, Job.owner == self.owner).values(**values)
+            )
+            await session.commit()
+
+    # ---------- выполнение ----------
+    def _status_message(self, job: Job) -> Message:
+        return Message(
+            message_id=job.message_id, date=job.created_at,
+            chat=TgChat(id=job.chat_id, type="private"),
+        ).as_(self._bot)
+
+    async def _execute(self, job: Job) -> None:
+        message = self._status_message(job)
+        if job.kind == "text":
+            if STREAM_REPLIES:
+                await stream_to_message(message, GPT_text_stream(job.text, tg_id=job.tg_id), reply_markup=kb.inline_main)
+            else:
+                await message.edit_text(await GPT_text(job.text, tg_id=job.tg_id), reply_markup=kb.inline_main)
+        elif job.kind == "vision":
+            if STREAM_REPLIES:
+                await stream_to_message(message, GPT_vision_stream(job.image, extra_text=job.text, tg_id=job.tg_id),
+                                        reply_markup=kb.inline_main)
+            else:
+                resp = await GPT_vision(job.image, extra_text=job.text, tg_id=job.tg_id)
+                await message.edit_text(resp, reply_markup=kb.inline_main)
+        else:
+            raise ValueError(f"неизвестный тип задачи {job.kind!r}")
+
+    async def _release_user(self, job: Job) -> None:
+        # снимаем «ожидание», только если пользователь не ушёл в другой сценарий
+        key = StorageKey(bot_id=self._bot.id, chat_id=job.chat_id, user_id=job.tg_id)
+        state = FSMContext(self._storage, key)
+        if await state.get_state() in _WAIT_STATES:
+            await state.clear()
+
+    async def _process(self, job: Job) -> None:
+        renew = asyncio.create_task(self._renew(job.id))
+        work: Optional[asyncio.Task] = None
+        try:
+            try:
+                if job.attempts > self.max_attempts:
+                    raise RuntimeError("задача исчерпала попытки (воркер падал на ней)")
+                work = asyncio.create_task(self._execute(job))
+                await asyncio.wait((work, renew), return_when=asyncio.FIRST_COMPLETED)
+                if not work.done():
+                    # аренду забрали (истекла, задачу взял другой процесс) — доделывать её не нам
+                    work.cancel()
+                    await asyncio.gather(work, return_exceptions=True)
+                    self.lost += 1
+                    return
+                work.result()
+            except TelegramBadRequest as e:
+                # сообщение-статус удалено и т.п. — пользователю доставить уже некуда
+                logger.warning("Задача %d: не удалось доставить результат: %s", job.id, e)
+                await self._finish(job, DONE, error=str(e))
+                self.done += 1
+            except Exception as e:
+                if job.attempts < self.max_attempts:
+                    logger.exception("Задача %d: ошибка, повтор через %.0f с", job.id, JOB_RETRY_DELAY)
+                    await self._finish(job, ENQUEUED, error=repr(e), retry_in=JOB_RETRY_DELAY)
+                    self.retried += 1
+                    return
+                logger.exception("Задача %d: ошибка, попытки исчерпаны", job.id)
+                await self._finish(job, FAILED, error=repr(e))
+                self.failed += 1
+                with contextlib.suppress(Exception):
+                    await self._status_message(job).edit_text(JOB_FAILED_TEXT, reply_markup=kb.inline_main)
+            else:
+                await self._finish(job, DONE)
+                self.done += 1
+        finally:
+            renew.cancel()
+            if work is not None:
+                work.cancel()
+        try:
+            await self._release_user(job)
+        except Exception:
+            logger.exception("Задача %d: не удалось снять состояние ожидания", job.id)
+
+    async def _worker(self) -> None:
+        woken = True
+        while True:
+            job = None
+            # без сигнала таблицу опрашивает один воркер за интервал, а не все сразу
+            if woken or time.monotonic() - self._polled_empty >= JOB_POLL_INTERVAL:
+                try:
+                    job = await self._claim()
+                except Exception:
+                    logger.exception("Не удалось взять задачу из очереди")
+                if job is None:
+                    self._polled_empty = time.monotonic()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._signal.acquire(), JOB_POLL_INTERVAL)
+                    woken = True
+                except asyncio.TimeoutError:
+                    woken = False
+                continue
+            woken = True
+            self.busy += 1
+            try:
+                await self._process(job)
+            except Exception:
+                # например, БД недоступна при записи итога: задача вернётся по истечении аренды
+                logger.exception("Задача %d: сбой обработки", job.id)
+            finally:
+                self.busy -= 1
+
+    # ---------- жизненный цикл ----------
+    async def start(self, bot: Bot, storage: BaseStorage) -> None:
+        """На старте: чистим старые задачи и возвращаем в очередь брошенные прошлым процессом."""
+        if self._tasks:
+            return
+        self._bot = bot
+        self._storage = storage
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(Job).where(
+                Job.status.in_((DONE, FAILED)), Job.updated_at < now - timedelta(days=JOB_RETENTION_DAYS),
+            ))
+            cond = Job.status == LEASED
+            if self.shard is not None:
+                # свой шард обслуживает только этот процесс: всё арендованное в нём — от упавшего предшественника
+                index, total = self.shard
+                cond = and_(cond, Job.tg_id % total == index)
+            else:
+                # задачи могут быть у живых соседей (несколько инстансов на одну БД):
+                # забираем только просроченные и брошенные завершившимися процессами этой машины
+                owners = (await session.execute(select(Job.owner).where(cond).distinct())).scalars().all()
+                dead = [owner for owner in owners if self._owner_dead(owner)]
+                cond = and_(cond, or_(Job.lease_until <= now, Job.owner.in_(dead)))
+            res = await session.execute(
+                update(Job).where(cond).values(status=ENQUEUED, owner=None, lease_until=None, updated_at=now)
+            )
+            await session.commit()
+        self.recovered += res.rowcount or 0
+        if res.rowcount:
+            logger.warning("Возвращено в очередь незавершённых задач: %d", res.rowcount)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _owner_dead(self, owner: Optional[str]) -> bool:
+        """Владелец аренды — процесс с этой же машины, который уже завершился."""
+        host, _, rest = (owner or "").partition(":")
+        pid = rest.partition(":")[0]
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        if int(pid) == os.getpid():
+            # тот же pid, но другой владелец — прошлый запуск (например, pid 1 в контейнере)
+            return owner != self.owner
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    async def stop(self) -> None:
+        """Останавливаем воркеров; незаконченные задачи сразу возвращаем в очередь без траты попытки."""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(Job).where(Job.owner == self.owner, Job.status == LEASED).values(
+                    status=ENQUEUED, owner=None, lease_until=None, attempts=Job.attempts - 1, updated_at=now,
+                )
+            )
+            await session.commit()
+
+    async def stats(self) -> dict:
+        async with AsyncSessionLocal() as session:
+            rows = await session.execute(
+                select(Job.status, func.count()).where(Job.status.in_((ENQUEUED, LEASED))).group_by(Job.status)
+            )
+            depth = dict(rows.all())
+        return {
+            "depth": {ENQUEUED: depth.get(ENQUEUED, 0), LEASED: depth.get(LEASED, 0)},
+            "workers": len(self._tasks),
+            "busy": self.busy,
+            "enqueued": self.enqueued,
+            "done": self.done,
+            "failed": self.failed,
+            "retried": self.retried,
+            "recovered": self.recovered,
+            "lost": self.lost,
+            # от постановки до первой аренды
+            "avg_wait_ms": self.wait_total / self.started * 1000 if self.started else 0.0,
+            "max_wait_ms": self.wait_max * 1000,
+        }
+
+
+job_queue = JobQueue(JOB_WORKERS, JOB_LEASE, JOB_MAX_ATTEMPTS)
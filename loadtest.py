@@ -0,0 +1,549 @@
+"""
+Нагрузочный прогон бота без сети: синтетические апдейты идут через настоящие
+router и Dispatcher (FSM, БД, кэши, планировщик), Telegram заменён заглушкой
+сессии Bot, OpenAI — локальным сервером с задержкой и долей ошибок.
+
+    python loadtest.py --users 200 --concurrency 50
+    python loadtest.py --openai-latency 1.5 --openai-errors 0.05 --json report.json
+
+Каждый пользователь проходит сценарий по порядку: /start, меню, оплата,
+пополнение, вопрос ассистенту, загрузка фото (с уточнением или без).
+Отчёт: p50/p95/p99 обработки апдейта по типам, апдейтов в секунду,
+SQL-запросов и вызовов Bot API на апдейт. База — временная, если не задан DB_URL.
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from io import BytesIO
+from typing import Any, AsyncGenerator, Optional
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+
+BOT_TOKEN = "123456:loadtest"
+
+QUESTIONS = [
+    "Сколько белка нужно в день для набора мышц?",
+    "Как составить план тренировок на неделю?",
+    "Какие продукты лучше для похудения?",
+    "Можно ли есть углеводы вечером?",
+    "Как распределить приёмы пищи в течение дня?",
+    "Мне 30 лет, вешу 82 кг, рост 178 — сколько калорий мне нужно?",
+    "Я бегаю 3 раза в неделю по 5 км, как добавить силовые?",
+    "Какая погода будет на выходных в Москве?",
+]
+# шаги, ответ на которые приходит из очереди задач: их время — до доставки ответа
+JOB_KINDS = {"question", "skip_photo_meta", "photo_meta"}
+
+PHOTO_META = ["гречка 150 г, курица 120 г", "омлет из 3 яиц", "салат, 200 г"]
+
+ANSWER = (
+    "Коротко: ориентируйтесь на 1,6–2 г белка на кг массы тела, распределяя его "
+    "на 3–5 приёмов пищи. Базу рациона составляют крупы, мясо, рыба, яйца, "
+    "творог и овощи. Тренировки — 3–4 раза в неделю с прогрессией нагрузки."
+)
+
+# тип апдейта, который сейчас обрабатывается (для подсчёта SQL по типам)
+_current_kind: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("loadtest_kind", default=None)
+
+
+# ---------- Фальшивый OpenAI ----------
+class FakeOpenAI:
+    """Минимальный Responses API: обычный ответ и SSE-поток, задержка и 5xx по вероятности."""
+
+    def __init__(self, latency: float, error_rate: float, chunks: int, rng: random.Random):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chunks = chunks
+        self.rng = rng
+        self.requests = 0
+        self.errors = 0
+        self.chained = 0
+        # id выданных ответов: previous_response_id на неизвестный id получает 404, как у OpenAI
+        self.issued: set[str] = set()
+        # начала запросов, уже виденные сервером: так же, как OpenAI, считаем их кэшированными
+        self.prefixes: set[str] = set()
+        self.runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    def _delay(self) -> float:
+        return self.latency * self.rng.uniform(0.5, 1.5)
+
+    def _cached_tokens(self, body: dict, input_tokens: int) -> int:
+        # префикс — инструкции, прошлые реплики и неизменное начало последней;
+        # как у OpenAI, кэш работает от 1024 токенов и отдаётся блоками по 128
+        prefix = [body.get("instructions"), body.get("prompt_cache_key"), body.get("previous_response_id")]
+        items = body.get("input")
+        if isinstance(items, list) and items:
+            prefix += items[:-1]
+            last = items[-1].get("content")
+            if isinstance(last, list) and last:
+                prefix.append(last[0])
+        key = json.dumps(prefix, ensure_ascii=False)
+        seen = key in self.prefixes
+        self.prefixes.add(key)
+        prefix_tokens = len(key.encode()) // 4
+        if not seen or input_tokens < 1024 or prefix_tokens < 1024:
+            return 0
+        return prefix_tokens // 128 * 128
+
+    def _response(self, text: str, input_tokens: int, cached_tokens: int = 0) -> dict:
+        output_tokens = len(text) // 4
+        response_id = f"resp_{random.getrandbits(48):x}"
+        self.issued.add(response_id)
+        return {
+            "id": response_id,
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": "gpt-5-nano",
+            "status": "completed",
+            "parallel_tool_calls": False,
+            "tool_choice": "auto",
+            "tools": [],
+            "output": [{
+                "type": "message",
+                "id": "msg_loadtest",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": cached_tokens},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": []})
+
+    async def responses(self, request: web.Request) -> web.StreamResponse:
+        raw = await request.read()
+        body = json.loads(raw)
+        self.requests += 1
+        delay = self._delay()
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(delay / 2)
+            return web.json_response(
+                {"error": {"message": "loadtest upstream error", "type": "server_error", "param": None, "code": None}},
+                status=500,
+            )
+        previous = body.get("previous_response_id")
+        if previous is not None:
+            if previous not in self.issued:
+                return web.json_response(
+                    {"error": {"message": f"Previous response with id '{previous}' not found.",
+                               "type": "invalid_request_error", "param": "previous_response_id",
+                               "code": "previous_response_not_found"}},
+                    status=404,
+                )
+            self.chained += 1
+        input_tokens = len(raw) // 4
+        cached_tokens = self._cached_tokens(body, input_tokens)
+        if not body.get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response(self._response(ANSWER, input_tokens, cached_tokens))
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        # 40% задержки — до первого токена, остальное — между частями
+        await asyncio.sleep(delay * 0.4)
+        step = max(len(ANSWER) // self.chunks, 1)
+        for seq, start in enumerate(range(0, len(ANSWER), step)):
+            event = {
+                "type": "response.output_text.delta",
+                "item_id": "msg_loadtest",
+                "output_index": 0,
+                "content_index": 0,
+                "delta": ANSWER[start:start + step],
+                "logprobs": [],
+                "sequence_number": seq,
+            }
+            await resp.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+            await asyncio.sleep(delay * 0.6 / self.chunks)
+        done = {"type": "response.completed", "response": self._response(ANSWER, input_tokens, cached_tokens),
+                "sequence_number": self.chunks + 1}
+        await resp.write(f"event: {done['type']}\ndata: {json.dumps(done)}\n\n".encode())
+        await resp.write_eof()
+        return resp
+
+    async def start(self) -> None:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_post("/v1/responses", self.responses)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/v1"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+# ---------- Заглушка Telegram ----------
+class StubSession(BaseSession):
+    """
+    Сессия Bot без сети: ответы Bot API собираются локально и разбираются
+    тем же check_response, что и настоящие. Файлы отдаются из памяти.
+    """
+
+    def __init__(self, latency: float, photos: list[bytes], flood_rate: float = 0.0,
+                 rng: Optional[random.Random] = None):
+        super().__init__()
+        self.latency = latency
+        self.photos = photos
+        self.flood_rate = flood_rate
+        self.rng = rng or random.Random()
+        self.calls: Counter = Counter()
+        self.flooded = 0
+        self._message_ids = itertools.count(1_000_000)
+
+    def _message(self, bot: Bot, method: Any, message_id: Optional[int] = None) -> dict:
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(getattr(method, "chat_id", 0) or 0), "type": "private"},
+            "from": {"id": bot.id, "is_bot": True, "first_name": "Bot"},
+            "text": getattr(method, "text", None) or "",
+        }
+
+    def _result(self, bot: Bot, name: str, method: Any) -> Any:
+        if name in ("sendMessage", "sendInvoice", "sendPhoto"):
+            return self._message(bot, method)
+        if name in ("editMessageText", "editMessageReplyMarkup"):
+            return self._message(bot, method, getattr(method, "message_id", None))
+        if name == "getMe":
+            return {"id": bot.id, "is_bot": True, "first_name": "Bot", "username": "loadtest_bot"}
+        if name == "getFile":
+            index = int(method.file_id.rsplit("-", 1)[1])
+            return {"file_id": method.file_id, "file_unique_id": method.file_id,
+                    "file_size": len(self.photos[index]), "file_path": f"photos/{index}.jpg"}
+        return True
+
+    async def make_request(self, bot: Bot, method: Any, timeout: Optional[int] = None) -> Any:
+        name = method.__api_method__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and getattr(method, "chat_id", None) is not None and self.rng.random() < self.flood_rate:
+            # 429 в том виде, в каком его присылает Telegram
+            self.flooded += 1
+            content = json.dumps({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                  "parameters": {"retry_after": 1}})
+            self.check_response(bot=bot, method=method, status_code=429, content=content)
+        content = json.dumps({"ok": True, "result": self._result(bot, name, method)})
+        response = self.check_response(bot=bot, method=method, status_code=200, content=content)
+        return response.result
+
+    async def stream_content(
+        self, url: str, headers: Optional[dict[str, Any]] = None, timeout: int = 30,
+        chunk_size: int = 65536, raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        data = self.photos[int(url.rsplit("/", 1)[1].split(".")[0])]
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    async def close(self) -> None:
+        pass
+
+
+def make_photos(count: int, rng: random.Random) -> list[bytes]:
+    """Разные «фото» 1280x960; без Pillow — просто случайные байты."""
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return [rng.randbytes(300_000) for _ in range(count)]
+    photos = []
+    for _ in range(count):
+        img = Image.new("RGB", (1280, 960), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(12):
+            x, y = rng.randrange(1200), rng.randrange(900)
+            draw.ellipse((x, y, x + rng.randrange(60, 400), y + rng.randrange(60, 400)),
+                         fill=tuple(rng.randrange(256) for _ in range(3)))
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=90)
+        photos.append(out.getvalue())
+    return photos
+
+
+# ---------- Синтетические апдейты ----------
+class Scenario:
+    """Сырые апдейты одного пользователя (как их присылает Telegram)."""
+
+    _update_ids = itertools.count(1)
+    _message_ids = itertools.count(1)
+
+    def __init__(self, tg_id: int, bot_id: int, rng: random.Random, photos: int):
+        self.tg_id = tg_id
+        self.bot_id = bot_id
+        self.rng = rng
+        self.photos = photos
+        self.user = {"id": tg_id, "is_bot": False, "first_name": f"User{tg_id}", "language_code": "ru"}
+        self.chat = {"id": tg_id, "type": "private", "first_name": f"User{tg_id}"}
+
+    def _update(self, **payload) -> dict:
+        return {"update_id": next(self._update_ids), **payload}
+
+    def _message(self, **fields) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": self.chat, "from": self.user, **fields}
+
+    def text(self, text: str) -> dict:
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else None
+        msg = self._message(text=text)
+        if entities:
+            msg["entities"] = entities
+        return self._update(message=msg)
+
+    def callback(self, data: str) -> dict:
+        bot_msg = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": self.chat,
+                   "from": {"id": self.bot_id, "is_bot": True, "first_name": "Bot"}, "text": "…"}
+        return self._update(callback_query={
+            "id": str(next(self._update_ids)), "from": self.user, "chat_instance": str(self.tg_id),
+            "message": bot_msg, "data": data,
+        })
+
+    def photo(self) -> dict:
+        index = self.rng.randrange(self.photos)
+        sizes = [
+            {"file_id": f"photo-{index}", "file_unique_id": f"p{index}-{w}", "width": w, "height": h,
+             "file_size": w * h // 8}
+            for w, h in ((320, 240), (800, 600), (1280, 960))
+        ]
+        return self._update(message=self._message(photo=sizes))
+
+    def payment(self, amount_rub: int = 100) -> dict:
+        return self._update(message=self._message(successful_payment={
+            "currency": "RUB",
+            "total_amount": amount_rub * 100,
+            "invoice_payload": f"topup_{self.tg_id}",
+            "telegram_payment_charge_id": f"tg-{self.tg_id}-{next(self._update_ids)}",
+            "provider_payment_charge_id": f"prov-{self.tg_id}",
+        }))
+
+    def steps(self, rounds: int) -> list[tuple[str, dict]]:
+        steps = [
+            ("start", self.text("/start")),
+            ("menu", self.callback("menu")),
+            ("sub_buy", self.callback("sub_buy")),
+            ("payment", self.payment()),
+            ("use_bot", self.callback("use_bot")),
+        ]
+        for _ in range(rounds):
+            steps += [
+                ("assistant", self.callback("assistant")),
+                ("question", self.text(self.rng.choice(QUESTIONS))),
+                ("upload_photo", self.callback("upload_photo")),
+                ("photo", self.photo()),
+            ]
+            if self.rng.random() < 0.5:
+                steps.append(("skip_photo_meta", self.callback("skip_photo_meta")))
+            else:
+                steps.append(("photo_meta", self.text(self.rng.choice(PHOTO_META))))
+            steps.append(("menu", self.callback("menu")))
+        return steps
+
+
+# ---------- Прогон ----------
+def _pct(ordered: list[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    fake = FakeOpenAI(args.openai_latency, args.openai_errors, args.stream_chunks, rng)
+    await fake.start()
+    os.environ["OPENAI_BASE_URL"] = fake.base_url
+
+    # модули бота читают настройки при импорте — импортируем после подготовки окружения
+    from sqlalchemy import event
+    import db
+    from generategpt import flights, resilience_stats, scheduler
+    from usage import usage_recorder
+    from main import build_dispatcher, send_scheduler
+    from textcache import text_cache
+    from topicfilter import topic_filter
+    from jobqueue import job_queue
+    from states import Chat, Images
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+    from visioncache import vision_cache
+
+    queries: Counter = Counter()
+
+    @event.listens_for(db.engine.sync_engine, "before_cursor_execute")
+    def _count_query(*_):
+        queries[_current_kind.get()] += 1
+
+    session = StubSession(args.tg_latency, make_photos(args.photos, rng), args.tg_flood, random.Random(args.seed))
+    bot = Bot(token=BOT_TOKEN, session=session)
+    dp = build_dispatcher()
+    await dp.emit_startup(bot=bot, bots=[bot], dispatcher=dp)
+    startup_queries = sum(queries.values())
+    queries.clear()
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: Counter = Counter()
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def reply_delivered(tg_id: int) -> None:
+        # генерация идёт в очереди задач: ждём, пока воркер доставит ответ и снимет ожидание
+        state = FSMContext(dp.storage, StorageKey(bot_id=bot.id, chat_id=tg_id, user_id=tg_id))
+        while await state.get_state() in (Chat.wait.state, Images.wait.state):
+            await asyncio.sleep(0.01)
+
+    async def user(tg_id: int) -> None:
+        scenario = Scenario(tg_id, bot.id, random.Random(rng.random()), args.photos)
+        async with sem:
+            for kind, update in scenario.steps(args.rounds):
+                token = _current_kind.set(kind)
+                started = time.perf_counter()
+                try:
+                    await dp.feed_raw_update(bot, update)
+                    if kind in JOB_KINDS:
+                        await reply_delivered(tg_id)
+                except Exception as e:
+                    errors[kind] += 1
+                    if errors[kind] == 1:
+                        print(f"ошибка в {kind}: {e!r}", file=sys.stderr)
+                finally:
+                    latencies[kind].append(time.perf_counter() - started)
+                    _current_kind.reset(token)
+                if args.think:
+                    await asyncio.sleep(rng.uniform(0, 2 * args.think))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[user(args.first_id + i) for i in range(args.users)])
+    wall = time.perf_counter() - started
+
+    jobs = await job_queue.stats()
+    await dp.emit_shutdown(bot=bot, bots=[bot], dispatcher=dp)
+    await fake.stop()
+
+    total = sum(len(v) for v in latencies.values())
+    every = sorted(x for v in latencies.values() for x in v)
+    kinds = {}
+    for kind, samples in sorted(latencies.items()):
+        ordered = sorted(samples)
+        kinds[kind] = {
+            "count": len(ordered),
+            "p50_ms": round(_pct(ordered, 0.50) * 1000, 1),
+            "p95_ms": round(_pct(ordered, 0.95) * 1000, 1),
+            "p99_ms": round(_pct(ordered, 0.99) * 1000, 1),
+            "errors": errors[kind],
+            "db_queries_per_update": round(queries[kind] / len(ordered), 2),
+        }
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "updates": total,
+        "wall_s": round(wall, 2),
+        "updates_per_s": round(total / wall, 1) if wall else 0.0,
+        "p50_ms": round(_pct(every, 0.50) * 1000, 1),
+        "p95_ms": round(_pct(every, 0.95) * 1000, 1),
+        "p99_ms": round(_pct(every, 0.99) * 1000, 1),
+        "errors": sum(errors.values()),
+        "db_queries": sum(queries.values()),
+        # пакет журнала операций засчитывается апдейту, который его открыл
+        "db_queries_per_update": round(sum(queries.values()) / total, 2) if total else 0.0,
+        "db_queries_background": queries[None],
+        "db_queries_startup": startup_queries,
+        "bot_api_calls_per_update": round(sum(session.calls.values()) / total, 2) if total else 0.0,
+        "bot_api_calls": dict(session.calls),
+        "openai": {"requests": fake.requests, "errors": fake.errors, "chained": fake.chained},
+        "kinds": kinds,
+        "scheduler": scheduler.stats(),
+        "single_flight": flights.stats(),
+        "resilience": resilience_stats(),
+        "text_cache": text_cache.stats(),
+        "vision_cache": vision_cache.stats(),
+        "usage": usage_recorder.stats(),
+        "topic_filter": topic_filter.stats(),
+        "jobs": jobs,
+        "outbound": {**send_scheduler.stats(), "flooded": session.flooded},
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"{'update':16} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'err':>4} {'sql/upd':>8}")
+    for kind, row in report["kinds"].items():
+        print(f"{kind:16} {row['count']:6} {row['p50_ms']:8} {row['p95_ms']:8} {row['p99_ms']:8} "
+              f"{row['errors']:4} {row['db_queries_per_update']:8}")
+    print(f"{'всего':16} {report['updates']:6} {report['p50_ms']:8} {report['p95_ms']:8} "
+          f"{report['p99_ms']:8} {report['errors']:4} {report['db_queries_per_update']:8}")
+    print()
+    print(f"апдейтов/с: {report['updates_per_s']}  (за {report['wall_s']} с)")
+    print(f"SQL: {report['db_queries']} (фоновых {report['db_queries_background']}), "
+          f"Bot API на апдейт: {report['bot_api_calls_per_update']}")
+    print(f"OpenAI: {report['openai']['requests']} запросов, {report['openai']['errors']} ошибок; "
+          f"повторы {report['resilience']['retries']}, предохранитель {report['resilience']['breaker_state']}")
+    print(f"кэш вопросов: {report['text_cache']}")
+    print(f"кэш фото: {report['vision_cache']}")
+    print(f"фильтр тем: {report['topic_filter']}")
+    print(f"очередь задач: {report['jobs']}")
+    print(f"исходящие: {report['outbound']}")
+    usage = report["usage"]
+    for lane in ("text", "vision"):
+        if f"{lane}_calls" in usage:
+            print(f"токены {lane}: вход {usage[f'{lane}_input_tokens']}, из кэша {usage[f'{lane}_cached_tokens']} "
+                  f"({usage[f'{lane}_cache_ratio']:.0%}), выход {usage[f'{lane}_output_tokens']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота без сети")
+    parser.add_argument("--users", type=int, default=100, help="сколько пользователей проходит сценарий")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей активны одновременно")
+    parser.add_argument("--rounds", type=int, default=2, help="сколько раз каждый спрашивает ассистента и шлёт фото")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза пользователя между апдейтами, с")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="средняя задержка ответа OpenAI, с")
+    parser.add_argument("--openai-errors", type=float, default=0.0, help="доля ответов OpenAI с 500")
+    parser.add_argument("--stream-chunks", type=int, default=8, help="на сколько частей делится потоковый ответ")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="задержка каждого вызова Bot API, с")
+    parser.add_argument("--tg-flood", type=float, default=0.0, help="доля отправок в чат, на которые приходит 429")
+    parser.add_argument("--photos", type=int, default=20, help="сколько разных фото в пуле")
+    parser.add_argument("--first-id", type=int, default=10_000, help="tg_id первого пользователя")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчёт в JSON (для сравнения прогонов)")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory(prefix="loadtest-")
+    os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{os.path.join(tmp.name, 'bot.db')}")
+    os.environ.setdefault("GPT_TOKEN", "sk-loadtest")
+    # сценарий шлёт действия без пауз — лимиты пользователя не мешают замеру (можно переопределить)
+    for var in ("RATE_LIMIT_TEXT", "RATE_LIMIT_VISION", "RATE_LIMIT_MENU"):
+        os.environ.setdefault(var, "1000000/1")
+    # то же для исходящих; OUTBOUND_GLOBAL_LIMIT=30/1 OUTBOUND_CHAT_LIMIT=3/3 — реальные лимиты Telegram
+    for var in ("OUTBOUND_GLOBAL_LIMIT", "OUTBOUND_CHAT_LIMIT"):
+        os.environ.setdefault(var, "1000000/1")
+    os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+    for var in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "http_proxy", "https_proxy", "all_proxy"):
+        os.environ.pop(var, None)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    tmp.cleanup()
+    sys.exit(1 if report["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
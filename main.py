@@ -1,30 +1,226 @@
 import os
 import asyncio
+import argparse
+import secrets
 from aiogram import Bot, Dispatcher
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 from dotenv import load_dotenv
 from handlers import router
-from db import init_db
+from db import init_db, ledger
+from imageprep import image_prep_stats, shutdown_image_pool
+from visioncache import vision_cache
+from textcache import text_cache
+from conversation import conversations
+from usage import usage_recorder
+from jobqueue import job_queue
+from topicfilter import topic_filter
+from generategpt import (
+    init_gpt_client, close_gpt_client, pool_stats_snapshot, scheduler, flights, resilience_stats,
+)
+from middlewares import ConcurrencyLimitMiddleware, MetricsMiddleware, RateLimitMiddleware, SendSchedulerMiddleware
+from metrics import register_collector, start_metrics_server, stop_metrics_server
+from storage import build_storage, state_counts, SQLStorage
+from photos import photo_store, SQLPhotoStore
+from workers import Supervisor
 
-async def main():
-    load_dotenv()
-    bot = Bot(token=os.getenv('TG_TOKEN', ''))
-    dp = Dispatcher()
+# ---------- Webhook ----------
+# Публичный адрес бота (если задан — вебхук регистрируется в Telegram на старте)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько апдейтов обрабатываем одновременно в режиме вебхука
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+# Порт /health супервизора в режиме long polling (0 — не поднимать)
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "0"))
+
+
+metrics_middleware = MetricsMiddleware()
+rate_limit_middleware = RateLimitMiddleware()
+send_scheduler = SendSchedulerMiddleware()
+
+
+def build_dispatcher(fsm_cache: bool = True) -> Dispatcher:
+    # fsm_cache=False, если тех же пользователей могут обслуживать другие процессы
+    dp = Dispatcher(storage=build_storage(fsm_cache))
     dp.startup.register(startup)
     dp.shutdown.register(shutdown)
     dp.include_router(router)
+    install_rate_limit(dp)
+    install_metrics(dp)
+    return dp
+
+
+def install_rate_limit(dp: Dispatcher):
+    # до FSMContextMiddleware (он читает состояние из хранилища на каждый апдейт),
+    # фильтров и хендлеров: лишний апдейт не доходит ни до БД, ни до OpenAI
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(rate_limit_middleware)
+    dp.update.outer_middleware(dp.fsm)
+
+
+def install_send_scheduler(bot: Bot):
+    # все исходящие бота (хендлеры, очередь задач, потоковые правки) — через одну очередь
+    if send_scheduler not in bot.session.middleware:
+        bot.session.middleware(send_scheduler)
+
+
+def install_metrics(dp: Dispatcher):
+    dp.update.outer_middleware(metrics_middleware)
+    # router общий для всех диспетчеров процесса — вешаем один раз
+    for observer in (router.message, router.callback_query, router.pre_checkout_query):
+        if metrics_middleware not in observer.middleware:
+            observer.middleware(metrics_middleware)
+    register_collector("gpt_pool", pool_stats_snapshot)
+    register_collector("gpt_scheduler", scheduler.stats)
+    register_collector("gpt_single_flight", flights.stats)
+    register_collector("gpt_resilience", resilience_stats)
+    register_collector("text_cache", text_cache.stats)
+    register_collector("vision_cache", vision_cache.stats)
+    register_collector("image_prep", image_prep_stats)
+    register_collector("ledger", ledger.stats)
+    register_collector("rate_limit", rate_limit_middleware.stats)
+    register_collector("conversations", conversations.stats)
+    register_collector("usage", usage_recorder.stats)
+    register_collector("topic_filter", topic_filter.stats)
+    register_collector("jobs", job_queue.stats)
+    register_collector("outbound", send_scheduler.stats)
+    register_collector("fsm", lambda: _fsm_metrics(dp))
+
+
+async def _fsm_metrics(dp: Dispatcher) -> dict:
+    return {"states": await state_counts(dp.storage)}
+
+
+async def main():
+    load_dotenv()
+    bot = Bot(token=os.getenv('TG_TOKEN', ''))
+    dp = build_dispatcher()
     await dp.start_polling(bot)
 
-async def startup(dispatcher: Dispatcher):
+
+def build_webhook_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    # Telegram получает ответ сразу, хендлеры крутятся фоновыми задачами
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(WEBHOOK_MAX_CONCURRENCY))
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def main_webhook():
+    load_dotenv()
+    bot = Bot(token=os.getenv('TG_TOKEN', ''))
+    dp = build_dispatcher(fsm_cache=False)
+    dp.startup.register(set_webhook)
+    app = build_webhook_app(bot, dp)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    print(f'Webhook: http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def main_supervisor(workers: int, webhook: bool):
+    # апдейты принимает один процесс, обрабатывают workers процессов (шардирование по tg_id)
+    load_dotenv()
+    await init_db()  # миграции один раз, до запуска воркеров
+    bot = Bot(token=os.getenv('TG_TOKEN', ''))
+    supervisor = Supervisor(workers)
+    supervisor.start()
+    monitor = asyncio.create_task(supervisor.monitor())
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response(supervisor.health())
+
+    async def receive(request: web.Request) -> web.Response:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if WEBHOOK_SECRET and not secrets.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401)
+        await supervisor.dispatch(await request.json())
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_get('/health', health)
+    runner = None
+    try:
+        if webhook:
+            app.router.add_post(WEBHOOK_PATH, receive)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            await set_webhook(bot)
+            print(f'Supervisor: {workers} workers, webhook on :{WEBHOOK_PORT}{WEBHOOK_PATH}')
+            await asyncio.Event().wait()
+        else:
+            if HEALTH_PORT:
+                runner = web.AppRunner(app)
+                await runner.setup()
+                await web.TCPSite(runner, WEBHOOK_HOST, HEALTH_PORT).start()
+            print(f'Supervisor: {workers} workers, long polling')
+            await supervisor.poll(bot, build_dispatcher().resolve_used_update_types())
+    finally:
+        monitor.cancel()
+        supervisor.stop()
+        if runner is not None:
+            await runner.cleanup()
+        await bot.session.close()
+
+
+async def set_webhook(bot: Bot):
+    # без WEBHOOK_URL сервер принимает апдейты, но в Telegram не регистрируется
+    # (удобно для локальной проверки: POST записанного апдейта на WEBHOOK_PATH)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+        )
+
+async def startup(dispatcher: Dispatcher, bot: Bot):
+    install_send_scheduler(bot)
     await init_db()
+    await vision_cache.load()
+    await text_cache.load()
+    await init_gpt_client()
+    if isinstance(dispatcher.storage, SQLStorage):
+        await dispatcher.storage.purge_expired()
+    if isinstance(photo_store, SQLPhotoStore):
+        await photo_store.purge_expired()
+    # после загрузки кэшей: задачи, брошенные прошлым запуском, сразу уходят в работу
+    await job_queue.start(bot, dispatcher.storage)
+    await start_metrics_server()
     print('Starting...')
 
 
 async def shutdown(dispatcher: Dispatcher):
+    await job_queue.stop()
+    await stop_metrics_server()
+    await close_gpt_client()
+    await usage_recorder.flush()
+    shutdown_image_pool()
     print('Shutting...')
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--webhook', action='store_true', help='принимать апдейты через вебхук вместо long polling')
+    parser.add_argument('--workers', type=int, default=0, help='обрабатывать апдейты в N процессах')
+    args = parser.parse_args()
+    if args.workers > 0:
+        entry = main_supervisor(args.workers, args.webhook)
+    else:
+        entry = main_webhook() if args.webhook else main()
     try:
-        asyncio.run(main())
+        asyncio.run(entry)
     except KeyboardInterrupt:
-        print('Бот выключен')
\ No newline at end of file
+        print('Бот выключен')
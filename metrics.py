@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Локальный HTTP /metrics (0 — не поднимать). В режиме --workers воркер i слушает METRICS_PORT + 1 + i
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Обработка апдейта дольше этого порога попадает в лог (0 — не логировать)
+METRICS_SLOW_UPDATE_MS = float(os.getenv("METRICS_SLOW_UPDATE_MS", "2000"))
+# Семплирующий профайлер: /debug/profile?seconds=N (1 — разрешён) и период семплов, сек
+METRICS_PROFILER = os.getenv("METRICS_PROFILER", "0") == "1"
+METRICS_PROFILER_INTERVAL = float(os.getenv("METRICS_PROFILER_INTERVAL", "0.01"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# смещение порта для процессов-воркеров (выставляет workers.py)
+port_offset = 0
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs: tuple) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = collections.defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        self._values[tuple(sorted(labels.items()))] += amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счётчики по корзинам..., сумма, количество]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, row):
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {row[-1]}")
+            lines.append(f"{self.name}_sum{_labels(key)} {_number(row[-2])}")
+            lines.append(f"{self.name}_count{_labels(key)} {row[-1]}")
+        return lines
+
+
+# ---------- Метрики ----------
+update_duration = Histogram("bot_update_duration_seconds", "Время обработки апдейта по хендлеру и состоянию FSM")
+update_errors = Counter("bot_update_errors_total", "Апдейты, завершившиеся исключением")
+sql_per_update = Histogram(
+    "bot_sql_statements_per_update", "SQL-запросов на один апдейт", buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34),
+)
+sql_duration = Histogram(
+    "bot_sql_duration_seconds", "Время SQL-запроса по типу",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+openai_duration = Histogram("bot_openai_request_duration_seconds", "Время запроса к OpenAI по очереди и исходу")
+openai_tokens = Counter("bot_openai_tokens_total", "Токены OpenAI по очереди и виду (input, cached, output)")
+telegram_send_duration = Histogram(
+    "bot_telegram_send_seconds", "Отправка в Telegram от постановки в очередь до ответа, по методу",
+)
+
+_registry: list[Union[Counter, Histogram]] = [
+    update_duration, update_errors, sql_per_update, sql_duration, openai_duration, openai_tokens,
+    telegram_send_duration,
+]
+# префикс -> функция: снимки stats() модулей бота, отдаются как gauge
+_collectors: dict[str, Callable[[], Union[dict, Awaitable[dict]]]] = {}
+
+
+def register_collector(prefix: str, fn: Callable[[], Union[dict, Awaitable[dict]]]) -> None:
+    """Числа из словаря fn() отдаются как bot_<prefix>_<ключ>, строки — как метка value."""
+    _collectors[prefix] = fn
+
+
+async def _render_collectors() -> list[str]:
+    lines = []
+    for prefix, fn in list(_collectors.items()):
+        try:
+            snap = fn()
+            if asyncio.iscoroutine(snap):
+                snap = await snap
+        except Exception:
+            logger.exception("Не удалось собрать метрики %s", prefix)
+            continue
+        for key, value in snap.items():
+            name = f"bot_{prefix}_{key}"
+            if isinstance(value, dict):
+                # вложенный словарь — одна метрика с меткой key
+                lines.append(f"# TYPE {name} gauge")
+                for label, item in sorted(value.items()):
+                    if not isinstance(item, (int, float)) or isinstance(item, bool):
+                        continue
+                    lines.append(f"{name}{_labels((('key', label),))} {_number(item)}")
+            elif isinstance(value, str):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name}{_labels((('value', value),))} 1")
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_number(value)}")
+    return lines
+
+
+async def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    lines += await _render_collectors()
+    return "\n".join(lines) + "\n"
+
+
+# ---------- Апдейт в работе ----------
+class UpdateScope:
+    """Что известно об апдейте, пока он обрабатывается (для меток и счётчика SQL)."""
+
+    __slots__ = ("handler", "state", "sql")
+
+    def __init__(self, state: Optional[str]):
+        self.handler: Optional[str] = None
+        self.state = state
+        self.sql = 0
+
+
+current_update: contextvars.ContextVar[Optional[UpdateScope]] = contextvars.ContextVar("current_update", default=None)
+
+
+def observe_update(scope: UpdateScope, seconds: float, failed: bool) -> None:
+    handler = scope.handler or "unhandled"
+    state = scope.state or "none"
+    update_duration.observe(seconds, handler=handler, state=state)
+    sql_per_update.observe(scope.sql)
+    if failed:
+        update_errors.inc(handler=handler)
+    if METRICS_SLOW_UPDATE_MS and seconds * 1000 >= METRICS_SLOW_UPDATE_MS:
+        logger.warning("Медленный апдейт: %s (state=%s) %.0f мс, SQL %d", handler, state, seconds * 1000, scope.sql)
+
+
+def observe_sql(statement: str, seconds: float) -> None:
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    sql_duration.observe(seconds, verb=verb)
+    scope = current_update.get()
+    if scope is not None:
+        scope.sql += 1
+
+
+def observe_openai(lane: str, seconds: float, outcome: str) -> None:
+    openai_duration.observe(seconds, lane=lane, outcome=outcome)
+
+
+def observe_tokens(lane: str, usage: Any) -> None:
+    """usage из ответа Responses API (у потока — из события response.completed)."""
+    if usage is None:
+        return
+    openai_tokens.inc(getattr(usage, "input_tokens", 0) or 0, lane=lane, kind="input")
+    openai_tokens.inc(getattr(usage, "output_tokens", 0) or 0, lane=lane, kind="output")
+    details = getattr(usage, "input_tokens_details", None)
+    openai_tokens.inc(getattr(details, "cached_tokens", 0) or 0, lane=lane, kind="cached")
+
+
+def observe_send(method: str, seconds: float, outcome: str) -> None:
+    telegram_send_duration.observe(seconds, method=method, outcome=outcome)
+
+
+# ---------- Семплирующий профайлер ----------
+class SamplingProfiler:
+    """
+    Раз в interval снимает стек главного потока (где крутится event loop) и
+    считает одинаковые стеки. Результат — «свёрнутые» стеки для flamegraph.pl
+    или speedscope. Включается на время запроса /debug/profile, в остальное
+    время ничего не стоит.
+    """
+
+    def __init__(self, interval: float = METRICS_PROFILER_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def _collapse(self, frame) -> str:
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def _sample(self, thread_id: int, seconds: float) -> collections.Counter:
+        stacks: collections.Counter = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[self._collapse(frame)] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    async def profile(self, seconds: float) -> str:
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("профайлер уже запущен")
+        try:
+            thread_id = threading.get_ident()
+            stacks = await asyncio.get_running_loop().run_in_executor(None, self._sample, thread_id, seconds)
+        finally:
+            self._lock.release()
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+profiler = SamplingProfiler()
+
+
+# ---------- HTTP ----------
+async def _metrics(request: web.Request) -> web.Response:
+    return web.Response(text=await render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def _profile(request: web.Request) -> web.Response:
+    if not METRICS_PROFILER:
+        return web.Response(status=404, text="profiler disabled (METRICS_PROFILER=1)\n")
+    try:
+        seconds = min(max(float(request.query.get("seconds", "10")), 0.1), 60.0)
+    except ValueError:
+        return web.Response(status=400, text="bad seconds\n")
+    try:
+        return web.Response(text=await profiler.profile(seconds))
+    except RuntimeError as e:
+        return web.Response(status=409, text=f"{e}\n")
+
+
+_runner: Optional[web.AppRunner] = None
+
+
+async def start_metrics_server() -> None:
+    global _runner
+    if not METRICS_PORT or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    app.router.add_get("/debug/profile", _profile)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT + port_offset).start()
+
+
+async def stop_metrics_server() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
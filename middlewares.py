@@ -0,0 +1,414 @@
+import asyncio
+import contextvars
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendChatAction, TelegramMethod
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+from metrics import UpdateScope, current_update, observe_send, observe_update
+
+
+def _rate(name: str, default: str) -> tuple[float, float]:
+    # "6/60" — не больше 6 действий подряд, восполняются за 60 секунд
+    burst, period = os.getenv(name, default).split("/")
+    return float(burst), float(period)
+
+
+# Лимиты по классам действий: text — вопросы ассистенту, vision — фото, menu — кнопки и команды
+RATE_LIMITS = {
+    "text": _rate("RATE_LIMIT_TEXT", "6/60"),
+    "vision": _rate("RATE_LIMIT_VISION", "4/60"),
+    "menu": _rate("RATE_LIMIT_MENU", "40/60"),
+}
+# Через сколько секунд тишины забываем пользователя и сколько пользователей держим максимум
+RATE_LIMIT_IDLE = float(os.getenv("RATE_LIMIT_IDLE", str(max(period for _, period in RATE_LIMITS.values()))))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "100000"))
+
+SLOW_DOWN_TEXT = "Слишком много запросов подряд. Подождите {seconds} с и попробуйте снова."
+
+# Исходящие в Telegram (0 — слать напрямую): общий лимит бота (на все воркеры --workers вместе),
+# лимит на личный чат и на группу
+OUTBOUND_SCHEDULER = os.getenv("OUTBOUND_SCHEDULER", "1") == "1"
+OUTBOUND_GLOBAL_LIMIT = _rate("OUTBOUND_GLOBAL_LIMIT", "30/1")
+OUTBOUND_CHAT_LIMIT = _rate("OUTBOUND_CHAT_LIMIT", "3/3")
+OUTBOUND_GROUP_LIMIT = _rate("OUTBOUND_GROUP_LIMIT", "20/60")
+# Сколько раз повторяем отправку после 429 (retry_after), прежде чем отдать ошибку вызывающему
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_MAX_CHATS = int(os.getenv("OUTBOUND_MAX_CHATS", "100000"))
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число апдейтов, которые обрабатываются одновременно."""
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Метрики апдейта: время обработки по хендлеру и состоянию FSM, число SQL.
+    Ставится дважды: outer-middleware на dp.update (замер и счётчик SQL)
+    и middleware на события роутера — там уже известен выбранный хендлер.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if "handler" in data:
+            scope = current_update.get()
+            if scope is not None:
+                scope.handler = data["handler"].callback.__name__
+            return await handler(event, data)
+
+        scope = UpdateScope(data.get("raw_state"))
+        token = current_update.set(scope)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            current_update.reset(token)
+            observe_update(scope, time.perf_counter() - started, failed)
+
+
+class _Buckets:
+    """Ведра одного пользователя: токены по классам и время последнего пополнения."""
+
+    __slots__ = ("tokens", "stamp", "warned")
+
+    def __init__(self, tokens: list[float], stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+        self.warned = 0  # битовая маска классов, по которым уже предупредили
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Token bucket на пользователя и класс действия. Ставится outer-middleware
+    на dp.update перед FSMContextMiddleware: лишний апдейт отбрасывается
+    до чтения состояния FSM, фильтров и хендлеров, то есть без запросов в БД
+    и OpenAI. Поэтому класс определяется по самому апдейту, без состояния:
+    любой свободный текст (вопрос ассистенту, уточнения к фото) — text.
+    О превышении пишем один раз, пока ведро не восполнится хотя бы на одно
+    действие. Оплаты не ограничиваются.
+    """
+
+    def __init__(self, limits: dict[str, tuple[float, float]] = RATE_LIMITS,
+                 idle: float = RATE_LIMIT_IDLE, max_users: int = RATE_LIMIT_MAX_USERS):
+        self.classes = list(limits)
+        self.capacity = [limits[c][0] for c in self.classes]
+        self.refill = [limits[c][0] / limits[c][1] for c in self.classes]
+        self.idle = idle
+        self.max_users = max_users
+        self.throttled = 0
+        self._users: "OrderedDict[int, _Buckets]" = OrderedDict()
+
+    @staticmethod
+    def action_class(event: Optional[TelegramObject]) -> Optional[str]:
+        if isinstance(event, CallbackQuery):
+            return "vision" if event.data == "skip_photo_meta" else "menu"
+        if isinstance(event, Message):
+            if event.successful_payment is not None:
+                return None
+            if event.photo:
+                return "vision"
+            if event.text and not event.text.startswith("/"):
+                return "text"
+            return "menu"
+        return None
+
+    def _evict(self, now: float) -> None:
+        while self._users:
+            tg_id, buckets = next(iter(self._users.items()))
+            if now - buckets.stamp < self.idle and len(self._users) <= self.max_users:
+                break
+            del self._users[tg_id]
+
+    def hit(self, tg_id: int, cls: str) -> tuple[bool, float, bool]:
+        """(разрешено, через сколько секунд будет токен, надо ли предупредить)."""
+        now = time.monotonic()
+        i = self.classes.index(cls)
+        buckets = self._users.get(tg_id)
+        if buckets is None:
+            buckets = self._users[tg_id] = _Buckets(list(self.capacity), now)
+        else:
+            elapsed = now - buckets.stamp
+            buckets.tokens = [min(cap, t + elapsed * r) for cap, t, r in zip(self.capacity, buckets.tokens, self.refill)]
+            buckets.stamp = now
+            self._users.move_to_end(tg_id)
+        self._evict(now)
+        if buckets.tokens[i] >= 1:
+            buckets.tokens[i] -= 1
+            buckets.warned &= ~(1 << i)
+            return True, 0.0, False
+        warn = not buckets.warned & (1 << i)
+        buckets.warned |= 1 << i
+        return False, (1 - buckets.tokens[i]) / self.refill[i], warn
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        message = (event.message or event.callback_query) if isinstance(event, Update) else event
+        cls = self.action_class(message)
+        if user is None or cls is None:
+            return await handler(event, data)
+        allowed, wait, warn = self.hit(user.id, cls)
+        if allowed:
+            return await handler(event, data)
+
+        self.throttled += 1
+        # до MetricsMiddleware апдейт не дошёл — замеряем его здесь
+        scope = UpdateScope(None)
+        scope.handler = f"rate_limited_{cls}"
+        token = current_update.set(scope)
+        started = time.perf_counter()
+        try:
+            text = SLOW_DOWN_TEXT.format(seconds=max(int(wait + 0.999), 1))
+            if isinstance(message, CallbackQuery):
+                # ответ на коллбэк нужен в любом случае, иначе кнопка «крутится»
+                await message.answer(text if warn else None)
+            elif warn:
+                await message.answer(text)
+        finally:
+            current_update.reset(token)
+            observe_update(scope, time.perf_counter() - started, False)
+        return None
+
+    def stats(self) -> dict:
+        return {"users": len(self._users), "throttled": self.throttled}
+
+
+class _Send:
+    """Один запрос к Bot API в очереди чата."""
+
+    __slots__ = ("make_request", "bot", "method", "future", "queued_at", "merge_key", "retries")
+
+    def __init__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod,
+                 future: asyncio.Future, merge_key: Optional[tuple]):
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.merge_key = merge_key
+        self.retries = 0
+
+
+class _ChatQueue:
+    """Очередь одного чата: ещё не начатые отправки, ведро токенов и пауза после 429."""
+
+    __slots__ = ("items", "tokens", "stamp", "paused_until", "task")
+
+    def __init__(self, tokens: float, now: float):
+        self.items: deque[_Send] = deque()
+        self.tokens = tokens
+        self.stamp = now
+        self.paused_until = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+
+class SendSchedulerMiddleware(BaseRequestMiddleware):
+    """
+    Все исходящие в чаты (методы с chat_id) идут через очередь своего чата:
+    одна отправка за раз, поэтому порядок внутри чата сохраняется. Перед
+    отправкой берётся токен из ведра чата и из общего ведра бота. На 429
+    чат замирает на retry_after, и тот же запрос уходит снова первым.
+    Ещё не отправленная правка текста того же сообщения и повтор
+    «печатает…» вытесняются новыми: уходит только последняя версия, а
+    вызывающие получают её результат. Запросы без chat_id (ответы на
+    коллбэки, getFile) идут напрямую.
+    """
+
+    def __init__(self, global_limit: tuple[float, float] = OUTBOUND_GLOBAL_LIMIT,
+                 chat_limit: tuple[float, float] = OUTBOUND_CHAT_LIMIT,
+                 group_limit: tuple[float, float] = OUTBOUND_GROUP_LIMIT,
+                 max_retries: int = OUTBOUND_MAX_RETRIES, max_chats: int = OUTBOUND_MAX_CHATS):
+        self.global_capacity, self.global_refill = global_limit[0], global_limit[0] / global_limit[1]
+        self.limits = {
+            "private": (chat_limit[0], chat_limit[0] / chat_limit[1]),
+            "group": (group_limit[0], group_limit[0] / group_limit[1]),
+        }
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.sent = 0
+        self.merged = 0
+        self.retry_after = 0
+        self.failed = 0
+        self._global_tokens = self.global_capacity
+        self._global_stamp = time.monotonic()
+        # общее ведро выдаёт токены по очереди (FIFO), а не тому, кто проснулся первым
+        self._global_lock = asyncio.Lock()
+        self._chats: "OrderedDict[Any, _ChatQueue]" = OrderedDict()
+
+    def share_global(self, parts: int) -> None:
+        """
+        Лимит на бота общий для всех процессов с этим токеном: в режиме
+        --workers N каждому воркеру достаётся 1/N общего ведра.
+        """
+        if parts > 1:
+            self.global_capacity = max(self.global_capacity / parts, 1.0)
+            self.global_refill /= parts
+            self._global_tokens = min(self._global_tokens, self.global_capacity)
+
+    def _limit(self, chat_id: Any) -> tuple[float, float]:
+        # у групп и каналов id отрицательный (или @username)
+        return self.limits["private" if isinstance(chat_id, int) and chat_id > 0 else "group"]
+
+    @staticmethod
+    def _merge_key(method: TelegramMethod) -> Optional[tuple]:
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            return ("edit_text", method.message_id)
+        if isinstance(method, SendChatAction):
+            return ("chat_action", method.action)
+        return None
+
+    def _evict(self, now: float) -> None:
+        # чат можно забыть, когда очередь пуста и ведро успело бы наполниться
+        while self._chats:
+            chat_id, chat = next(iter(self._chats.items()))
+            capacity, refill = self._limit(chat_id)
+            idle = now - chat.stamp >= capacity / refill and now >= chat.paused_until
+            if chat.task is not None or chat.items or (not idle and len(self._chats) <= self.max_chats):
+                break
+            del self._chats[chat_id]
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        chat_id = getattr(method, "chat_id", None)
+        if not OUTBOUND_SCHEDULER or chat_id is None:
+            return await make_request(bot, method)
+        now = time.monotonic()
+        # чистим до поиска: забытый чат создаётся заново с полным ведром, и у него одна очередь
+        self._evict(now)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(self._limit(chat_id)[0], now)
+        else:
+            self._chats.move_to_end(chat_id)
+
+        item = _Send(make_request, bot, method, asyncio.get_running_loop().create_future(), self._merge_key(method))
+        if item.merge_key is not None:
+            for old in chat.items:
+                if old.merge_key == item.merge_key:
+                    chat.items.remove(old)
+                    # вытесненная версия получает результат новой
+                    item.future.add_done_callback(lambda f, old=old: self._chain(f, old.future))
+                    self.merged += 1
+                    break
+        chat.items.append(item)
+        if chat.task is None:
+            # пустой контекст: отправки не засчитываются апдейту, который открыл очередь
+            chat.task = asyncio.create_task(self._drain(chat_id, chat), context=contextvars.Context())
+        return await item.future
+
+    @staticmethod
+    def _chain(source: asyncio.Future, target: asyncio.Future) -> None:
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    async def _take_chat_token(self, chat_id: Any, chat: _ChatQueue) -> None:
+        capacity, refill = self._limit(chat_id)
+        while True:
+            now = time.monotonic()
+            chat.tokens = min(capacity, chat.tokens + (now - chat.stamp) * refill)
+            chat.stamp = now
+            wait = max(chat.paused_until - now, 0.0)
+            if not wait and chat.tokens >= 1:
+                chat.tokens -= 1
+                return
+            await asyncio.sleep(wait or (1 - chat.tokens) / refill)
+
+    async def _take_global_token(self) -> None:
+        async with self._global_lock:
+            while True:
+                now = time.monotonic()
+                self._global_tokens = min(self.global_capacity,
+                                          self._global_tokens + (now - self._global_stamp) * self.global_refill)
+                self._global_stamp = now
+                if self._global_tokens >= 1:
+                    self._global_tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._global_tokens) / self.global_refill)
+
+    async def _drain(self, chat_id: Any, chat: _ChatQueue) -> None:
+        try:
+            while chat.items:
+                item = chat.items[0]
+                if item.future.done():
+                    # вызывающего отменили, пока запрос ждал очереди
+                    chat.items.popleft()
+                    continue
+                await self._take_chat_token(chat_id, chat)
+                await self._take_global_token()
+                # пока ждали токены, запрос могли вытеснить более новой версией
+                if not chat.items or chat.items[0] is not item:
+                    continue
+                chat.items.popleft()
+                name = type(item.method).__name__
+                try:
+                    result = await item.make_request(item.bot, item.method)
+                except TelegramRetryAfter as e:
+                    self.retry_after += 1
+                    item.retries += 1
+                    if item.retries <= self.max_retries:
+                        chat.paused_until = time.monotonic() + e.retry_after
+                        chat.items.appendleft(item)
+                        continue
+                    self._fail(item, e, name)
+                except Exception as e:
+                    self._fail(item, e, name)
+                else:
+                    self.sent += 1
+                    observe_send(name, time.monotonic() - item.queued_at, "ok")
+                    if not item.future.done():
+                        item.future.set_result(result)
+        finally:
+            chat.task = None
+
+    def _fail(self, item: _Send, error: Exception, name: str) -> None:
+        self.failed += 1
+        observe_send(name, time.monotonic() - item.queued_at, "error")
+        if not item.future.done():
+            item.future.set_exception(error)
+
+    def stats(self) -> dict:
+        depths = [len(chat.items) for chat in self._chats.values()]
+        return {
+            "queued": sum(depths),
+            "max_chat_depth": max(depths, default=0),
+            "busy_chats": sum(1 for chat in self._chats.values() if chat.task is not None),
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "merged": self.merged,
+            "retry_after": self.retry_after,
+            "failed": self.failed,
+        }
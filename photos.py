@@ -0,0 +1,140 @@
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Optional, Union
+
+from aiogram import Bot
+from aiogram.types import PhotoSize
+from sqlalchemy import delete
+
+from db import AsyncSessionLocal, PendingPhoto
+from storage import FSM_STORAGE
+
+# Сколько секунд держим фото, пока пользователь вводит состав/граммовку
+PHOTO_TTL = float(os.getenv("PHOTO_TTL", "600"))
+
+# Максимальный размер одного фото и общий бюджет памяти на все ожидающие фото
+PHOTO_MAX_BYTES = int(os.getenv("PHOTO_MAX_BYTES", str(10 * 1024 * 1024)))
+PHOTO_BUDGET_BYTES = int(os.getenv("PHOTO_BUDGET_BYTES", str(256 * 1024 * 1024)))
+
+
+class PhotoStore:
+    """
+    Фото, ожидающие обработки, в памяти процесса (без временных файлов).
+    Ключ кладём в FSM, сами байты живут здесь: с TTL и общим лимитом по памяти,
+    старые записи вытесняются первыми.
+    """
+
+    def __init__(self, ttl: float, budget_bytes: int):
+        self.ttl = ttl
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+        self._items: "OrderedDict[str, tuple[float, bytes]]" = OrderedDict()
+
+    def _drop(self, key: str) -> Optional[bytes]:
+        item = self._items.pop(key, None)
+        if item is None:
+            return None
+        self.total_bytes -= len(item[1])
+        return item[1]
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._items:
+            key, (expires_at, _) = next(iter(self._items.items()))
+            if expires_at >= now and self.total_bytes <= self.budget_bytes:
+                break
+            self._drop(key)
+
+    async def put(self, data: bytes) -> str:
+        key = uuid.uuid4().hex
+        self._items[key] = (time.monotonic() + self.ttl, data)
+        self.total_bytes += len(data)
+        self._evict()
+        return key
+
+    async def pop(self, key: Optional[str]) -> Optional[bytes]:
+        self._evict()
+        if not key:
+            return None
+        return self._drop(key)
+
+    async def discard(self, key: Optional[str]) -> None:
+        if key:
+            self._drop(key)
+
+
+class SQLPhotoStore:
+    """
+    Те же ожидающие фото, но в таблице pending_photos (движок db.py) — рядом
+    с состоянием FSM. Сценарий «фото → уточнения» переживает перезапуск и
+    может закончиться в другом процессе (несколько инстансов --webhook).
+    TTL тот же; просроченные строки удаляются на старте и попутно при записи.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._purged_at = time.monotonic()
+
+    async def put(self, data: bytes) -> str:
+        key = uuid.uuid4().hex
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as session:
+            session.add(PendingPhoto(key=key, data=data, expires_at=now + timedelta(seconds=self.ttl)))
+            if time.monotonic() - self._purged_at >= self.ttl:
+                self._purged_at = time.monotonic()
+                await session.execute(delete(PendingPhoto).where(PendingPhoto.expires_at < now))
+            await session.commit()
+        return key
+
+    async def pop(self, key: Optional[str]) -> Optional[bytes]:
+        if not key:
+            return None
+        # удаление с RETURNING: фото забирает ровно один обработчик
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                delete(PendingPhoto).where(PendingPhoto.key == key)
+                .returning(PendingPhoto.data, PendingPhoto.expires_at)
+            )
+            row = res.first()
+            await session.commit()
+        if row is None or row.expires_at < datetime.utcnow():
+            return None
+        return row.data
+
+    async def discard(self, key: Optional[str]) -> None:
+        if not key:
+            return
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(PendingPhoto).where(PendingPhoto.key == key))
+            await session.commit()
+
+    async def purge_expired(self) -> int:
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(delete(PendingPhoto).where(PendingPhoto.expires_at < datetime.utcnow()))
+            await session.commit()
+        return res.rowcount or 0
+
+
+def build_photo_store() -> Union[PhotoStore, SQLPhotoStore]:
+    # фото живут там же, где и FSM с их ключом
+    if FSM_STORAGE == "memory":
+        return PhotoStore(PHOTO_TTL, PHOTO_BUDGET_BYTES)
+    return SQLPhotoStore(PHOTO_TTL)
+
+
+photo_store = build_photo_store()
+
+
+async def download_photo(bot: Bot, photo: PhotoSize) -> Optional[bytes]:
+    """Скачиваем фото в память. None — если фото больше PHOTO_MAX_BYTES."""
+    if photo.file_size and photo.file_size > PHOTO_MAX_BYTES:
+        return None
+    buf = BytesIO()
+    await bot.download(photo, destination=buf)
+    if buf.getbuffer().nbytes > PHOTO_MAX_BYTES:
+        return None
+    return buf.getvalue()
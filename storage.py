@@ -0,0 +1,154 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import case, delete, func, or_, select
+
+from db import AsyncSessionLocal, FSMRecord, dialect_insert
+
+# Хранилище FSM: sql — таблица fsm_states в DB_URL, memory — в памяти процесса
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sql")
+# Сколько секунд живёт незавершённое состояние (брошенный сценарий)
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))
+# Кэш в процессе: время жизни записи и максимум записей. Включается, только когда
+# пользователя обслуживает один процесс (long polling, --workers); в режиме
+# --webhook инстансов может быть несколько — читаем всегда из БД
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "60"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "50000"))
+
+
+class SQLStorage(BaseStorage):
+    """
+    FSM в таблице fsm_states (тот же движок, что и у db.py) с кэшем в процессе.
+    Запись идёт сквозь кэш сразу в БД, чтение — из кэша, пока он свежий
+    (cache_ttl=0 — без кэша). set_state и set_data пишут только свою колонку,
+    поэтому не возвращают в БД устаревшую копию второй.
+    Состояния старше FSM_STATE_TTL считаются брошенными и не возвращаются.
+    """
+
+    def __init__(self, state_ttl: int = FSM_STATE_TTL, cache_ttl: float = FSM_CACHE_TTL,
+                 cache_size: int = FSM_CACHE_SIZE):
+        self.state_ttl = state_ttl
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> (state, data, cached_at)
+        self._cache: "OrderedDict[str, tuple[Optional[str], dict, float]]" = OrderedDict()
+
+    def _cache_put(self, key: str, state: Optional[str], data: dict) -> None:
+        if self.cache_ttl <= 0:
+            return
+        self._cache[key] = (state, data, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str) -> tuple[Optional[str], dict]:
+        item = self._cache.get(key)
+        if item is not None and time.monotonic() - item[2] < self.cache_ttl:
+            self._cache.move_to_end(key)
+            return item[0], item[1]
+        async with AsyncSessionLocal() as session:
+            row = await session.get(FSMRecord, key)
+        state, data = None, {}
+        if row is not None and row.updated_at >= datetime.utcnow() - timedelta(seconds=self.state_ttl):
+            state, data = row.state, json.loads(row.data or "{}")
+        self._cache_put(key, state, data)
+        return state, data
+
+    def _upsert(self, key: str, column: str, value: Optional[str], now: datetime):
+        border = now - timedelta(seconds=self.state_ttl)
+        empty = {"state": None, "data": "{}"}
+        other = "data" if column == "state" else "state"
+        values = {**empty, column: value}
+        stmt = dialect_insert(FSMRecord).values(key=key, updated_at=now, **values)
+        return stmt.on_conflict_do_update(
+            index_elements=[FSMRecord.key],
+            set_={
+                column: value,
+                other: case((FSMRecord.updated_at >= border, getattr(FSMRecord, other)), else_=empty[other]),
+                "updated_at": now,
+            },
+        )
+
+    async def _write(self, key: str, column: str, value: Optional[str]) -> None:
+        """
+        Обновляем одну колонку (state или data). Вторая остаётся как в БД,
+        если запись не брошена; пустая запись удаляется.
+        """
+        async with AsyncSessionLocal() as session:
+            await session.execute(self._upsert(key, column, value, datetime.utcnow()))
+            await session.execute(delete(FSMRecord).where(
+                FSMRecord.key == key,
+                FSMRecord.state.is_(None),
+                or_(FSMRecord.data.is_(None), FSMRecord.data == "{}"),
+            ))
+            await session.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        await self._write(skey, "state", state)
+        item = self._cache.get(skey)
+        if item is not None:
+            self._cache_put(skey, state, item[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        skey = self.key_builder.build(key)
+        data = dict(data)
+        await self._write(skey, "data", json.dumps(data, ensure_ascii=False))
+        item = self._cache.get(skey)
+        if item is not None:
+            self._cache_put(skey, item[0], data)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    async def purge_expired(self) -> int:
+        """Удаляем брошенные состояния старше FSM_STATE_TTL."""
+        border = datetime.utcnow() - timedelta(seconds=self.state_ttl)
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(delete(FSMRecord).where(FSMRecord.updated_at < border))
+            await session.commit()
+        return res.rowcount or 0
+
+    async def state_counts(self) -> dict[str, int]:
+        """Сколько пользователей сейчас в каждом состоянии (для метрик)."""
+        border = datetime.utcnow() - timedelta(seconds=self.state_ttl)
+        async with AsyncSessionLocal() as session:
+            rows = await session.execute(
+                select(FSMRecord.state, func.count())
+                .where(FSMRecord.updated_at >= border, FSMRecord.state.is_not(None))
+                .group_by(FSMRecord.state)
+            )
+        return {state: count for state, count in rows}
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+async def state_counts(storage: BaseStorage) -> dict[str, int]:
+    if isinstance(storage, SQLStorage):
+        return await storage.state_counts()
+    counts: dict[str, int] = {}
+    for record in getattr(storage, "storage", {}).values():
+        if record.state:
+            counts[record.state] = counts.get(record.state, 0) + 1
+    return counts
+
+
+def build_storage(cache: bool = True) -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLStorage(cache_ttl=FSM_CACHE_TTL if cache else 0)
@@ -0,0 +1,96 @@
+import asyncio
+import contextlib
+import os
+import time
+from typing import AsyncIterator, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+
+# Потоковая выдача ответов (1 — включена)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+
+# Минимальный интервал между правками одного сообщения, сек (лимит Telegram на чат)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Максимальная длина текста сообщения в Telegram
+MESSAGE_LIMIT = 4096
+
+# Если поток закончился, не дав ни строчки: Telegram не примет пустой текст
+EMPTY_REPLY_TEXT = "Не получилось сформулировать ответ, попробуйте спросить иначе."
+
+
+class ProgressiveEditor:
+    """
+    Постепенно правит сообщение-заглушку по мере генерации.
+    Промежуточные версии текста, пришедшие чаще STREAM_EDIT_INTERVAL, склеиваются:
+    в Telegram уходит только последняя. Промежуточные правки не ждём — генерация
+    не стоит, пока чат на паузе после 429; ещё не отправленные правки вытесняет
+    очередь исходящих (SendSchedulerMiddleware).
+    """
+
+    def __init__(self, message: Message, interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._last_edit = 0.0
+        self._shown = message.text or ""
+        self._pending: set[asyncio.Task] = set()
+
+    async def _edit(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        text = text[:MESSAGE_LIMIT]
+        if text == self._shown and reply_markup is None:
+            return
+        try:
+            await self.message.edit_text(text, reply_markup=reply_markup)
+        except TelegramRetryAfter as e:
+            # не успели — следующая правка всё равно придёт позже
+            self._last_edit = time.monotonic() + e.retry_after
+            return
+        except TelegramBadRequest:
+            # «message is not modified» и т.п. — не ломаем ответ
+            pass
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def update(self, text: str) -> None:
+        if text and time.monotonic() - self._last_edit >= self.interval:
+            self._last_edit = time.monotonic()
+            task = asyncio.create_task(self._edit(text + " ▌"))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    def cancel(self) -> None:
+        for task in self._pending:
+            task.cancel()
+
+    async def finish(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        # промежуточная правка не должна лечь поверх итоговой
+        await asyncio.gather(*self._pending, return_exceptions=True)
+        try:
+            await self.message.edit_text(text[:MESSAGE_LIMIT], reply_markup=reply_markup)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            await self.message.edit_text(text[:MESSAGE_LIMIT], reply_markup=reply_markup)
+        except TelegramBadRequest:
+            with contextlib.suppress(TelegramBadRequest):
+                await self.message.edit_reply_markup(reply_markup=reply_markup)
+
+
+async def stream_to_message(
+    message: Message,
+    chunks: AsyncIterator[str],
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> str:
+    """Выводим поток ответа в сообщение; последняя правка добавляет клавиатуру."""
+    editor = ProgressiveEditor(message)
+    text = ""
+    try:
+        async for text in chunks:
+            await editor.update(text)
+        if not text.strip():
+            text = EMPTY_REPLY_TEXT
+        await editor.finish(text, reply_markup=reply_markup)
+    finally:
+        # при отмене не оставляем висящих промежуточных правок
+        editor.cancel()
+    return text
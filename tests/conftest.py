@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# модули бота лежат в корне репозитория и читают настройки при импорте:
+# отдельная БД для тестов, без токенов и без /metrics
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{os.path.join(_tmp, 'test.db')}"
+os.environ.setdefault("GPT_TOKEN", "test")
+os.environ.setdefault("TG_TOKEN", "42:test")
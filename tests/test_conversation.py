@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+import generategpt
+from conversation import conversations
+
+
+def _stub_create(calls):
+    async def create(lane, request, tg_id=None):
+        calls.append((request.get("previous_response_id"), request["input"]))
+        return SimpleNamespace(output_text=f"ответ {len(calls)}", id=f"resp_{len(calls)}")
+    return create
+
+
+def test_first_own_answer_starts_the_chain(monkeypatch):
+    calls = []
+    monkeypatch.setattr(generategpt, "_create", _stub_create(calls))
+    tg_id = 501
+    conversations.reset(tg_id)
+
+    async def scenario():
+        # личные вопросы («мне», «мой») идут мимо кэша ответов
+        await generategpt.GPT_text("Сколько мне приседать при весе 80 кг?", tg_id)
+        await generategpt.GPT_text("А сколько подходов мне делать?", tg_id)
+        await generategpt.GPT_text("И сколько мне отдыхать между ними?", tg_id)
+
+    asyncio.run(scenario())
+    assert [prev for prev, _ in calls] == [None, "resp_1", "resp_2"]
+    # со ссылкой на прошлый ответ историю заново не отправляем
+    assert all(isinstance(item, str) for _, item in calls)
+
+
+def test_shared_answer_is_remembered_without_chain(monkeypatch):
+    calls = []
+    create = _stub_create(calls)
+
+    async def slow_create(lane, request, tg_id=None):
+        await asyncio.sleep(0.05)
+        return await create(lane, request, tg_id)
+
+    monkeypatch.setattr(generategpt, "_create", slow_create)
+    leader, follower = 502, 503
+    conversations.reset(leader)
+    conversations.reset(follower)
+    question = "Сколько мне пить воды в день?"
+
+    async def scenario():
+        # одинаковый вопрос одновременно: запрос один, его делает лидер
+        await asyncio.gather(generategpt.GPT_text(question, leader), generategpt.GPT_text(question, follower))
+        await generategpt.GPT_text("А если мне жарко?", follower)
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+    # ответ получен чужим запросом: история уходит целиком, без previous_response_id
+    prev, items = calls[1]
+    assert prev is None and len(items) == 3
+    assert conversations.context(leader)[0] == "resp_1"
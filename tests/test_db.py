@@ -0,0 +1,119 @@
+import asyncio
+
+from sqlalchemy import func, select
+
+import db
+from db import AsyncSessionLocal, Transaction, User
+
+
+def run(coro):
+    async def main():
+        try:
+            await db.init_db()
+            return await coro
+        finally:
+            # соединения aiosqlite привязаны к циклу событий теста
+            await db.engine.dispose()
+    return asyncio.run(main())
+
+
+async def _user_with_balance(tg_id: int, balance: int, warm: bool = True) -> None:
+    async with AsyncSessionLocal() as session:
+        session.add(User(tg_id=tg_id, balance_rub=balance))
+        await session.commit()
+    db.invalidate_access(tg_id)
+    if warm:
+        # снимок «сегодня не списано» в кэше: все параллельные вызовы дойдут до списания
+        await db.get_access_snapshot(tg_id)
+
+
+async def _state(tg_id: int) -> tuple[int, int]:
+    async with AsyncSessionLocal() as session:
+        balance = (await session.execute(select(User.balance_rub).where(User.tg_id == tg_id))).scalar_one()
+        charges = (await session.execute(
+            select(func.count()).select_from(Transaction)
+            .where(Transaction.user_tg == tg_id, Transaction.kind == "daily")
+        )).scalar_one()
+    return balance, charges
+
+
+# сотни одновременных вызовов — как пачка сообщений одного пользователя в начале дня
+CALLS = 300
+
+
+async def _hammer(tg_id: int, start: int, *, max_batch: int, window: float, warm: bool = True) -> tuple[list, tuple]:
+    await _user_with_balance(tg_id, start, warm)
+    saved = db.ledger.window, db.ledger.max_batch
+    db.ledger.window, db.ledger.max_batch = window, max_batch
+    try:
+        results = await asyncio.gather(*(db.ensure_access_with_wallet_daily(tg_id) for _ in range(CALLS)))
+    finally:
+        db.ledger.window, db.ledger.max_batch = saved
+    return results, await _state(tg_id)
+
+
+def _assert_charged_once(results: list, balance: int, charges: int, start: int) -> None:
+    assert len(results) == CALLS
+    assert all(r["allowed"] for r in results)
+    reasons = [r["reason"] for r in results]
+    assert reasons.count("charged") == 1
+    assert reasons.count("already_charged") == CALLS - 1
+    assert charges == 1
+    assert balance == start - db.daily_price_rub()
+
+
+def test_concurrent_daily_charge_is_taken_once():
+    tg_id, start = 1001, 10
+
+    async def scenario():
+        await _user_with_balance(tg_id, start)
+        results = await asyncio.gather(
+            db.ensure_access_with_wallet_daily(tg_id),
+            db.ensure_access_with_wallet_daily(tg_id),
+        )
+        return results, await _state(tg_id)
+
+    results, (balance, charges) = run(scenario())
+    assert all(r["allowed"] for r in results)
+    assert sorted(r["reason"] for r in results) == ["already_charged", "charged"]
+    assert charges == 1
+    assert balance == start - db.daily_price_rub()
+
+
+def test_hundreds_of_daily_charges_in_one_ledger_batch():
+    # все списания попадают в одну пачку и одну транзакцию журнала
+    tg_id, start = 1004, 10
+    results, (balance, charges) = run(_hammer(tg_id, start, max_batch=CALLS, window=0.05))
+    _assert_charged_once(results, balance, charges, start)
+
+
+def test_concurrent_daily_charge_in_separate_batches():
+    # каждый вызов в своей пачке журнала: защищает сам условный UPDATE, а не склейка пачки
+    tg_id, start = 1002, 10
+    results, (balance, charges) = run(_hammer(tg_id, start, max_batch=1, window=0))
+    _assert_charged_once(results, balance, charges, start)
+
+
+def test_hundreds_of_daily_charges_with_cold_access_cache():
+    # снимка в кэше нет: все вызовы сначала читают БД, а списывает всё равно только один
+    tg_id, start = 1005, 10
+    for max_batch, window in ((CALLS, 0.05), (1, 0)):
+        results, (balance, charges) = run(_hammer(tg_id, start, max_batch=max_batch, window=window, warm=False))
+        _assert_charged_once(results, balance, charges, start)
+        tg_id += 1
+
+
+def test_daily_charge_without_money_is_refused():
+    tg_id = 1003
+
+    async def scenario():
+        await _user_with_balance(tg_id, 0)
+        results = await asyncio.gather(
+            db.ensure_access_with_wallet_daily(tg_id),
+            db.ensure_access_with_wallet_daily(tg_id),
+        )
+        return results, await _state(tg_id)
+
+    results, (balance, charges) = run(scenario())
+    assert [r["reason"] for r in results] == ["no_balance", "no_balance"]
+    assert (balance, charges) == (0, 0)
@@ -0,0 +1,34 @@
+import asyncio
+from io import BytesIO
+
+from PIL import Image
+
+import imageprep
+
+
+def _jpeg(size: int) -> bytes:
+    out = BytesIO()
+    Image.effect_noise((size, size), 64).convert("RGB").save(out, format="JPEG", quality=95)
+    return out.getvalue()
+
+
+def test_prepare_image_counts_bytes_and_latency_in_a_spawned_pool(monkeypatch):
+    monkeypatch.setattr(imageprep, "prep_counters", dict.fromkeys(imageprep.prep_counters, 0))
+    data = _jpeg(2048)
+
+    async def scenario():
+        try:
+            result = await imageprep.prepare_image(data)
+            return result, imageprep._get_pool()._mp_context.get_start_method()
+        finally:
+            imageprep.shutdown_image_pool()
+
+    result, method = asyncio.run(scenario())
+    stats = imageprep.image_prep_stats()
+
+    assert method == "spawn"
+    assert len(result) < len(data)
+    assert stats["images"] == 1 and stats["errors"] == 0
+    assert stats["bytes_in"] == len(data) and stats["bytes_out"] == len(result)
+    assert stats["bytes_saved"] == len(data) - len(result)
+    assert stats["max_ms"] > 0 and stats["avg_ms"] == stats["max_ms"]
@@ -0,0 +1,156 @@
+import os
+import subprocess
+import sys
+import textwrap
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+import db
+import storage
+import usage
+from conftest import ROOT
+
+PG = postgresql.dialect()
+
+
+@pytest.fixture
+def pg_statements(monkeypatch):
+    # билдеры выбирают INSERT по движку процесса (в тестах это SQLite) — подменяем на PostgreSQL
+    for module in (db, storage, usage):
+        monkeypatch.setattr(module, "dialect_insert", pg_insert)
+
+
+def _sql(stmt) -> str:
+    return " ".join(str(stmt.compile(dialect=PG)).split())
+
+
+def test_engine_options_for_postgres_profile(monkeypatch):
+    monkeypatch.setattr(db, "DB_PROFILE", "postgres")
+    options = db._engine_options()
+
+    assert options["pool_pre_ping"] is True
+    assert options["pool_recycle"] == db.DB_POOL_RECYCLE
+    assert options["pool_size"] == db.DB_POOL_SIZE
+    assert options["max_overflow"] == db.DB_MAX_OVERFLOW
+    assert options["pool_timeout"] == db.DB_POOL_TIMEOUT
+    # аргументы asyncpg.connect
+    assert options["connect_args"]["command_timeout"] == 30
+    assert options["connect_args"]["server_settings"] == {"application_name": "hangman-bot", "jit": "off"}
+
+
+def test_ledger_credit_compiles_for_postgres(pg_statements):
+    sql = _sql(db._credit_insert({"tg_id": 1, "kind": "topup", "amount": 100, "charge_id": "c1"}))
+    assert sql.startswith("INSERT INTO transactions")
+    assert "ON CONFLICT (charge_id) DO NOTHING RETURNING transactions.id" in sql
+
+
+def test_fsm_upsert_compiles_for_postgres(pg_statements):
+    stmt = storage.SQLStorage(state_ttl=60)._upsert("fsm:1", "state", "Chat:waiting", datetime.utcnow())
+    sql = _sql(stmt)
+    assert "ON CONFLICT (key) DO UPDATE SET state = " in sql
+    # вторая колонка сохраняется, только если запись не брошена
+    assert "data = CASE WHEN (fsm_states.updated_at >= " in sql
+    assert "THEN fsm_states.data ELSE " in sql
+
+
+def test_usage_upsert_compiles_for_postgres(pg_statements):
+    acc = dict(day="2026-01-01", tg_id=1, lane="text", calls=1,
+               input_tokens=10, cached_tokens=5, output_tokens=3, latency_ms=40)
+    sql = _sql(usage._daily_upsert(acc))
+    assert "ON CONFLICT (day, tg_id, lane) DO UPDATE SET" in sql
+    for field in ("calls", "input_tokens", "cached_tokens", "output_tokens", "latency_ms"):
+        assert f"{field} = (usage_daily.{field} + excluded.{field})" in sql
+
+
+def test_ledger_opening_migration_compiles_for_postgres():
+    sql = _sql(db._LEDGER_OPENING_SQL)
+    assert "'opening:' || tg_id" in sql
+    assert "CURRENT_TIMESTAMP" in sql
+
+
+# Живая проверка: отдельный процесс, потому что движок создаётся из DB_URL при импорте db
+_SMOKE = textwrap.dedent("""
+    import asyncio
+    import random
+    from types import SimpleNamespace
+
+    from aiogram.fsm.storage.base import StorageKey
+    from sqlalchemy import delete, select, text
+
+    import db
+    from db import AsyncSessionLocal, Transaction, User
+    from photos import SQLPhotoStore
+    from storage import SQLStorage
+    from usage import usage_recorder
+
+
+    async def main():
+        try:
+            await db.init_db()
+            await db.init_db()  # повторный старт: миграции не падают и не повторяются
+            assert db.engine.dialect.name == "postgresql"
+            tg_id = random.randint(10**12, 10**13)
+
+            async with AsyncSessionLocal() as session:
+                assert await db.credit_balance(session, tg_id, 10, charge_id=f"smoke:{tg_id}") == 10
+            async with AsyncSessionLocal() as session:
+                assert await db.credit_balance(session, tg_id, 10, charge_id=f"smoke:{tg_id}") == 10
+            assert (await db.ensure_access_with_wallet_daily(tg_id))["reason"] == "charged"
+            assert (await db.ensure_access_with_wallet_daily(tg_id))["reason"] == "already_charged"
+
+            # перенос старых балансов в журнал: || с bigint
+            other = tg_id + 1
+            async with AsyncSessionLocal() as session:
+                session.add(User(tg_id=other, balance_rub=7))
+                await session.execute(text("DELETE FROM migrations WHERE name = 'ledger_opening'"))
+                await session.commit()
+            async with db.engine.begin() as conn:
+                await conn.run_sync(db._migrate_ledger_opening)
+            async with AsyncSessionLocal() as session:
+                charge = (await session.execute(
+                    select(Transaction.charge_id).where(Transaction.user_tg == other)
+                )).scalar_one()
+                assert charge == f"opening:{other}", charge
+
+            fsm = SQLStorage(cache_ttl=0)
+            key = StorageKey(bot_id=1, chat_id=tg_id, user_id=tg_id)
+            await fsm.set_state(key, "Chat:waiting")
+            await fsm.set_data(key, {"a": 1})
+            assert await fsm.get_state(key) == "Chat:waiting"
+            assert await fsm.get_data(key) == {"a": 1}
+            await fsm.set_state(key, None)
+            await fsm.set_data(key, {})
+
+            usage = SimpleNamespace(input_tokens=10, output_tokens=2,
+                                    input_tokens_details=SimpleNamespace(cached_tokens=4))
+            usage_recorder.record(tg_id, "text", "smoke", usage, 0.1)
+            usage_recorder.record(tg_id, "text", "smoke", usage, 0.1)
+            await usage_recorder.flush()
+
+            photos = SQLPhotoStore(600)
+            assert await photos.pop(await photos.put(b"jpeg")) == b"jpeg"
+
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(Transaction).where(Transaction.user_tg.in_([tg_id, other])))
+                await session.execute(delete(User).where(User.tg_id.in_([tg_id, other])))
+                await session.commit()
+        finally:
+            await db.engine.dispose()
+
+
+    asyncio.run(main())
+    print("ok")
+""")
+
+
+@pytest.mark.skipif(not os.getenv("TEST_PG_URL"), reason="TEST_PG_URL не задан")
+def test_live_postgres_smoke():
+    env = {**os.environ, "DB_URL": os.environ["TEST_PG_URL"], "FSM_STORAGE": "sql", "METRICS_PORT": "0"}
+    proc = subprocess.run([sys.executable, "-c", _SMOKE], cwd=ROOT, env=env,
+                          capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip().endswith("ok")
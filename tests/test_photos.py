@@ -0,0 +1,42 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+import db
+from db import AsyncSessionLocal, PendingPhoto
+from photos import SQLPhotoStore
+
+
+def run(coro):
+    async def main():
+        try:
+            await db.init_db()
+            return await coro
+        finally:
+            await db.engine.dispose()
+    return asyncio.run(main())
+
+
+def test_pending_photo_survives_restart_and_is_taken_once():
+    async def scenario():
+        key = await SQLPhotoStore(600).put(b"jpeg")
+        # другой процесс или перезапуск — новый экземпляр, та же БД
+        other = SQLPhotoStore(600)
+        return await other.pop(key), await other.pop(key)
+
+    assert run(scenario()) == (b"jpeg", None)
+
+
+def test_expired_photo_is_not_returned_and_is_purged():
+    async def scenario():
+        store = SQLPhotoStore(600)
+        expired, purged_key = await store.put(b"old"), await store.put(b"old too")
+        async with AsyncSessionLocal() as session:
+            await session.execute(update(PendingPhoto).values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+            await session.commit()
+        photo = await store.pop(expired)
+        purged = await store.purge_expired()
+        return photo, purged, await store.pop(purged_key)
+
+    assert run(scenario()) == (None, 1, None)
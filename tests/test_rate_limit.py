@@ -0,0 +1,49 @@
+import asyncio
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.types import Chat, Message, Update, User
+from sqlalchemy import event
+
+import db
+import main
+
+
+def _text_update(update_id: int, tg_id: int, text: str) -> Update:
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=datetime.now(), text=text,
+        chat=Chat(id=tg_id, type="private"), from_user=User(id=tg_id, is_bot=False, first_name="u"),
+    ))
+
+
+def test_throttled_update_does_not_touch_the_database():
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    async def scenario():
+        await db.init_db()
+        dp = main.build_dispatcher(fsm_cache=False)
+        bot = Bot("42:TEST")
+        limiter = main.rate_limit_middleware
+        throttled, spammer, other = limiter.throttled, 9001, 9002
+        # ведро text исчерпано, о превышении уже предупредили — ответа в Telegram не будет
+        while limiter.hit(spammer, "text")[0]:
+            pass
+        event.listen(db.engine.sync_engine, "before_cursor_execute", count)
+        try:
+            await dp.feed_update(bot, _text_update(1, spammer, "ещё вопрос"))
+            blocked = list(statements)
+            # тот же путь без лимита читает состояние FSM из БД
+            await dp.feed_update(bot, _text_update(2, other, "/nothing"))
+        finally:
+            event.remove(db.engine.sync_engine, "before_cursor_execute", count)
+            await bot.session.close()
+            await db.engine.dispose()
+        return blocked, limiter.throttled - throttled
+
+    blocked, throttled = asyncio.run(scenario())
+    assert throttled == 1
+    assert blocked == []
+    assert any("fsm_states" in s for s in statements)
@@ -0,0 +1,89 @@
+import asyncio
+import multiprocessing as mp
+import time
+from functools import partial
+
+import workers
+
+
+def _update(update_id: int, hang: bool = False) -> dict:
+    return {"update_id": update_id, "message": {"from": {"id": 7}, "text": "hang" if hang else "ok"}}
+
+
+def echo_worker(out, index, total, queue, heartbeat, taken) -> None:
+    asyncio.run(_echo_loop(out, queue, heartbeat, taken))
+
+
+async def _echo_loop(out, queue, heartbeat, taken) -> None:
+    # как _worker_loop: чтение очереди в потоке, обработка — задачами в event loop
+    async def beat():
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(0.05)
+
+    async def handle(update):
+        if update["message"]["text"] == "hang":
+            out.put(("hang", update["update_id"]))
+            time.sleep(3600)  # зависший event loop: поток уже ждёт в queue.get
+        out.put(update["update_id"])
+
+    loop = asyncio.get_running_loop()
+    beat_task = asyncio.create_task(beat())
+    tasks = set()
+    while True:
+        update = await loop.run_in_executor(None, workers._take, queue, taken)
+        if update is None:
+            break
+        task = asyncio.create_task(handle(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    beat_task.cancel()
+
+
+def test_killed_worker_is_replaced_and_gets_next_updates(monkeypatch):
+    monkeypatch.setattr(workers, "WORKER_HEARTBEAT", 0.1)
+    monkeypatch.setattr(workers, "WORKER_HEARTBEAT_TIMEOUT", 1.0)
+    out = mp.get_context("spawn").Queue()
+    supervisor = workers.Supervisor(1, target=partial(echo_worker, out))
+
+    async def recv(timeout: float = 30):
+        return await asyncio.get_running_loop().run_in_executor(None, out.get, True, timeout)
+
+    async def scenario():
+        supervisor.start()
+        monitor = asyncio.create_task(supervisor.monitor())
+        try:
+            await supervisor.dispatch(_update(1))
+            assert await recv() == 1
+            await supervisor.dispatch(_update(2, hang=True))
+            assert await recv() == ("hang", 2)
+            # третий апдейт забирает поток зависшего воркера — он пропадёт вместе с процессом,
+            # четвёртый остаётся в очереди и должен дойти до нового поколения
+            await supervisor.dispatch(_update(3))
+            await supervisor.dispatch(_update(4))
+            assert await recv() == 4
+            await supervisor.dispatch(_update(5))
+            assert await recv() == 5
+            assert supervisor.restarts == 1
+            assert supervisor.redispatched == 1
+        finally:
+            monitor.cancel()
+            await asyncio.gather(monitor, return_exceptions=True)
+            supervisor.stop()
+
+    asyncio.run(scenario())
+
+
+def dead_worker(index, total, queue, heartbeat, taken) -> None:
+    pass
+
+
+def test_stop_does_not_hang_on_a_full_queue_of_a_dead_worker(monkeypatch):
+    monkeypatch.setattr(workers, "WORKER_QUEUE_SIZE", 1)
+    supervisor = workers.Supervisor(1, target=dead_worker)
+    supervisor.start()
+    supervisor.procs[0].join(30)
+    supervisor.queues[0].put((1, _update(1)))
+    started = time.monotonic()
+    supervisor.stop()
+    assert time.monotonic() - started < 5
@@ -0,0 +1,185 @@
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, delete
+
+from db import AsyncSessionLocal, TextCacheEntry
+
+# Время жизни ответа в кэше (сек) и максимум записей
+TEXT_CACHE_TTL = int(os.getenv("TEXT_CACHE_TTL", str(7 * 24 * 3600)))
+TEXT_CACHE_SIZE = int(os.getenv("TEXT_CACHE_SIZE", "20000"))
+# Порог похожести по триграммам (коэффициент Жаккара), 0 — только точные совпадения
+TEXT_CACHE_SIMILARITY = float(os.getenv("TEXT_CACHE_SIMILARITY", "0.85"))
+
+# Признаки личного вопроса: местоимения от первого лица и цифры (вес, рост, возраст)
+_PERSONAL_RE = re.compile(r"\b(я|мне|меня|мной|мой|моя|моё|мое|мои|моего|моей|моих|у меня)\b|\d")
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def is_personal(norm_text: str) -> bool:
+    return bool(_PERSONAL_RE.search(norm_text))
+
+
+def _trigrams(norm_text: str) -> set[str]:
+    padded = f"  {norm_text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _key(norm_text: str) -> str:
+    return hashlib.sha256(norm_text.encode("utf-8")).hexdigest()
+
+
+class TextCache:
+    """
+    Кэш ответов GPT_text: сначала точное совпадение по хэшу нормализованного
+    вопроса, затем (если включено) поиск близкой перефразировки по триграммам.
+    Хранится в таблице text_cache, в памяти — индекс и LRU-порядок.
+    """
+
+    def __init__(self, ttl: int, max_size: int, similarity: float):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.similarity = similarity
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.lookup_seconds = 0.0
+        # key -> (trigrams, result, expires_at); порядок — LRU
+        self._entries: "OrderedDict[str, tuple[set[str], str, float]]" = OrderedDict()
+        self._by_trigram: dict[str, set[str]] = {}
+        self._loaded = False
+
+    def _add(self, key: str, grams: set[str], result: str, expires_at: float) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (grams, result, expires_at)
+        if self.similarity > 0:
+            for gram in grams:
+                self._by_trigram.setdefault(gram, set()).add(key)
+
+    def _remove(self, key: str) -> None:
+        grams, _, _ = self._entries.pop(key)
+        for gram in grams:
+            keys = self._by_trigram.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_trigram[gram]
+
+    def _alive(self, key: str) -> Optional[str]:
+        grams, result, expires_at = self._entries[key]
+        if expires_at < time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def _find_similar(self, grams: set[str]) -> Optional[str]:
+        counts: dict[str, int] = {}
+        for gram in grams:
+            for key in self._by_trigram.get(gram, ()):
+                counts[key] = counts.get(key, 0) + 1
+        best_key, best_score = None, self.similarity
+        for key, common in counts.items():
+            other = self._entries[key][0]
+            score = common / (len(grams) + len(other) - common)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    async def load(self) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(TextCacheEntry).where(TextCacheEntry.expires_at < datetime.utcnow())
+            )
+            res = await session.execute(
+                select(TextCacheEntry)
+                .order_by(TextCacheEntry.created_at.desc())
+                .limit(self.max_size)
+            )
+            rows = list(res.scalars())
+            await session.commit()
+        now_wall, now_dt = time.time(), datetime.utcnow()
+        for row in reversed(rows):
+            expires_at = now_wall + (row.expires_at - now_dt).total_seconds()
+            self._add(row.key, _trigrams(row.norm_text), row.result, expires_at)
+        self._loaded = True
+
+    async def get(self, text: str) -> Optional[str]:
+        """Ответ из кэша или None. Личные вопросы кэш не используют."""
+        started = time.perf_counter()
+        try:
+            norm = normalize_question(text)
+            if not norm or is_personal(norm):
+                self.bypassed += 1
+                return None
+            if not self._loaded:
+                await self.load()
+            key = _key(norm)
+            if key in self._entries:
+                result = self._alive(key)
+                if result is not None:
+                    self.hits += 1
+                    return result
+            if self.similarity > 0:
+                similar = self._find_similar(_trigrams(norm))
+                if similar is not None:
+                    result = self._alive(similar)
+                    if result is not None:
+                        self.near_hits += 1
+                        return result
+            self.misses += 1
+            return None
+        finally:
+            self.lookup_seconds += time.perf_counter() - started
+
+    async def put(self, text: str, result: str) -> None:
+        norm = normalize_question(text)
+        if not norm or is_personal(norm):
+            return
+        key = _key(norm)
+        self._add(key, _trigrams(norm), result, time.time() + self.ttl)
+        evicted = []
+        while len(self._entries) > self.max_size:
+            old_key = next(iter(self._entries))
+            self._remove(old_key)
+            evicted.append(old_key)
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(TextCacheEntry).where(TextCacheEntry.key.in_(evicted + [key]))
+            )
+            session.add(TextCacheEntry(
+                key=key,
+                norm_text=norm,
+                result=result,
+                expires_at=datetime.utcnow() + timedelta(seconds=self.ttl),
+            ))
+            await session.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+            "avg_lookup_ms": self.lookup_seconds * 1000 / (lookups + self.bypassed or 1),
+            "size": len(self._entries),
+        }
+
+
+text_cache = TextCache(TEXT_CACHE_TTL, TEXT_CACHE_SIZE, TEXT_CACHE_SIMILARITY)
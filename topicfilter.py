@@ -0,0 +1,144 @@
+import json
+import logging
+import math
+import os
+import time
+import zlib
+from typing import Optional
+
+from textcache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# Локальный фильтр вопросов не по теме перед GPT_text (0 — выключен)
+TOPIC_FILTER = os.getenv("TOPIC_FILTER", "1") == "1"
+# Файл весов (собирается train_topic.py) и порог уверенности «не по теме»
+TOPIC_FILTER_MODEL = os.getenv("TOPIC_FILTER_MODEL", os.path.join(os.path.dirname(__file__), "topic_model.json"))
+TOPIC_FILTER_THRESHOLD = float(os.getenv("TOPIC_FILTER_THRESHOLD", "0.9"))
+
+DEFAULT_BUCKETS = 1 << 18
+
+
+def features(text: str, buckets: int = DEFAULT_BUCKETS) -> dict[int, float]:
+    """
+    Хэшированные признаки: слова, пары слов и символьные триграммы внутри
+    слов (ловят формы слов: «тренировка», «тренировки», «тренироваться»).
+    Вектор нормирован, чтобы длина вопроса не сдвигала оценку.
+    """
+    words = normalize_question(text).split()
+    grams = [f"w:{w}" for w in words]
+    grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    for w in words:
+        padded = f" {w} "
+        grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    if not grams:
+        return {}
+    mask = buckets - 1
+    vec: dict[int, float] = {}
+    for gram in grams:
+        h = zlib.crc32(gram.encode("utf-8")) & mask
+        vec[h] = vec.get(h, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    return {h: v / norm for h, v in vec.items()}
+
+
+def sigmoid(z: float) -> float:
+    if z < -30:
+        return 0.0
+    if z > 30:
+        return 1.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+class TopicModel:
+    """Линейная модель над хэшированными признаками: вероятность «не по теме»."""
+
+    def __init__(self, weights: dict[int, float], bias: float, buckets: int = DEFAULT_BUCKETS):
+        self.weights = weights
+        self.bias = bias
+        self.buckets = buckets
+
+    def probability(self, text: str) -> float:
+        weights = self.weights
+        z = self.bias
+        for h, v in features(text, self.buckets).items():
+            w = weights.get(h)
+            if w is not None:
+                z += w * v
+        return sigmoid(z)
+
+    @classmethod
+    def load(cls, path: str) -> "TopicModel":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        weights = {int(h): float(w) for h, w in data["weights"].items()}
+        return cls(weights, float(data["bias"]), int(data.get("buckets", DEFAULT_BUCKETS)))
+
+    def save(self, path: str, meta: Optional[dict] = None) -> None:
+        data = {
+            "version": 1,
+            "buckets": self.buckets,
+            "bias": round(self.bias, 6),
+            "meta": meta or {},
+            # нулевые веса не храним: файл остаётся маленьким
+            "weights": {str(h): round(w, 6) for h, w in sorted(self.weights.items()) if abs(w) >= 1e-6},
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            f.write("\n")
+
+
+class TopicFilter:
+    """
+    Отсекает вопросы не по теме до запроса в OpenAI: если модель уверена
+    (вероятность не ниже порога), бот сразу отвечает заготовленным отказом.
+    Всё сомнительное пропускается дальше — там решит сама модель по INSTRUCTIONS.
+    Без файла весов фильтр молча выключается.
+    """
+
+    def __init__(self, path: str, threshold: float, enabled: bool = True):
+        self.path = path
+        self.threshold = threshold
+        self.enabled = enabled
+        self.checked = 0
+        self.refused = 0
+        self.seconds = 0.0
+        self._model: Optional[TopicModel] = None
+        self._loaded = False
+
+    def _get_model(self) -> Optional[TopicModel]:
+        if not self._loaded:
+            self._loaded = True
+            try:
+                self._model = TopicModel.load(self.path)
+            except FileNotFoundError:
+                logger.warning("Нет файла весов фильтра тем %s — фильтр выключен", self.path)
+            except Exception:
+                logger.exception("Не удалось загрузить веса фильтра тем %s — фильтр выключен", self.path)
+        return self._model
+
+    def is_off_topic(self, text: str) -> bool:
+        if not self.enabled or not text:
+            return False
+        model = self._get_model()
+        if model is None:
+            return False
+        started = time.perf_counter()
+        off_topic = model.probability(text) >= self.threshold
+        self.seconds += time.perf_counter() - started
+        self.checked += 1
+        if off_topic:
+            self.refused += 1
+        return off_topic
+
+    def stats(self) -> dict:
+        return {
+            "enabled": int(self.enabled and self._get_model() is not None),
+            "checked": self.checked,
+            "refused": self.refused,
+            "avg_us": self.seconds / self.checked * 1e6 if self.checked else 0.0,
+            "threshold": self.threshold,
+        }
+
+
+topic_filter = TopicFilter(TOPIC_FILTER_MODEL, TOPIC_FILTER_THRESHOLD, TOPIC_FILTER)
@@ -0,0 +1,125 @@
+"""
+Обучение и проверка локального фильтра вопросов не по теме (topicfilter.py).
+
+    python train_topic.py topic_train.jsonl                 # кросс-валидация + веса в topic_model.json
+    python train_topic.py topic_train.jsonl --out new.json --epochs 30
+    python train_topic.py my_labeled.jsonl --eval topic_model.json   # только отчёт по готовым весам
+
+Формат JSONL: одна строка — {"text": "...", "label": "off"} или {"text": "...", "label": "on"}
+(off — не по теме, бот откажет сам; on — вопрос для ассистента).
+
+Отчёт — точность (precision) и полнота (recall) класса «не по теме» на
+нескольких порогах. Для TOPIC_FILTER_THRESHOLD важнее точность: ложный
+отказ на вопрос по теме хуже, чем лишний запрос в OpenAI.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from topicfilter import DEFAULT_BUCKETS, TOPIC_FILTER_THRESHOLD, TopicModel, features, sigmoid
+
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95)
+
+
+def load_dataset(path: str) -> list[tuple[str, int]]:
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            label = item["label"]
+            if label not in ("on", "off"):
+                raise ValueError(f"{path}:{lineno}: label должен быть on или off, а не {label!r}")
+            rows.append((item["text"], int(label == "off")))
+    return rows
+
+
+def train(rows: list[tuple[str, int]], epochs: int, lr: float, l2: float, buckets: int, seed: int) -> TopicModel:
+    """Логистическая регрессия, SGD по одному примеру; L2 — только на задетых весах."""
+    data = [(features(text, buckets), label) for text, label in rows]
+    rng = random.Random(seed)
+    weights: dict[int, float] = {}
+    bias = 0.0
+    for epoch in range(epochs):
+        rng.shuffle(data)
+        step = lr / (1 + epoch * 0.1)
+        for vec, label in data:
+            z = bias + sum(weights.get(h, 0.0) * v for h, v in vec.items())
+            g = sigmoid(z) - label
+            for h, v in vec.items():
+                w = weights.get(h, 0.0)
+                weights[h] = w - step * (g * v + l2 * w)
+            bias -= step * g
+    return TopicModel(weights, bias, buckets)
+
+
+def cross_val(rows: list[tuple[str, int]], folds: int, **kw) -> list[tuple[float, int]]:
+    """Вероятности для каждого примера от модели, которая его не видела."""
+    order = list(range(len(rows)))
+    random.Random(kw["seed"]).shuffle(order)
+    scored = []
+    for k in range(folds):
+        held = set(order[k::folds])
+        model = train([r for i, r in enumerate(rows) if i not in held], **kw)
+        scored += [(model.probability(rows[i][0]), rows[i][1]) for i in sorted(held)]
+    return scored
+
+
+def report(scored: list[tuple[float, int]], current: float = TOPIC_FILTER_THRESHOLD) -> str:
+    positives = sum(label for _, label in scored)
+    lines = [
+        f"примеров {len(scored)}: не по теме {positives}, по теме {len(scored) - positives}",
+        "порог   precision  recall  ложных отказов  отсечено",
+    ]
+    for threshold in sorted(set(THRESHOLDS) | {current}):
+        tp = sum(1 for p, label in scored if p >= threshold and label)
+        fp = sum(1 for p, label in scored if p >= threshold and not label)
+        precision = tp / (tp + fp) if tp + fp else 1.0
+        recall = tp / positives if positives else 0.0
+        mark = "  <- TOPIC_FILTER_THRESHOLD" if threshold == current else ""
+        lines.append(f"{threshold:<7} {precision:<10.3f} {recall:<7.3f} {fp:<15} {tp + fp}{mark}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="размеченный JSONL")
+    parser.add_argument("--out", default="topic_model.json", help="куда сохранить веса")
+    parser.add_argument("--eval", metavar="MODEL", help="не обучать, а проверить готовые веса на dataset")
+    parser.add_argument("--threshold", type=float, default=TOPIC_FILTER_THRESHOLD)
+    parser.add_argument("--epochs", type=int, default=40)
+    parser.add_argument("--lr", type=float, default=1.0)
+    parser.add_argument("--l2", type=float, default=1e-5)
+    parser.add_argument("--folds", type=int, default=5, help="кросс-валидация (0 — без неё)")
+    parser.add_argument("--buckets", type=int, default=DEFAULT_BUCKETS)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rows = load_dataset(args.dataset)
+    if args.eval:
+        model = TopicModel.load(args.eval)
+        print(report([(model.probability(text), label) for text, label in rows], args.threshold))
+        return
+
+    if args.buckets & (args.buckets - 1):
+        sys.exit("--buckets должен быть степенью двойки")
+    kw = dict(epochs=args.epochs, lr=args.lr, l2=args.l2, buckets=args.buckets, seed=args.seed)
+    if args.folds > 1:
+        print(f"кросс-валидация, {args.folds} фолдов")
+        print(report(cross_val(rows, args.folds, **kw), args.threshold))
+
+    model = train(rows, **kw)
+    t0 = time.perf_counter()
+    for text, _ in rows:
+        model.probability(text)
+    per_call = (time.perf_counter() - t0) / len(rows) * 1e6
+    model.save(args.out, meta={"dataset": args.dataset, "examples": len(rows), **kw})
+    print(f"веса: {args.out} ({len(model.weights)} ненулевых), оценка одного вопроса ~{per_call:.0f} мкс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import Any, Optional
+
+from sqlalchemy import func, insert, select
+
+from db import AsyncSessionLocal, UsageDaily, UsageRecord, dialect_insert
+
+logger = logging.getLogger(__name__)
+
+# Как часто сбрасываем накопленные записи в БД, размер пачки и предел очереди в памяти
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "2"))
+USAGE_BATCH_MAX = int(os.getenv("USAGE_BATCH_MAX", "500"))
+USAGE_MAX_PENDING = int(os.getenv("USAGE_MAX_PENDING", "20000"))
+
+
+def _cache_ratio(input_tokens: int, cached_tokens: int) -> float:
+    return cached_tokens / input_tokens if input_tokens else 0.0
+
+
+def _daily_upsert(acc: dict):
+    # суточные суммы копятся на стороне БД: несколько процессов пишут в одну строку
+    stmt = dialect_insert(UsageDaily).values(**acc)
+    return stmt.on_conflict_do_update(
+        index_elements=[UsageDaily.day, UsageDaily.tg_id, UsageDaily.lane],
+        set_={
+            field: getattr(UsageDaily, field) + getattr(stmt.excluded, field)
+            for field in ("calls", "input_tokens", "cached_tokens", "output_tokens", "latency_ms")
+        },
+    )
+
+
+class UsageRecorder:
+    """
+    Учёт токенов OpenAI. record() ничего не ждёт: запись копится в памяти и
+    раз в USAGE_FLUSH_INTERVAL уходит в БД одной транзакцией — строки в
+    usage_log и приращения дневной сводки usage_daily. Если БД недоступна
+    дольше, чем помещается в USAGE_MAX_PENDING, старые записи теряются
+    (счётчик dropped): учёт не должен тормозить ответы.
+    """
+
+    def __init__(self, interval: float, max_batch: int, max_pending: int):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        # lane -> [calls, input, cached, output] с момента старта процесса
+        self.totals: dict[str, list[int]] = {}
+        self._pending: list[dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def record(self, tg_id: Optional[int], lane: str, model: str, usage: Any, seconds: float) -> None:
+        if usage is None:
+            return
+        details = getattr(usage, "input_tokens_details", None)
+        row = dict(
+            tg_id=tg_id or 0,
+            lane=lane,
+            model=model,
+            input_tokens=getattr(usage, "input_tokens", 0) or 0,
+            cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+            output_tokens=getattr(usage, "output_tokens", 0) or 0,
+            latency_ms=int(seconds * 1000),
+            created_at=datetime.utcnow(),
+        )
+        totals = self.totals.setdefault(lane, [0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += row["input_tokens"]
+        totals[2] += row["cached_tokens"]
+        totals[3] += row["output_tokens"]
+
+        self._pending.append(row)
+        if len(self._pending) > self.max_pending:
+            overflow = len(self._pending) - self.max_pending
+            del self._pending[:overflow]
+            self.dropped += overflow
+        if self._task is None or self._task.done():
+            # пустой контекст: запись пачки не засчитывается апдейту, который её открыл
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self) -> None:
+        while self._pending:
+            if not self._closing and len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.interval)
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                await self._write(batch)
+            except Exception:
+                logger.exception("Не удалось записать учёт токенов (%d записей)", len(batch))
+                self.dropped += len(batch)
+
+    @staticmethod
+    def _rollup(batch: list[dict]) -> list[dict]:
+        rollup: dict[tuple, dict] = {}
+        for row in batch:
+            key = (row["created_at"].strftime("%Y-%m-%d"), row["tg_id"], row["lane"])
+            acc = rollup.get(key)
+            if acc is None:
+                acc = rollup[key] = dict(day=key[0], tg_id=key[1], lane=key[2], calls=0,
+                                         input_tokens=0, cached_tokens=0, output_tokens=0, latency_ms=0)
+            acc["calls"] += 1
+            for field in ("input_tokens", "cached_tokens", "output_tokens", "latency_ms"):
+                acc[field] += row[field]
+        return list(rollup.values())
+
+    async def _write(self, batch: list[dict]) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(insert(UsageRecord), batch)
+            for acc in self._rollup(batch):
+                await session.execute(_daily_upsert(acc))
+            await session.commit()
+        self.batches += 1
+        self.written += len(batch)
+
+    async def flush(self) -> None:
+        """Дописываем всё накопленное (на остановке бота)."""
+        self._closing = True
+        try:
+            if self._task is not None:
+                await self._task
+        finally:
+            self._closing = False
+
+    def stats(self) -> dict:
+        lanes = {}
+        for lane, (calls, input_tokens, cached_tokens, output_tokens) in self.totals.items():
+            lanes[f"{lane}_calls"] = calls
+            lanes[f"{lane}_input_tokens"] = input_tokens
+            lanes[f"{lane}_cached_tokens"] = cached_tokens
+            lanes[f"{lane}_output_tokens"] = output_tokens
+            lanes[f"{lane}_cache_ratio"] = _cache_ratio(input_tokens, cached_tokens)
+        return {**lanes, "written": self.written, "dropped": self.dropped,
+                "batches": self.batches, "pending": len(self._pending)}
+
+
+usage_recorder = UsageRecorder(USAGE_FLUSH_INTERVAL, USAGE_BATCH_MAX, USAGE_MAX_PENDING)
+
+
+async def usage_report(day: str, top: int = 10) -> dict:
+    """Сводка за день: токены и доля кэша по полосам, самые «дорогие» пользователи."""
+    async with AsyncSessionLocal() as session:
+        lanes = await session.execute(
+            select(
+                UsageDaily.lane,
+                func.sum(UsageDaily.calls),
+                func.sum(UsageDaily.input_tokens),
+                func.sum(UsageDaily.cached_tokens),
+                func.sum(UsageDaily.output_tokens),
+                func.sum(UsageDaily.latency_ms),
+            ).where(UsageDaily.day == day).group_by(UsageDaily.lane)
+        )
+        users = await session.execute(
+            select(
+                UsageDaily.tg_id,
+                func.sum(UsageDaily.calls),
+                func.sum(UsageDaily.input_tokens + UsageDaily.output_tokens).label("tokens"),
+            ).where(UsageDaily.day == day).group_by(UsageDaily.tg_id)
+            .order_by(func.sum(UsageDaily.input_tokens + UsageDaily.output_tokens).desc()).limit(top)
+        )
+    return {
+        "day": day,
+        "lanes": {
+            lane: {
+                "calls": calls,
+                "input_tokens": input_tokens,
+                "cached_tokens": cached_tokens,
+                "output_tokens": output_tokens,
+                "cache_ratio": round(_cache_ratio(input_tokens, cached_tokens), 3),
+                "avg_latency_ms": round(latency_ms / calls) if calls else 0,
+            }
+            for lane, calls, input_tokens, cached_tokens, output_tokens, latency_ms in lanes
+        },
+        "top_users": [{"tg_id": tg_id, "calls": calls, "tokens": tokens} for tg_id, calls, tokens in users],
+    }
+
+
+if __name__ == "__main__":
+    # python usage.py [YYYY-MM-DD] — сводка за день (по умолчанию сегодня, UTC)
+    import json
+
+    report_day = sys.argv[1] if len(sys.argv) > 1 else datetime.utcnow().strftime("%Y-%m-%d")
+    print(json.dumps(asyncio.run(usage_report(report_day)), ensure_ascii=False, indent=2))
@@ -0,0 +1,129 @@
+import logging
+import os
+import re
+from collections import OrderedDict
+from itertools import islice
+from typing import Optional
+
+from sqlalchemy import select, delete
+
+from db import AsyncSessionLocal, VisionCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Максимальное расстояние Хэмминга между dHash, при котором фото считаем тем же блюдом
+VISION_CACHE_DISTANCE = int(os.getenv("VISION_CACHE_DISTANCE", "4"))
+# Максимум записей в кэше (LRU)
+VISION_CACHE_SIZE = int(os.getenv("VISION_CACHE_SIZE", "5000"))
+
+_HASH_BITS = 64
+
+
+def normalize_extra(extra_text: Optional[str]) -> str:
+    return re.sub(r"\s+", " ", (extra_text or "").strip().lower())
+
+
+def _to_signed(value: int) -> int:
+    return value - (1 << _HASH_BITS) if value >= 1 << (_HASH_BITS - 1) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << _HASH_BITS) if value < 0 else value
+
+
+class VisionCache:
+    """
+    Кэш ответов по dHash фото + нормализованным уточнениям.
+
+    Поиск близких хэшей — multi-index hashing: хэш режется на distance+1 сегментов,
+    и по принципу Дирихле у любого хэша в пределах distance хотя бы один сегмент
+    совпадает точно. По каждому сегменту держим словарь значение -> id записей.
+    """
+
+    def __init__(self, distance: int, max_size: int):
+        self.distance = distance
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        bounds = [round(i * _HASH_BITS / (distance + 1)) for i in range(distance + 2)]
+        self._segments = list(zip(bounds, bounds[1:]))
+        self._index: list[dict[int, set[int]]] = [{} for _ in self._segments]
+        # id -> (hash, extra_key, result); порядок — от давно использованных к свежим
+        self._entries: "OrderedDict[int, tuple[int, str, str]]" = OrderedDict()
+        self._loaded = False
+
+    def _parts(self, value: int):
+        for start, end in self._segments:
+            yield (value >> start) & ((1 << (end - start)) - 1)
+
+    def _add(self, entry_id: int, value: int, extra_key: str, result: str) -> None:
+        self._entries[entry_id] = (value, extra_key, result)
+        for table, part in zip(self._index, self._parts(value)):
+            table.setdefault(part, set()).add(entry_id)
+
+    def _remove(self, entry_id: int) -> None:
+        value, _, _ = self._entries.pop(entry_id)
+        for table, part in zip(self._index, self._parts(value)):
+            ids = table.get(part)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del table[part]
+
+    def _find(self, value: int, extra_key: str) -> Optional[int]:
+        best_id, best_dist = None, self.distance + 1
+        for table, part in zip(self._index, self._parts(value)):
+            for entry_id in table.get(part, ()):
+                cand, cand_extra, _ = self._entries[entry_id]
+                if cand_extra != extra_key:
+                    continue
+                dist = (cand ^ value).bit_count()
+                if dist < best_dist:
+                    best_id, best_dist = entry_id, dist
+        return best_id
+
+    async def load(self) -> None:
+        """Поднимаем кэш из таблицы vision_cache (вызывается на старте)."""
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                select(VisionCacheEntry)
+                .order_by(VisionCacheEntry.created_at.desc())
+                .limit(self.max_size)
+            )
+            rows = list(res.scalars())
+        for row in reversed(rows):
+            self._add(row.id, _to_unsigned(row.dhash), row.extra_key, row.result)
+        self._loaded = True
+
+    async def get(self, value: int, extra_text: Optional[str]) -> Optional[str]:
+        if not self._loaded:
+            await self.load()
+        entry_id = self._find(value, normalize_extra(extra_text))
+        if entry_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(entry_id)
+        return self._entries[entry_id][2]
+
+    async def put(self, value: int, extra_text: Optional[str], result: str) -> None:
+        extra_key = normalize_extra(extra_text)
+        # память меняем только после коммита: при ошибке БД кэш не расходится с таблицей
+        evicted = list(islice(self._entries, max(len(self._entries) + 1 - self.max_size, 0)))
+        async with AsyncSessionLocal() as session:
+            row = VisionCacheEntry(dhash=_to_signed(value), extra_key=extra_key, result=result)
+            session.add(row)
+            if evicted:
+                await session.execute(delete(VisionCacheEntry).where(VisionCacheEntry.id.in_(evicted)))
+            await session.commit()
+        for old_id in evicted:
+            # параллельный put мог вытеснить ту же запись
+            if old_id in self._entries:
+                self._remove(old_id)
+        self._add(row.id, value, extra_key, result)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+vision_cache = VisionCache(VISION_CACHE_DISTANCE, VISION_CACHE_SIZE)
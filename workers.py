@@ -0,0 +1,257 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import time
+from collections import deque
+from queue import Full
+from typing import Any, Callable, Optional
+
+from aiogram import Bot
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Как часто воркер отмечается, и через сколько секунд тишины его перезапускаем
+WORKER_HEARTBEAT = float(os.getenv("WORKER_HEARTBEAT", "5"))
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv("WORKER_HEARTBEAT_TIMEOUT", "60"))
+# Сколько секунд даём воркеру на импорт и startup до первой отметки
+WORKER_START_GRACE = float(os.getenv("WORKER_START_GRACE", "60"))
+# Размер очереди апдейтов одного воркера
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+
+
+def update_user_id(update: dict[str, Any]) -> int:
+    """tg_id пользователя из сырого апдейта (0 — если апдейт без пользователя)."""
+    for name, value in update.items():
+        if name == "update_id" or not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            who = value.get(field)
+            if isinstance(who, dict) and "id" in who:
+                return who["id"]
+    return 0
+
+
+# ---------- Воркер ----------
+def _worker_main(index: int, workers: int, queue: mp.Queue, heartbeat, taken) -> None:
+    asyncio.run(_worker_loop(index, workers, queue, heartbeat, taken))
+
+
+def _take(queue: mp.Queue, taken) -> Optional[dict]:
+    """Следующий апдейт из очереди (None — стоп); номер забранного видит супервизор."""
+    item = queue.get()
+    if item is None:
+        return None
+    seq, update = item
+    taken.value = seq
+    return update
+
+
+async def _handle(dp, bot: Bot, update: dict, prev: Optional[asyncio.Task]) -> None:
+    # апдейты одного пользователя обрабатываем строго по порядку
+    if prev is not None:
+        await asyncio.gather(prev, return_exceptions=True)
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception:
+        logger.exception("Ошибка обработки апдейта %s", update.get("update_id"))
+
+
+async def _worker_loop(index: int, workers: int, queue: mp.Queue, heartbeat, taken) -> None:
+    import metrics
+    from jobqueue import job_queue
+    from main import build_dispatcher, send_scheduler
+
+    # у каждого воркера свой /metrics: METRICS_PORT + 1 + index
+    metrics.port_offset = index + 1
+    # задачи генерации — только своих пользователей (тот же шард, что и у апдейтов)
+    job_queue.shard = (index, workers)
+    # общий лимит исходящих Telegram делим между воркерами
+    send_scheduler.share_global(workers)
+    load_dotenv()
+    bot = Bot(token=os.getenv('TG_TOKEN', ''))
+    dp = build_dispatcher()
+
+    async def beat():
+        # отметка идёт из event loop: зависший loop перестанет отмечаться
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(WORKER_HEARTBEAT)
+
+    loop = asyncio.get_running_loop()
+    tails: dict[int, asyncio.Task] = {}
+    beat_task = asyncio.create_task(beat())
+    await dp.emit_startup(bot=bot, bots=[bot], dispatcher=dp)
+    try:
+        while True:
+            update = await loop.run_in_executor(None, _take, queue, taken)
+            if update is None:
+                break
+            uid = update_user_id(update)
+            task = asyncio.create_task(_handle(dp, bot, update, tails.get(uid)))
+            tails[uid] = task
+            task.add_done_callback(lambda t, uid=uid: tails.get(uid) is t and tails.pop(uid))
+        await asyncio.gather(*tails.values(), return_exceptions=True)
+    finally:
+        beat_task.cancel()
+        await dp.emit_shutdown(bot=bot, bots=[bot], dispatcher=dp)
+        await bot.session.close()
+    logger.info("Воркер %d остановлен", index)
+
+
+# ---------- Супервизор ----------
+class Supervisor:
+    """
+    Получает апдейты один раз и раздаёт их N процессам-воркерам по tg_id:
+    у каждого пользователя свой воркер, поэтому порядок апдейтов и его
+    кэши/FSM остаются в одном процессе. Упавшие и зависшие воркеры
+    перезапускаются.
+
+    Убитый процесс мог остаться внутри queue.get с блокировкой чтения —
+    тогда из этой очереди больше никто не прочитает. Поэтому новое поколение
+    воркера получает новую очередь, а апдейты, которые старое поколение так
+    и не забрало (их номера больше taken), супервизор отправляет заново.
+    """
+
+    def __init__(self, workers: int, target: Callable = _worker_main):
+        self._ctx = mp.get_context("spawn")
+        self.workers = workers
+        self.target = target
+        self.queues = [self._ctx.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self.heartbeats = [self._ctx.Value("d", 0.0) for _ in range(workers)]
+        # номер последнего апдейта, который воркер забрал из очереди
+        self.taken = [self._ctx.Value("q", 0) for _ in range(workers)]
+        # отправленные воркеру апдейты (номер, апдейт), которые он, возможно, ещё не забрал
+        self.sent: list[deque] = [deque() for _ in range(workers)]
+        self.procs: list[Optional[mp.Process]] = [None] * workers
+        self.restarts = 0
+        self.redispatched = 0
+        self._seq = itertools.count(1)
+        # порядок апдейтов в очереди воркера: отправка и переотправка — по одной
+        self._locks = [asyncio.Lock() for _ in range(workers)]
+        self._tasks: set[asyncio.Task] = set()
+        self._stopping = False
+
+    def _start(self, index: int) -> None:
+        # до первой отметки воркера считаем, что он «отметился» в конце grace-периода
+        self.heartbeats[index].value = time.time() + WORKER_START_GRACE
+        proc = self._ctx.Process(
+            target=self.target,
+            args=(index, self.workers, self.queues[index], self.heartbeats[index], self.taken[index]),
+            name=f"bot-worker-{index}",
+            daemon=True,
+        )
+        proc.start()
+        self.procs[index] = proc
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._start(index)
+
+    def _unsent(self, index: int) -> deque:
+        sent, taken = self.sent[index], self.taken[index].value
+        while sent and sent[0][0] <= taken:
+            sent.popleft()
+        return sent
+
+    async def _put(self, index: int, queue: mp.Queue, item: tuple) -> None:
+        loop = asyncio.get_running_loop()
+        # пока воркера не перезапустили: иначе апдейт переотправит _redispatch
+        while self.queues[index] is queue:
+            try:
+                await loop.run_in_executor(None, queue.put, item, True, 1.0)
+                return
+            except Full:
+                continue
+
+    async def dispatch(self, update: dict[str, Any]) -> None:
+        index = update_user_id(update) % self.workers
+        async with self._locks[index]:
+            item = (next(self._seq), update)
+            self._unsent(index).append(item)
+            await self._put(index, self.queues[index], item)
+
+    async def _restart(self, index: int) -> None:
+        old, self.queues[index] = self.queues[index], self._ctx.Queue(WORKER_QUEUE_SIZE)
+        # старую очередь бросаем: выход супервизора не должен ждать её фоновый поток
+        old.cancel_join_thread()
+        self._start(index)
+        task = asyncio.create_task(self._redispatch(index))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _redispatch(self, index: int) -> None:
+        async with self._locks[index]:
+            queue = self.queues[index]
+            unsent = list(self._unsent(index))
+            for item in unsent:
+                await self._put(index, queue, item)
+        if unsent:
+            self.redispatched += len(unsent)
+            logger.warning("Воркеру %d заново отправлено апдейтов: %d", index, len(unsent))
+
+    async def monitor(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(WORKER_HEARTBEAT)
+            for index, proc in enumerate(self.procs):
+                silent = max(time.time() - self.heartbeats[index].value, 0.0)
+                if proc is not None and proc.is_alive() and silent < WORKER_HEARTBEAT_TIMEOUT:
+                    continue
+                logger.warning("Воркер %d не отвечает (%.0f с), перезапуск", index, silent)
+                if proc is not None and proc.is_alive():
+                    proc.kill()
+                    # join — в потоке: event loop супервизора продолжает принимать апдейты
+                    await asyncio.get_running_loop().run_in_executor(None, proc.join, 5)
+                self.restarts += 1
+                await self._restart(index)
+
+    async def poll(self, bot: Bot, allowed_updates: list[str]) -> None:
+        offset = None
+        while not self._stopping:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception:
+                logger.exception("Ошибка получения апдейтов")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+
+    def health(self) -> dict:
+        now = time.time()
+        return {
+            "workers": [
+                {
+                    "alive": bool(proc and proc.is_alive()),
+                    "heartbeat_age": max(now - hb.value, 0.0),
+                    "queued": _qsize(queue),
+                }
+                for proc, hb, queue in zip(self.procs, self.heartbeats, self.queues)
+            ],
+            "restarts": self.restarts,
+            "redispatched": self.redispatched,
+        }
+
+    def stop(self) -> None:
+        self._stopping = True
+        for queue in self.queues:
+            try:
+                queue.put(None, timeout=1)
+            except Full:
+                # очередь полна (воркер мёртв или завис) — его убьём ниже, после join
+                pass
+        for proc in self.procs:
+            if proc is not None:
+                proc.join(10)
+                if proc.is_alive():
+                    proc.kill()
+
+
+def _qsize(queue: mp.Queue) -> Optional[int]:
+    try:
+        return queue.qsize()
+    except NotImplementedError:  # macOS
+        return None